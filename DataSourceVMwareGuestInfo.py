@@ -19,43 +19,106 @@ A cloud init datasource for VMware GuestInfo.
 '''
 
 import base64
+import binascii
 import collections
-import copy
-from distutils.spawn import find_executable
-from distutils.util import strtobool
-import ipaddress
+import errno
+import fnmatch
+import functools
+import hashlib
 import json
 import os
+import random
+import select
 import socket
+import stat
 import string
+import struct
+import sys
+import threading
 import time
-import zlib
 
 from cloudinit import log as logging
 from cloudinit import sources
 from cloudinit import util
 from cloudinit import safeyaml
 
-import netifaces
+# from python >= 3.3 the abstract base classes are in collections.abc
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 # from cloud-init >= 20.3 subp is in its own module
 try:
-    from cloudinit.subp import subp, ProcessExecutionError
+    from cloudinit.subp import subp, which, ProcessExecutionError
 except ImportError:
-    from cloudinit.util import subp, ProcessExecutionError
+    from cloudinit.util import subp, which, ProcessExecutionError
+
+# netifaces, ipaddress, and zlib are imported by the functions that use
+# them, as cloud-init imports every configured datasource during discovery,
+# even on hosts that are not VMware VMs.
 
 
 LOG = logging.getLogger(__name__)
 NOVAL = "No value found"
-VMWARE_RPCTOOL = find_executable("vmware-rpctool")
+VMWARE_RPCTOOL = "vmware-rpctool"
+VMWARE_RPCI = "vmware-rpci"
+VMWARE_SEED = "vmware-seed"
+VMWARE_LIBVMTOOLS = ("libvmtools.so.0", "libvmtools.so")
 VMX_GUESTINFO = "VMX_GUESTINFO"
 GUESTINFO_EMPTY_YAML_VAL = "---"
 LOCAL_IPV4 = 'local-ipv4'
 LOCAL_IPV6 = 'local-ipv6'
 CLEANUP_GUESTINFO = 'cleanup-guestinfo'
+PUBLIC_KEYS_DATA = 'public-keys-data'
 WAIT_ON_NETWORK = 'wait-on-network'
 WAIT_ON_NETWORK_IPV4 = 'ipv4'
 WAIT_ON_NETWORK_IPV6 = 'ipv6'
+WAIT_ON_NETWORK_TIMEOUT = 'timeout'
+WAIT_ON_NETWORK_INTERVAL = 'interval'
+WAIT_ON_NETWORK_BACKOFF = 'backoff'
+WAIT_ON_NETWORK_MAX_INTERVAL = 'max-interval'
+WAIT_ON_NETWORK_MODE = 'mode'
+WAIT_ON_NETWORK_MODE_ALL = 'all'
+WAIT_ON_NETWORK_MODE_ANY = 'any'
+WAIT_ON_NETWORK_INTERFACE = 'interface'
+WAIT_ON_NETWORK_CIDR = 'cidr'
+HOST_INFO = 'host-info'
+HOST_INFO_INCLUDE_INTERFACES = 'include-interfaces'
+HOST_INFO_EXCLUDE_INTERFACES = 'exclude-interfaces'
+HOST_INFO_EXCLUDE_DRIVERS = 'exclude-drivers'
+HOST_INFO_EXCLUDE_TYPES = 'exclude-types'
+HOST_INFO_MAX_ADDRESSES = 'max-addresses'
+HOST_INFO_HOSTNAME_RESOLUTION = 'hostname-resolution'
+HOST_INFO_HOSTNAME_TIMEOUT = 'hostname-timeout'
+HOSTNAME_RESOLUTION_DNS = 'dns'
+HOSTNAME_RESOLUTION_HOSTS = 'hosts'
+HOSTNAME_RESOLUTION_METADATA = 'metadata'
+HOSTNAME_RESOLUTION_NONE = 'none'
+ETC_HOSTS = '/etc/hosts'
+SYS_CLASS_NET = '/sys/class/net'
+GUESTINFO_KEYS = ('metadata', 'userdata', 'vendordata')
+GUESTINFO_PAYLOAD_KEYS = ('userdata', 'vendordata')
+GUESTINFO_REVISION = 'revision'
+GUESTINFO_METADATA_FORMAT = 'metadata.format'
+GUESTINFO_TIMING = 'cloudinit.timing'
+METADATA_TIMING = 'guestinfo-timing'
+FORMAT_JSON = 'json'
+FORMAT_YAML = 'yaml'
+GUESTINFO_CACHE_FILE = 'vmware-guestinfo-cache.json'
+GUESTINFO_CACHE_VERSION = 2
+PRODUCT_UUID_FILE = '/sys/class/dmi/id/product_uuid'
+GUESTINFO_PROBE_DIR = '/run/cloud-init/vmware-guestinfo-probe'
+GUESTINFO_SEED_PATHS = ('/var/lib/cloud/seed/vmware-guestinfo',)
+GUESTINFO_SEED_CDROM = '/dev/sr0'
+OVF_ENV_FILE = 'ovf-env.xml'
+
+
+class DecodeError(Exception):
+    '''
+    DecodeError is raised when a guestinfo value cannot be decoded.
+    '''
+    pass
 
 
 class NetworkConfigError(Exception):
@@ -66,6 +129,94 @@ class NetworkConfigError(Exception):
     pass
 
 
+class Timing(object):
+    '''
+    Timing records how long the datasource's stages take, along with
+    counters such as the number of bytes fetched from guestinfo. It is safe
+    to use from multiple threads.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def timer(self, name):
+        '''
+        timer returns a context manager that records the time spent in its
+        block under name
+        '''
+        return _Timer(self, name)
+
+    def add(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0}
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def to_dict(self):
+        '''
+        to_dict returns the recorded timers, in seconds, and counters
+        '''
+        with self._lock:
+            timers = collections.OrderedDict()
+            for name, timer in self.timers.items():
+                timers[name] = {
+                    'count': timer['count'],
+                    'total': round(timer['total'], 6),
+                    'max': round(timer['max'], 6),
+                }
+            return {
+                'timers': timers,
+                'counters': collections.OrderedDict(self.counters),
+            }
+
+
+class _Timer(object):
+
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.timing.add(self.name, time.time() - self.start)
+
+
+TIMING = Timing()
+
+
+def timed(name):
+    '''
+    timed is a decorator that records the time spent in the decorated
+    function under name
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TIMING.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class DataSourceVMwareGuestInfo(sources.DataSource):
     '''
     This cloud-init datasource was designed for use with CentOS 7,
@@ -101,17 +252,55 @@ class DataSourceVMwareGuestInfo(sources.DataSource):
         enough to parse the data.
 
         The metadata key "network.encoding" may be used to indicate the
-        format of the metadata key "network". Valid encodings are base64
-        and gzip+base64.
+        format of the metadata key "network". Valid encodings are base64,
+        gzip+base64, xz+base64, and zstd+base64.
+
+    Filtering the host's network interfaces:
+        The metadata key "host-info", or the key of the same name in the
+        datasource config, may be used to exclude network interfaces from
+        the host info by name, driver, or type, and to limit the number of
+        recorded addresses.
+
+    Recording the datasource's timing:
+        The time spent in each stage of the datasource, along with the
+        number of bytes fetched, subprocesses executed, etc., is recorded
+        in the metadata key "guestinfo-timing". Setting "publish-timing:
+        true" in the datasource config also writes the record to the key
+        "guestinfo.cloudinit.timing".
+
+    Splitting large values across keys:
+        The metadata, user data, and vendor data may each be split across
+        the keys "guestinfo.<key>.0" to "guestinfo.<key>.<N-1>" by setting
+        "guestinfo.<key>.parts" to N. The parts are fetched concurrently
+        and checked against "guestinfo.<key>.digest" if it is set.
+
+    Loading the user data and vendor data:
+        The user data and vendor data are fetched in the background once
+        the metadata is loaded, and userdata_raw and vendordata_raw wait
+        for them when they are first read.
+
+    Caching the guestinfo data:
+        The decoded guestinfo values and the loaded metadata are cached in
+        the file vmware-guestinfo-cache.json in cloud-init's data directory.
+        On subsequent boots a value is decoded again only if its raw value
+        or encoding changed. If the key "guestinfo.revision" is set and is
+        unchanged since the last boot, the cached data is used without
+        fetching the other keys at all. The cache is discarded when the
+        VM's BIOS UUID changes, such as when the VM is cloned. The cache is
+        disabled by setting "cache: false" in the datasource config.
     '''
 
     dsname = 'VMwareGuestInfo'
 
     def __init__(self, sys_cfg, distro, paths, ud_proc=None):
+        self._pending_guestinfo = None
+        self._network_config = None
+        self.guestinfo_errors = {}
         sources.DataSource.__init__(self, sys_cfg, distro, paths, ud_proc)
         if not get_data_access_method():
             LOG.error("Failed to find vmware-rpctool")
 
+    @timed('get_data')
     def get_data(self):
         """
         This method should really be _get_data in accordance with the most
@@ -127,18 +316,32 @@ class DataSourceVMwareGuestInfo(sources.DataSource):
             LOG.error("vmware-rpctool is required to fetch guestinfo value")
             return False
 
-        # Get the metadata.
-        self.metadata = load_metadata()
-
-        # Get the user data.
-        self.userdata_raw = guestinfo('userdata')
-
-        # Get the vendor data.
-        self.vendordata_raw = guestinfo('vendordata')
-
-        # Check to see if any of the guestinfo data should be removed.
-        if data_access_method == VMWARE_RPCTOOL and CLEANUP_GUESTINFO in self.metadata:
-            clear_guestinfo_keys(self.metadata[CLEANUP_GUESTINFO])
+        # The user data and vendor data are not needed until cloud-init
+        # consumes them, so they are fetched and decoded in the background
+        # while the metadata is loaded and the network is brought up. Any
+        # values that are unchanged since they were cached are not decoded
+        # again.
+        self._network_config = None
+        self.wait_for_guestinfo()
+        self.guestinfo_errors = {}
+        cache = self.read_guestinfo_cache()
+        if cache is None:
+            self.fetch_guestinfo_payloads()
+            self.metadata = load_metadata()
+        else:
+            self.metadata = self.load_cached_guestinfo(cache)
+
+        # Check to see if any of the guestinfo data should be removed. The
+        # keys are not cleared until the user data and vendor data are read,
+        # and those that could not be read are left in place.
+        if get_transport().writable and CLEANUP_GUESTINFO in self.metadata:
+            self.wait_for_guestinfo()
+            cleanup_keys = self.metadata[CLEANUP_GUESTINFO]
+            if not type(cleanup_keys) in (list, tuple):
+                cleanup_keys = [cleanup_keys]
+            clear_guestinfo_keys([
+                key for key in cleanup_keys
+                if key not in self.guestinfo_errors])
 
         if self.metadata or self.userdata_raw or self.vendordata_raw:
             return True
@@ -155,7 +358,10 @@ class DataSourceVMwareGuestInfo(sources.DataSource):
         brought up the OS at this point.
         """
 
-        host_info = wait_on_network(self.metadata)
+        host_info = wait_on_network(
+            self.metadata,
+            get_host_info_config(
+                self.ds_cfg.get(HOST_INFO), self.metadata.get(HOST_INFO)))
         LOG.info("got host-info: %s", host_info)
 
         # Reflect any possible local IPv4 or IPv6 addresses in the guest
@@ -167,17 +373,32 @@ class DataSourceVMwareGuestInfo(sources.DataSource):
         # etc.
         self.metadata = merge_dicts(self.metadata, host_info)
 
+        # Record how long each stage took so far in the instance data.
+        self.metadata[METADATA_TIMING] = TIMING.to_dict()
+
         # Persist the instance data for versions of cloud-init that support
         # doing so. This occurs here rather than in the get_data call in
         # order to ensure that the network interfaces are up and can be
         # persisted with the metadata.
         try:
-            self.persist_instance_data()
+            with TIMING.timer('persist_instance_data'):
+                self.persist_instance_data()
         except AttributeError:
             pass
 
+        if util.is_true(self.ds_cfg.get('publish-timing', False)):
+            publish_timing()
+
     @property
     def network_config(self):
+        '''
+        network_config returns the network config from the metadata, which
+        was validated when it was loaded, or the distro's fallback config.
+        The config is computed once and reused until get_data runs again.
+        '''
+        config = getattr(self, '_network_config', None)
+        if config is not None:
+            return config
         if 'network' in self.metadata:
             LOG.debug("using metadata network config")
         else:
@@ -185,72 +406,512 @@ class DataSourceVMwareGuestInfo(sources.DataSource):
             self.metadata['network'] = {
                 'config': self.distro.generate_fallback_config(),
             }
-        return self.metadata['network']['config']
+        self._network_config = self.metadata['network']['config']
+        return self._network_config
 
     def get_instance_id(self):
         # Pull the instance ID out of the metadata if present. Otherwise
         # read the file /sys/class/dmi/id/product_uuid for the instance ID.
         if self.metadata and 'instance-id' in self.metadata:
             return self.metadata['instance-id']
-        with open('/sys/class/dmi/id/product_uuid', 'r') as id_file:
-            self.metadata['instance-id'] = str(id_file.read()).rstrip().lower()
-            return self.metadata['instance-id']
+        self.metadata['instance-id'] = get_product_uuid()
+        return self.metadata['instance-id']
+
+    def get_guestinfo_cache_path(self):
+        return os.path.join(
+            self.paths.cloud_dir, 'data', GUESTINFO_CACHE_FILE)
+
+    def read_guestinfo_cache(self):
+        '''
+        read_guestinfo_cache returns the guestinfo cache, or None if the
+        cache is disabled. An empty cache is returned if the cache file
+        does not exist, cannot be read, or was written on a VM with another
+        BIOS UUID, such as the VM that this one was cloned from.
+        '''
+        if util.is_false(self.ds_cfg.get('cache', True)):
+            LOG.debug("guestinfo cache is disabled")
+            return None
+
+        path = self.get_guestinfo_cache_path()
+        try:
+            cache = json.loads(util.load_file(path))
+        except (IOError, OSError):
+            return {}
+        except ValueError as error:
+            LOG.warning("discarding invalid guestinfo cache %s: %s", path, error)
+            return {}
+
+        if not isinstance(cache, dict) or \
+                cache.get('version') != GUESTINFO_CACHE_VERSION:
+            return {}
+        if cache.get('product-uuid') != read_product_uuid():
+            LOG.debug("discarding guestinfo cache for instance %s",
+                      cache.get('instance-id'))
+            return {}
+        return cache
+
+    def load_cached_guestinfo(self, cache):
+        '''
+        load_cached_guestinfo returns the loaded metadata and fetches the
+        user data and vendor data in the background. Decoded values and the
+        loaded metadata are reused from the cache if their raw values are
+        unchanged, and the cache is written back to disk when it changes.
+        Nothing else is fetched if the revision and the fingerprint of the
+        signing key are unchanged.
+        '''
+        entries = cache.get('values', {})
+        revision = cache.get('revision')
+        if revision and 'metadata' in cache and \
+                all(key in entries for key in GUESTINFO_KEYS) and \
+                cache.get('signing-key') == get_signing_key_fingerprint(
+                    read_signing_key()) and \
+                revision == get_guestinfo_value(GUESTINFO_REVISION):
+            LOG.debug("guestinfo revision %s is unchanged", revision)
+            self.userdata_raw = entries['userdata']['value']
+            self.vendordata_raw = entries['vendordata']['value']
+            return cache['metadata']
+
+        digests = dict((k, e.get('digest')) for k, e in entries.items())
+        metadata_digest = digests.get('metadata')
+
+        # The user data and vendor data are fetched and decoded while the
+        # metadata is loaded, but the cache is not written until the
+        # metadata is known.
+        loaded = threading.Event()
+        state = {}
+
+        def write_cache():
+            loaded.wait()
+            new_cache = state.get('cache')
+            if new_cache is None:
+                return
+            for key in state['cleanup_keys']:
+                entries.pop(key, None)
+
+            # Only write the cache if it changed, as rewriting large values
+            # on every boot costs more than decoding them.
+            new_digests = dict(
+                (k, e.get('digest')) for k, e in entries.items())
+            if new_digests != digests or any(
+                    cache.get(k) != v
+                    for k, v in new_cache.items() if k != 'values'):
+                self.write_guestinfo_cache(new_cache)
+
+        self.fetch_guestinfo_payloads(entries, write_cache)
+        try:
+            metadata = self.load_cached_metadata(
+                cache, entries, metadata_digest, state)
+        finally:
+            loaded.set()
+        return metadata
+
+    def load_cached_metadata(self, cache, entries, metadata_digest, state):
+        '''
+        load_cached_metadata returns the loaded metadata, reusing the cached
+        metadata if its raw value and format are unchanged. The new cache
+        and the keys to remove from it are recorded in state.
+        '''
+        values = guestinfo_many(
+            ['metadata'], entries,
+            raw_keys=[GUESTINFO_REVISION, GUESTINFO_METADATA_FORMAT])
+        revision = values.pop(GUESTINFO_REVISION)
+        metadata_format = values[GUESTINFO_METADATA_FORMAT]
+
+        metadata_entry = entries.get('metadata')
+        if 'metadata' in cache and metadata_entry and \
+                metadata_entry['digest'] == metadata_digest and \
+                cache.get('metadata-format') == metadata_format:
+            LOG.debug("guestinfo.metadata is unchanged")
+            metadata = cache['metadata']
+        else:
+            network_cache = cache.get('network')
+            if not isinstance(network_cache, dict):
+                network_cache = {}
+            metadata = load_metadata(values, network_cache)
+            cache['network'] = network_cache
+
+        # Keys that are about to be cleared from guestinfo must not be
+        # reused on the next boot, nor may the revision that covers them.
+        cleanup_keys = metadata.get(CLEANUP_GUESTINFO)
+        if cleanup_keys:
+            revision = None
+            if not type(cleanup_keys) in (list, tuple):
+                cleanup_keys = [cleanup_keys]
+
+        state['cleanup_keys'] = cleanup_keys or ()
+        state['cache'] = {
+            'version': GUESTINFO_CACHE_VERSION,
+            'instance-id': get_metadata_instance_id(metadata),
+            'product-uuid': read_product_uuid(),
+            'revision': revision,
+            'signing-key': get_signing_key_fingerprint(read_signing_key()),
+            'values': entries,
+            'metadata': metadata,
+            'metadata-format': metadata_format,
+            'network': cache.get('network', {}),
+        }
+        return metadata
+
+    def fetch_guestinfo_payloads(self, cache=None, callback=None):
+        '''
+        fetch_guestinfo_payloads starts fetching the user data and vendor
+        data in the background. The values are decoded, using the cache
+        entries if provided, and then callback is invoked, if provided, on
+        the same background thread. The cache entry of a value that fails
+        to decode is removed before callback is invoked.
+        '''
+        def fetch():
+            errors = {}
+            with TIMING.timer('fetch_guestinfo_payloads'):
+                values = guestinfo_many(
+                    GUESTINFO_PAYLOAD_KEYS, cache, errors=errors)
+            if cache is not None:
+                for key in errors:
+                    cache.pop(key, None)
+            if callback:
+                callback()
+            return values, errors
+
+        self.wait_for_guestinfo()
+        self.guestinfo_errors = {}
+        self._pending_guestinfo = BackgroundCall(fetch)
+
+    def wait_for_guestinfo(self):
+        '''
+        wait_for_guestinfo blocks until the user data and vendor data that
+        are being fetched in the background, if any, are available. An
+        error raised while fetching or decoding a value is logged once and
+        saved in guestinfo_errors under its key, and that value is None on
+        this and every later access, rather than raising from whatever
+        reads it. If the values cannot be fetched at all, the error is
+        saved for both of them.
+        '''
+        pending = getattr(self, '_pending_guestinfo', None)
+        if pending is None:
+            return
+        self._pending_guestinfo = None
+        with TIMING.timer('wait_for_guestinfo'):
+            try:
+                values, errors = pending.result()
+            except Exception as error:
+                values = dict((k, None) for k in GUESTINFO_PAYLOAD_KEYS)
+                errors = dict((k, error) for k in GUESTINFO_PAYLOAD_KEYS)
+        for key in GUESTINFO_PAYLOAD_KEYS:
+            if key in errors:
+                LOG.error("Failed to fetch guestinfo.%s, ignoring it: %s",
+                          key, errors[key])
+        self.guestinfo_errors = errors
+        self._userdata_raw = values['userdata']
+        self._vendordata_raw = values['vendordata']
+
+    @property
+    def userdata_raw(self):
+        self.wait_for_guestinfo()
+        return getattr(self, '_userdata_raw', None)
+
+    @userdata_raw.setter
+    def userdata_raw(self, value):
+        self.wait_for_guestinfo()
+        self._userdata_raw = value
+
+    @property
+    def vendordata_raw(self):
+        self.wait_for_guestinfo()
+        return getattr(self, '_vendordata_raw', None)
+
+    @vendordata_raw.setter
+    def vendordata_raw(self, value):
+        self.wait_for_guestinfo()
+        self._vendordata_raw = value
+
+    def __getstate__(self):
+        # cloud-init pickles the datasource at the end of each stage, which
+        # requires the background fetch to be complete.
+        self.wait_for_guestinfo()
+        parent = getattr(
+            super(DataSourceVMwareGuestInfo, self), '__getstate__', None)
+        if parent is not None:
+            state = dict(parent() or {})
+        else:
+            state = self.__dict__.copy()
+        state.pop('_pending_guestinfo', None)
+        state.pop('guestinfo_errors', None)
+        return state
+
+    def __setstate__(self, state):
+        # Datasources pickled by earlier versions store the user data and
+        # vendor data as plain attributes.
+        for key in GUESTINFO_PAYLOAD_KEYS:
+            if key + '_raw' in state:
+                state['_' + key + '_raw'] = state.pop(key + '_raw')
+        parent = getattr(
+            super(DataSourceVMwareGuestInfo, self), '__setstate__', None)
+        if parent is not None:
+            parent(state)
+        else:
+            self.__dict__.update(state)
+
+    def write_guestinfo_cache(self, cache):
+        path = self.get_guestinfo_cache_path()
+        try:
+            content = json.dumps(cache, sort_keys=True)
+        except (TypeError, ValueError) as error:
+            LOG.warning("guestinfo data cannot be cached: %s", error)
+            return
+        try:
+            util.write_file(path + '.tmp', content, mode=0o600)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed to write guestinfo cache %s", path)
 
     def get_public_ssh_keys(self):
-        public_keys_data = ""
-        if 'public-keys-data' in self.metadata:
-            public_keys_data = self.metadata['public-keys-data'].splitlines()
+        return get_public_ssh_keys(self.metadata)
 
-        public_keys = []
-        if not public_keys_data:
-            return public_keys
 
-        for public_key in public_keys_data:
-            public_keys.append(public_key)
+def get_public_ssh_keys(metadata):
+    '''
+    get_public_ssh_keys returns the list of public SSH keys in the metadata
+    key "public-keys-data"
+    '''
+    public_keys_data = ""
+    if PUBLIC_KEYS_DATA in metadata:
+        public_keys_data = metadata[PUBLIC_KEYS_DATA].splitlines()
 
+    public_keys = []
+    if not public_keys_data:
         return public_keys
 
+    for public_key in public_keys_data:
+        public_keys.append(public_key)
+
+    return public_keys
+
+
+_MAX_DECODED_SIZE_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_MAX_DECODED_SIZE'
+_MAX_DECODED_SIZE = 64 * 1024 * 1024
+_DECODE_CHUNK_SIZE = 64 * 1024
+_BASE64_WHITESPACE = b' \t\r\n\v\f'
+_ENC_BASE64 = ('base64', 'b64')
+_ENC_GZIP_BASE64 = ('gzip+base64', 'gz+b64')
+_ENC_XZ_BASE64 = ('xz+base64', 'xz+b64')
+_ENC_ZSTD_BASE64 = ('zstd+base64', 'zst+b64')
+
+# The largest output of a single zstd block. Every block takes at least
+# four bytes of input, including its header.
+_ZSTD_BLOCK_SIZE_MAX = 128 * 1024
+_ZSTD_BLOCK_INPUT_MIN = 4
+
+
+def get_max_decoded_size():
+    '''
+    get_max_decoded_size returns the maximum size, in bytes, of a decoded
+    guestinfo value. The default may be overridden with the environment
+    variable CLOUD_INIT_VMWARE_GUEST_INFO_MAX_DECODED_SIZE.
+    '''
+    val = os.getenv(_MAX_DECODED_SIZE_ENV_VAR)
+    if val:
+        try:
+            return int(val)
+        except ValueError:
+            LOG.warning("invalid %s: %s", _MAX_DECODED_SIZE_ENV_VAR, val)
+    return _MAX_DECODED_SIZE
+
+
+def new_decompressor(enc_type):
+    '''
+    new_decompressor returns a decompressor for the compression used by
+    enc_type, or None if enc_type is not compressed
+    '''
+    if enc_type in _ENC_GZIP_BASE64:
+        import zlib
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if enc_type in _ENC_XZ_BASE64:
+        try:
+            import lzma
+        except ImportError:
+            raise DecodeError("%s requires the lzma module" % enc_type)
+        return lzma.LZMADecompressor()
+    if enc_type in _ENC_ZSTD_BASE64:
+        try:
+            import zstandard
+        except ImportError:
+            raise DecodeError("%s requires the zstandard module" % enc_type)
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+class StreamDecoder(object):
+    '''
+    StreamDecoder decodes a guestinfo value incrementally. Base64 text is
+    decoded and inflated one chunk at a time, so only the decoded output
+    is held in memory in full, and decoding stops as soon as the output
+    exceeds max_size.
+    '''
+
+    def __init__(self, key, enc_type, max_size=None):
+        self.key = key
+        self.enc_type = enc_type
+        self.max_size = max_size or get_max_decoded_size()
+        self.base64 = enc_type in _ENC_BASE64 or \
+            enc_type in _ENC_GZIP_BASE64 or \
+            enc_type in _ENC_XZ_BASE64 or \
+            enc_type in _ENC_ZSTD_BASE64
+        self._decompressor = new_decompressor(enc_type)
+        self._carry = b''
+        self._output = bytearray()
+
+    def update(self, chunk):
+        '''
+        update decodes the next chunk of the raw value
+        '''
+        if not chunk:
+            return
+        if not self.base64:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            self._write(chunk)
+            return
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('ascii')
+        chunk = self._carry + chunk.translate(None, _BASE64_WHITESPACE)
+        size = len(chunk) - len(chunk) % 4
+        self._carry = chunk[size:]
+        if size:
+            self._inflate(self._b64decode(chunk[:size]))
+
+    def finish(self):
+        '''
+        finish decodes any remaining input and returns the decoded value
+        as bytes
+        '''
+        if self._carry:
+            self._inflate(self._b64decode(self._carry))
+            self._carry = b''
+        # A truncated stream is not an error to the decompressors, so check
+        # that the stream is complete, before flushing invalidates them.
+        if self._decompressor is not None and not self._is_eof():
+            raise DecodeError(
+                "failed to inflate %s: incomplete or truncated stream" %
+                self.key)
+        flush = getattr(self._decompressor, 'flush', None)
+        if flush:
+            try:
+                self._write(flush())
+            except DecodeError:
+                raise
+            except Exception as error:
+                raise DecodeError(
+                    "failed to inflate %s: %s" % (self.key, error))
+        output = self._output
+        self._output = bytearray()
+        return output
+
+    def _is_eof(self):
+        eof = getattr(self._decompressor, 'eof', None)
+        if eof is not None:
+            return eof
+        if self.enc_type not in _ENC_GZIP_BASE64:
+            # The decompressor cannot tell whether its stream is complete.
+            return True
+        # Python 2.7's zlib does not report the end of the stream, but any
+        # data after the end of the stream is returned as unused_data.
+        if self._decompressor.unused_data:
+            return True
+        probe = self._decompressor.copy()
+        try:
+            probe.decompress(b'\0')
+        except Exception:
+            return False
+        return bool(probe.unused_data)
 
-def decode(key, enc_type, data):
+    def _b64decode(self, data):
+        try:
+            return binascii.a2b_base64(data)
+        except (binascii.Error, TypeError) as error:
+            raise DecodeError(
+                "failed to decode %s as base64: %s" % (self.key, error))
+
+    def _inflate(self, data):
+        if self._decompressor is None:
+            self._write(data)
+            return
+        # Each call is bounded so that a small, highly compressed chunk
+        # cannot inflate far past the limit in memory.
+        try:
+            if self.enc_type in _ENC_GZIP_BASE64:
+                while data:
+                    self._write(self._decompressor.decompress(
+                        data, self._remaining()))
+                    data = self._decompressor.unconsumed_tail
+            elif self.enc_type in _ENC_XZ_BASE64:
+                self._write(self._decompressor.decompress(
+                    data, self._remaining()))
+                while not self._decompressor.eof and \
+                        not self._decompressor.needs_input:
+                    self._write(self._decompressor.decompress(
+                        b'', self._remaining()))
+            else:
+                # The zstd decompressor cannot limit its output, so it is
+                # given only as much input as cannot produce more than the
+                # remaining output, plus at most two blocks.
+                offset = 0
+                while offset < len(data):
+                    blocks = self._remaining() // _ZSTD_BLOCK_SIZE_MAX
+                    end = offset + max(1, blocks) * _ZSTD_BLOCK_INPUT_MIN
+                    self._write(self._decompressor.decompress(
+                        data[offset:end]))
+                    offset = end
+        except DecodeError:
+            raise
+        except Exception as error:
+            raise DecodeError("failed to inflate %s: %s" % (self.key, error))
+
+    def _remaining(self):
+        # One byte more than the limit is requested, so that exceeding the
+        # limit is detected.
+        return self.max_size - len(self._output) + 1
+
+    def _write(self, data):
+        if len(self._output) + len(data) > self.max_size:
+            raise DecodeError(
+                "decoded %s exceeds %d bytes" % (self.key, self.max_size))
+        self._output += data
+
+
+def decode(key, enc_type, data, digest=None):
     '''
     decode returns the decoded string value of data
     key is a string used to identify the data being decoded in log messages
-    ----
-    In py 2.7:
-    json.loads method takes string as input
-    zlib.decompress takes and returns a string
-    base64.b64decode takes and returns a string
-    -----
-    In py 3.6 and newer:
-    json.loads method takes bytes or string as input
-    zlib.decompress takes and returns a bytes
-    base64.b64decode takes bytes or string and returns bytes
-    -----
-    In py > 3, < 3.6:
-    json.loads method takes string as input
-    zlib.decompress takes and returns a bytes
-    base64.b64decode takes bytes or string and returns bytes
-    -----
-    Given the above conditions the output from zlib.decompress and
-    base64.b64decode would be bytes with newer python and str in older
-    version. Thus we would covert the output to str before returning
+
+    Values encoded as base64, gzip+base64, xz+base64, or zstd+base64 are
+    decoded with a StreamDecoder, one chunk at a time, and the result is
+    converted to a str. Values with any other encoding are plain text and
+    are returned as a str without being copied.
+
+    If digest is a hashlib object, it is updated with each chunk of the raw
+    data as the chunk is decoded.
     '''
     LOG.debug("Getting encoded data for key=%s, enc=%s", key, enc_type)
 
-    raw_data = None
-    if enc_type == "gzip+base64" or enc_type == "gz+b64":
-        LOG.debug("Decoding %s format %s", enc_type, key)
-        raw_data = zlib.decompress(base64.b64decode(data), zlib.MAX_WBITS | 16)
-    elif enc_type == "base64" or enc_type == "b64":
-        LOG.debug("Decoding %s format %s", enc_type, key)
-        raw_data = base64.b64decode(data)
-    else:
+    decoder = StreamDecoder(key, enc_type)
+    if not decoder.base64:
         LOG.debug("Plain-text data %s", key)
-        raw_data = data
-
-    if isinstance(raw_data, bytes):
-        return raw_data.decode('utf-8')
-    return raw_data
+        if digest is not None:
+            digest.update(
+                data if isinstance(data, bytes) else data.encode('utf-8'))
+        if isinstance(data, bytes) and not isinstance(data, str):
+            return data.decode('utf-8')
+        return data
+
+    LOG.debug("Decoding %s format %s", enc_type, key)
+    with TIMING.timer('decode.' + key):
+        for i in range(0, len(data), _DECODE_CHUNK_SIZE):
+            chunk = data[i:i + _DECODE_CHUNK_SIZE]
+            if digest is not None:
+                digest.update(chunk if isinstance(chunk, bytes)
+                              else chunk.encode('utf-8'))
+            decoder.update(chunk)
+        return decoder.finish().decode('utf-8')
 
 
 def get_none_if_empty_val(val):
@@ -273,26 +934,32 @@ def get_none_if_empty_val(val):
     return val
 
 
+@timed('advertise_local_ip_addrs')
 def advertise_local_ip_addrs(host_info):
     '''
     advertise_local_ip_addrs gets the local IP address information from
     the provided host_info map and sets the addresses in the guestinfo
-    namespace
+    namespace. A dictionary of the keys that could not be set, mapped to
+    the reason, is returned.
     '''
     if not host_info:
-        return
+        return {}
 
     # Reflect any possible local IPv4 or IPv6 addresses in the guest
-    # info.
-    local_ipv4 = host_info.get(LOCAL_IPV4)
-    if local_ipv4:
-        set_guestinfo_value(LOCAL_IPV4, local_ipv4)
-        LOG.info("advertised local ipv4 address %s in guestinfo", local_ipv4)
-
-    local_ipv6 = host_info.get(LOCAL_IPV6)
-    if local_ipv6:
-        set_guestinfo_value(LOCAL_IPV6, local_ipv6)
-        LOG.info("advertised local ipv6 address %s in guestinfo", local_ipv6)
+    # info. Addresses that are unchanged since they were last advertised
+    # are not written again.
+    writer = GuestInfoWriter()
+    for key in (LOCAL_IPV4, LOCAL_IPV6):
+        if host_info.get(key):
+            writer.set(key, host_info[key])
+    failures = writer.flush()
+    for key in (LOCAL_IPV4, LOCAL_IPV6):
+        if key in failures:
+            LOG.error("failed to advertise %s %s in guestinfo: %s",
+                      key, host_info[key], failures[key])
+        elif host_info.get(key):
+            LOG.info("advertised %s %s in guestinfo", key, host_info[key])
+    return failures
 
 
 def handle_returned_guestinfo_val(key, val):
@@ -314,33 +981,143 @@ def get_guestinfo_value(key):
     '''
     LOG.debug("Getting guestinfo value for key %s", key)
 
-    data_access_method = get_data_access_method()
+    transport = get_transport()
+    if not transport:
+        return None
+
+    try:
+        val = None
+        if transport.probed:
+            val = pop_probed_guestinfo_value(key)
+        if val is not None:
+            LOG.debug("Using the probed value for key %s", key)
+            TIMING.incr('probed_values')
+        else:
+            with TIMING.timer('get_guestinfo_value.' + key):
+                val = transport.get(key)
+        if val is not None:
+            TIMING.incr('bytes_fetched.' + key, len(val))
+            if isinstance(val, bytes):
+                val = val.decode('utf-8')
+            set_known_guestinfo_value(key, val.rstrip('\n'))
+            return handle_returned_guestinfo_val(key, val)
+    except Exception:
+        util.logexc(
+            LOG, "Unexpected error while trying to get guestinfo value for key %s", key)
+
+    return None
+
+
+_PROBE = None
+_PROBE_LOCK = threading.Lock()
+
+
+def pop_probed_guestinfo_value(key):
+    '''
+    pop_probed_guestinfo_value returns the raw value of guestinfo.<key> that
+    dscheck_VMwareGuestInfo recorded when ds-identify probed for the
+    datasource during this boot, or None if no value was recorded. Each
+    recorded value is returned at most once.
+    '''
+    global _PROBE
+    with _PROBE_LOCK:
+        if _PROBE is None:
+            _PROBE = load_guestinfo_probe(GUESTINFO_PROBE_DIR)
+        return _PROBE.pop(key, None)
 
-    if data_access_method == VMX_GUESTINFO:
-        env_key = ("vmx.guestinfo." + key).upper().replace(".", "_", -1)
-        return handle_returned_guestinfo_val(key, os.environ.get(env_key, ""))
 
-    if data_access_method == VMWARE_RPCTOOL:
+def load_guestinfo_probe(path):
+    '''
+    load_guestinfo_probe returns a dictionary of the raw guestinfo values
+    recorded in the directory path, keyed by guestinfo key. The recorded
+    values are removed, as they may be sensitive and are only valid until
+    the datasource writes to guestinfo.
+    '''
+    probe = {}
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return probe
+    for name in names:
+        file_path = os.path.join(path, name)
         try:
-            (stdout, stderr) = subp(
-                [VMWARE_RPCTOOL, "info-get guestinfo." + key])
-            if stderr == NOVAL:
-                LOG.debug("No value found for key %s", key)
-            elif not stdout:
-                LOG.error("Failed to get guestinfo value for key %s", key)
-            else:
-                return handle_returned_guestinfo_val(key, stdout)
-        except ProcessExecutionError as error:
-            if error.stderr == NOVAL:
-                LOG.debug("No value found for key %s", key)
-            else:
-                util.logexc(
-                    LOG, "Failed to get guestinfo value for key %s: %s", key, error)
-        except Exception:
-            util.logexc(
-                LOG, "Unexpected error while trying to get guestinfo value for key %s", key)
+            probe[name] = util.load_file(file_path)
+            os.unlink(file_path)
+        except (IOError, OSError) as error:
+            LOG.debug("failed to load probed guestinfo %s: %s", name, error)
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+    return probe
 
-    return None
+
+def get_guestinfo_values(keys):
+    '''
+    Returns a dictionary of the guestinfo values for the specified keys. The
+    keys are fetched concurrently when the transport supports it.
+    '''
+    transport = get_transport()
+    if transport and transport.concurrent:
+        vals = map_concurrently(get_guestinfo_value, keys)
+    else:
+        vals = [get_guestinfo_value(key) for key in keys]
+    return dict(zip(keys, vals))
+
+
+def iter_guestinfo_values(keys, max_workers=None):
+    '''
+    iter_guestinfo_values yields the guestinfo values for the specified keys
+    in order. The keys are fetched concurrently when the transport supports
+    it, with at most twice max_workers values fetched ahead of the one that
+    was last yielded.
+    '''
+    keys = list(keys)
+    transport = get_transport()
+    if not (transport and transport.concurrent) or len(keys) < 2:
+        for key in keys:
+            yield get_guestinfo_value(key)
+        return
+
+    max_workers = max_workers or _MAX_WORKERS
+    results = {}
+    state = {'next': 0, 'consumed': 0, 'closed': False}
+    cond = threading.Condition()
+    window = 2 * max_workers
+
+    def worker():
+        while True:
+            with cond:
+                while not state['closed'] and state['next'] < len(keys) and \
+                        state['next'] >= state['consumed'] + window:
+                    cond.wait()
+                if state['closed'] or state['next'] >= len(keys):
+                    return
+                index = state['next']
+                state['next'] += 1
+            val = get_guestinfo_value(keys[index])
+            with cond:
+                results[index] = val
+                cond.notify_all()
+
+    for _ in range(min(max_workers, len(keys))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for index in range(len(keys)):
+            with cond:
+                while index not in results:
+                    cond.wait()
+                val = results.pop(index)
+                state['consumed'] = index + 1
+                cond.notify_all()
+            yield val
+    finally:
+        with cond:
+            state['closed'] = True
+            cond.notify_all()
 
 
 def set_guestinfo_value(key, value):
@@ -348,33 +1125,109 @@ def set_guestinfo_value(key, value):
     Sets a guestinfo value for the specified key. Set value to an empty string
     to clear an existing guestinfo key.
     '''
+    writer = GuestInfoWriter()
+    writer.set(key, value)
+    error = writer.flush().get(key)
+    if error:
+        LOG.error(
+            "Failed to set guestinfo key=%s to value=%s: %s", key, value, error)
+        return None
+    return True
 
-    # If value is an empty string then set it to a single space as it is not
-    # possible to set a guestinfo key to an empty string. Setting a guestinfo
-    # key to a single space is as close as it gets to clearing an existing
-    # guestinfo key.
-    if value == "":
-        value = " "
 
-    LOG.debug("Setting guestinfo key=%s to value=%s", key, value)
+_GUESTINFO_KNOWN = {}
+_GUESTINFO_KNOWN_LOCK = threading.Lock()
 
-    data_access_method = get_data_access_method()
 
-    if data_access_method == VMX_GUESTINFO:
-        return True
+def get_known_guestinfo_value(key):
+    '''
+    get_known_guestinfo_value returns the raw value of guestinfo.<key> as
+    it was last read or written by this process, or None if it is unknown
+    '''
+    with _GUESTINFO_KNOWN_LOCK:
+        return _GUESTINFO_KNOWN.get(key)
 
-    if data_access_method == VMWARE_RPCTOOL:
-        try:
-            subp([VMWARE_RPCTOOL, ("info-set guestinfo.%s %s" % (key, value))])
-            return True
-        except ProcessExecutionError as error:
-            util.logexc(
-                LOG, "Failed to set guestinfo key=%s to value=%s: %s", key, value, error)
-        except Exception:
-            util.logexc(
-                LOG, "Unexpected error while trying to set guestinfo key=%s to value=%s", key, value)
 
-    return None
+def set_known_guestinfo_value(key, value):
+    '''
+    set_known_guestinfo_value records the raw value of guestinfo.<key> as
+    it was last read or written by this process. A value of None forgets
+    the key.
+    '''
+    with _GUESTINFO_KNOWN_LOCK:
+        if value is None:
+            _GUESTINFO_KNOWN.pop(key, None)
+        else:
+            _GUESTINFO_KNOWN[key] = value
+
+
+class GuestInfoWriter(object):
+    '''
+    GuestInfoWriter batches writes to guestinfo. A key that is set more
+    than once before the batch is flushed is only written with its last
+    value, and a key whose value is unchanged from the last value known to
+    be in guestinfo is not written at all.
+    '''
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+
+    def set(self, key, value):
+        # If value is an empty string then set it to a single space as it
+        # is not possible to set a guestinfo key to an empty string.
+        # Setting a guestinfo key to a single space is as close as it gets
+        # to clearing an existing guestinfo key.
+        if value == "":
+            value = " "
+        self.pending.pop(key, None)
+        self.pending[key] = value
+
+    def clear(self, key):
+        self.set(key, "")
+
+    def flush(self):
+        '''
+        flush writes the pending values and returns a dictionary of the keys
+        that could not be written, mapped to the reason. The values are
+        written concurrently or over a single session, depending on the
+        transport.
+        '''
+        pending, self.pending = self.pending, collections.OrderedDict()
+        items = []
+        for key, value in pending.items():
+            if get_known_guestinfo_value(key) == value:
+                LOG.debug("guestinfo.%s is unchanged", key)
+                TIMING.incr('guestinfo_writes_skipped')
+                continue
+            LOG.debug("Setting guestinfo key=%s to value=%s", key, value)
+            items.append((key, value))
+        if not items:
+            return {}
+
+        transport = get_transport()
+        if not transport:
+            return dict((key, "no transport is available") for key, _ in items)
+
+        with TIMING.timer('flush_guestinfo_writes'):
+            failures = transport.set_many(items)
+        for key, value in items:
+            pop_probed_guestinfo_value(key)
+            set_known_guestinfo_value(
+                key, None if key in failures else value)
+        TIMING.incr('guestinfo_writes', len(items) - len(failures))
+        return failures
+
+
+def publish_timing():
+    '''
+    publish_timing writes the datasource's timing record to guestinfo as
+    compact JSON so it may be collected from outside of the guest
+    '''
+    record = json.dumps(TIMING.to_dict(), separators=(',', ':'))
+    if set_guestinfo_value(GUESTINFO_TIMING, record):
+        LOG.info("published timing in guestinfo.%s", GUESTINFO_TIMING)
+    else:
+        LOG.error("failed to publish timing in guestinfo.%s", GUESTINFO_TIMING)
 
 
 def clear_guestinfo_keys(keys):
@@ -382,18 +1235,49 @@ def clear_guestinfo_keys(keys):
     clear_guestinfo_keys clears guestinfo of all of the keys in the given list.
     each key will have its value set to "---". Since the value is valid YAML,
     cloud-init can still read it if it tries.
+
+    The keys are cleared in a single batch, and a dictionary of the keys
+    that could not be cleared, mapped to the reason, is returned. A key's
+    ref and parts are only cleared if they had a value when they were last
+    read, as they are only read when they are used, so clearing a key reads
+    nothing from guestinfo.
     '''
     if not keys:
-        return
+        return {}
     if not type(keys) in (list, tuple):
         keys = [keys]
+    writer = GuestInfoWriter()
     for key in keys:
         LOG.info("clearing guestinfo.%s", key)
-        if not set_guestinfo_value(key, GUESTINFO_EMPTY_YAML_VAL):
-            LOG.error("failed to clear guestinfo.%s", key)
-        LOG.info("clearing guestinfo.%s.encoding", key)
-        if not set_guestinfo_value(key + ".encoding", ""):
-            LOG.error("failed to clear guestinfo.%s.encoding", key)
+        writer.set(key, GUESTINFO_EMPTY_YAML_VAL)
+        writer.clear(key + ".encoding")
+        ref = get_known_guestinfo_value(key + ".ref")
+        if ref and get_none_if_empty_val(ref):
+            writer.clear(key + ".ref")
+        clear_guestinfo_parts(key, writer)
+    failures = writer.flush()
+    for key, error in failures.items():
+        LOG.error("failed to clear guestinfo.%s: %s", key, error)
+    return failures
+
+
+def clear_guestinfo_parts(key, writer):
+    '''
+    clear_guestinfo_parts adds clearing the parts of key to writer if its
+    value was split across several keys when its parts count was last read,
+    along with its parts count, digest, and signature
+    '''
+    try:
+        count = get_guestinfo_parts_count(
+            key, get_known_guestinfo_value(key + '.parts'))
+    except DecodeError:
+        count = 0
+    for i in range(count):
+        writer.clear('%s.%d' % (key, i))
+    if count:
+        writer.clear(key + '.parts')
+        writer.clear(key + '.digest')
+        writer.clear(key + '.signature')
 
 
 def guestinfo(key):
@@ -401,173 +1285,949 @@ def guestinfo(key):
     guestinfo returns the guestinfo value for the provided key, decoding
     the value when required
     '''
-    data = get_guestinfo_value(key)
-    if not data:
-        return None
-    enc_type = get_guestinfo_value(key + '.encoding')
-    return decode('guestinfo.' + key, enc_type, data)
+    return guestinfo_many([key])[key]
 
 
-def load(data):
+def guestinfo_many(keys, cache=None, raw_keys=(), errors=None):
     '''
-    load first attempts to unmarshal the provided data as JSON, and if
-    that fails then attempts to unmarshal the data as YAML. If data is
-    None then a new dictionary is returned.
+    guestinfo_many returns a dictionary of the guestinfo values for the
+    provided keys, decoding the values when required. The values and their
+    encodings are all fetched in a single pass, along with the values of
+    raw_keys, which are returned as is.
+
+    The values are decoded as soon as they are fetched. When there is more
+    than one key, each value is decoded on its own thread while the next
+    one is fetched, with at most _DECODE_WORKERS values decoded at once.
+
+    If cache is a dictionary, it maps each key to the digest of its raw
+    value and encoding along with the decoded value. Values whose digests
+    are unchanged are not decoded again, and the cache is updated in place.
+
+    The number of parts, <key>.parts, is only fetched when the value of key
+    is empty. See decode_guestinfo.
+
+    A value is verified with decode_guestinfo against <key>.digest if it is
+    set. If a signing key is configured, the value must be signed, and
+    <key>.signature is only fetched in that case. DecodeError is raised if
+    verification fails.
+
+    If a local content store exists, <key>.ref is fetched instead of the
+    value, which is only fetched if it is not found in the store. See
+    resolve_guestinfo.
+
+    If errors is a dictionary, an error raised while a value is resolved is
+    saved in it under the value's key and the value is None, so the other
+    values are still returned.
     '''
-    if not data:
-        return {}
+    def resolve(*args):
+        if errors is None:
+            return resolve_guestinfo(*args)
+        try:
+            return resolve_guestinfo(*args)
+        except Exception as error:
+            errors[args[0]] = error
+            return None
+
+    stores = get_guestinfo_stores()
+    signed = read_signing_key() is not None
+    first_suffix = '.ref' if stores else ''
+    lookup_keys = list(raw_keys)
+    for key in keys:
+        lookup_keys.append(key + first_suffix)
+        lookup_keys.append(key + '.encoding')
+        lookup_keys.append(key + '.digest')
+        if signed:
+            lookup_keys.append(key + '.signature')
+
+    result = {}
+    pending = collections.deque()
+    vals = iter_guestinfo_values(lookup_keys)
     try:
-        return json.loads(data)
-    except:
-        return safeyaml.load(data)
+        for key in raw_keys:
+            result[key] = next(vals)
+        for key in keys:
+            if stores:
+                data, ref = _NOT_FETCHED, next(vals)
+            else:
+                data, ref = next(vals), None
+            args = (key, data, next(vals), _NOT_FETCHED, next(vals),
+                    next(vals) if signed else None, ref, stores, cache)
+            if len(keys) < 2 or _DECODE_WORKERS < 2:
+                result[key] = resolve(*args)
+                continue
+            if len(pending) >= _DECODE_WORKERS:
+                done_key, call = pending.popleft()
+                result[done_key] = call.result()
+            pending.append((key, BackgroundCall(resolve, *args)))
+    finally:
+        vals.close()
+    for key, call in pending:
+        result[key] = call.result()
+    return result
+
+
+# _NOT_FETCHED is passed to resolve_guestinfo in place of a value that
+# guestinfo_many did not fetch.
+_NOT_FETCHED = object()
+
+
+def resolve_guestinfo(key, data, enc_type, parts, digest, signature,
+                      ref=None, stores=(), cache=None):
+    '''
+    resolve_guestinfo returns the decoded value of key given its raw value,
+    encoding, number of parts, digest, signature, and ref. If cache is a
+    dictionary it is used and updated the same way as by guestinfo_many.
+
+    If ref is set, the value is read from the local content stores with
+    guestinfo_ref. Otherwise, or if the stores do not hold the value, the
+    raw value is fetched if data is _NOT_FETCHED and is decoded with
+    decode_guestinfo. A value that is fetched in place of a ref must match
+    the ref once it is decoded. Either way, the value is normalized with
+    normalize_ref_text, which the ref is the digest of.
+    '''
+    signing_key = read_signing_key()
+    fingerprint = get_signing_key_fingerprint(signing_key)
+    if ref:
+        ref_digest = parse_guestinfo_ref(key, ref)
+        value = guestinfo_ref(
+            key, ref, ref_digest, stores, signature, signing_key, cache)
+        if value is not None:
+            return value
+        LOG.debug("guestinfo.%s.ref %s is not stored locally", key, ref)
+        TIMING.incr('guestinfo_store_misses')
+        # The signature, if any, covers the ref and was already verified.
+        signature = signing_key = None
+
+    if data is _NOT_FETCHED:
+        data = get_guestinfo_value(key)
+    value = decode_guestinfo(
+        key, data, enc_type, parts, digest, signature, signing_key,
+        None if ref else cache)
+    if ref:
+        if value is None:
+            raise DecodeError(
+                "guestinfo.%s.ref %s is not stored locally and "
+                "guestinfo.%s is empty" % (key, ref, key))
+        value = normalize_ref_text(value)
+        if get_text_digest(value) != ref_digest:
+            raise DecodeError(
+                "guestinfo.%s does not match its ref %s" % (key, ref))
+        if cache is not None:
+            cache[key] = {
+                'digest': get_guestinfo_ref_digest(ref_digest),
+                'value': value,
+                'signed': fingerprint,
+            }
+    return value
 
 
-def load_metadata():
+def decode_guestinfo(key, data, enc_type, parts, digest, signature,
+                     signing_key=None, cache=None):
     '''
-    load_metadata loads the metadata from the guestinfo data, optionally
-    decoding the network config when required
+    decode_guestinfo returns the decoded value of key given its raw value,
+    encoding, number of parts, digest, signature, and the signing key, if
+    one is configured. If cache is a dictionary it is used and updated the
+    same way as by guestinfo_many.
+
+    If the digest or the signature is set, or a signing key is configured,
+    the value is verified with verify_guestinfo. The SHA-256 digest of the
+    raw value is computed while it is decoded, and the cache records the
+    digest once it is verified. A value that is unchanged since it was
+    verified is neither verified nor decoded again.
+
+    If parts is _NOT_FETCHED, <key>.parts is fetched only if data is empty,
+    since a value that is set is never split.
     '''
-    data = load(guestinfo('metadata'))
-    LOG.debug('loaded metadata %s', data)
+    if parts is _NOT_FETCHED:
+        parts = None if data else get_guestinfo_value(key + '.parts')
+    count = get_guestinfo_parts_count(key, parts)
+    if count:
+        return guestinfo_parts(
+            key, count, enc_type, digest, signature, signing_key, cache)
+    if not data:
+        if cache is not None:
+            cache[key] = {'digest': None, 'value': None}
+        return None
 
-    network = None
-    if 'network' in data:
-        network = data['network']
-        del data['network']
+    if not (digest or signature or signing_key):
+        raw_digest = None
+        if cache is not None:
+            raw_digest = get_guestinfo_digest(enc_type, data)
+            entry = cache.get(key)
+            if entry and entry.get('digest') == raw_digest:
+                LOG.debug("Using cached value for key %s", key)
+                return entry['value']
+        value = decode('guestinfo.' + key, enc_type, data)
+        if cache is not None:
+            cache[key] = {'digest': raw_digest, 'value': value}
+        return value
+
+    # Without a digest, an unchanged value is only detected by hashing it
+    # first, which is still cheaper than verifying and decoding it again.
+    fingerprint = get_signing_key_fingerprint(signing_key)
+    entry = cache.get(key) if cache is not None else None
+    raw_digest = None
+    if entry and not digest:
+        raw_digest = get_text_digest(data)
+    if entry and entry.get('signed') == fingerprint and \
+            entry.get('digest') == get_guestinfo_verified_digest(
+                enc_type, digest or raw_digest):
+        LOG.debug("Using cached value for key %s", key)
+        TIMING.incr('verified_values_cached')
+        return entry['value']
+
+    if raw_digest:
+        value = decode('guestinfo.' + key, enc_type, data)
+    else:
+        sha256 = hashlib.sha256()
+        value = decode('guestinfo.' + key, enc_type, data, sha256)
+        raw_digest = sha256.hexdigest()
+    verify_guestinfo(key, raw_digest, digest, signature, signing_key)
+    if cache is not None:
+        cache[key] = {
+            'digest': get_guestinfo_verified_digest(enc_type, raw_digest),
+            'value': value,
+            'signed': fingerprint,
+        }
+    return value
+
+
+def get_guestinfo_parts_count(key, val):
+    '''
+    get_guestinfo_parts_count returns the number of parts that the value of
+    key is split across, or zero if the value is not split
+    '''
+    if not val:
+        return 0
+    try:
+        count = int(val)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise DecodeError("invalid guestinfo.%s.parts: %s" % (key, val))
+    return count
 
-    network_enc = None
-    if 'network.encoding' in data:
-        network_enc = data['network.encoding']
-        del data['network.encoding']
 
-    if network:
-        LOG.debug('network data found')
-        if isinstance(network, collections.Mapping):
-            LOG.debug("network data copied to 'config' key")
-            network = {
-                'config': copy.deepcopy(network)
-            }
-        else:
-            LOG.debug("network data to be decoded %s", network)
-            dec_net = decode('metadata.network', network_enc, network)
-            network = {
-                'config': load(dec_net),
-            }
+def guestinfo_parts(key, count, enc_type, digest=None, signature=None,
+                    signing_key=None, cache=None):
+    '''
+    guestinfo_parts returns the decoded value of key when it is split across
+    count parts. If cache is a dictionary it is used and updated the same
+    way as by guestinfo_many. When digest is set, an unchanged value is
+    reused from the cache without fetching its parts at all.
+    '''
+    fingerprint = get_signing_key_fingerprint(signing_key)
+    entry = cache.get(key) if cache is not None else None
+    if digest and entry and entry.get('signed') == fingerprint and \
+            entry.get('digest') == get_guestinfo_parts_digest(
+                enc_type, count, digest):
+        LOG.debug("Using cached value for key %s", key)
+        return entry['value']
+
+    value, raw_digest = get_guestinfo_parts(
+        key, count, enc_type, digest, signature, signing_key)
+    if cache is not None:
+        cache[key] = {
+            'digest': get_guestinfo_parts_digest(enc_type, count, raw_digest),
+            'value': value,
+            'signed': fingerprint,
+        }
+    return value
+
+
+def get_guestinfo_parts(key, count, enc_type, digest=None, signature=None,
+                        signing_key=None):
+    '''
+    get_guestinfo_parts returns the decoded value of a payload split across
+    the keys <key>.0 through <key>.<count - 1>, along with the SHA-256 hex
+    digest of the concatenated raw parts. The parts are fetched
+    concurrently and decoded in order as they arrive, and the concatenated
+    parts are then verified with verify_guestinfo.
+    '''
+    LOG.debug("Getting %d parts for key=%s, enc=%s", count, key, enc_type)
+
+    part_keys = ['%s.%d' % (key, i) for i in range(count)]
+    decoder = StreamDecoder('guestinfo.' + key, enc_type)
+    sha256 = hashlib.sha256()
+    with TIMING.timer('get_guestinfo_parts.' + key):
+        parts = iter_guestinfo_values(part_keys)
+        try:
+            for part_key, part in zip(part_keys, parts):
+                if part is None:
+                    raise DecodeError(
+                        "guestinfo.%s is missing or empty" % part_key)
+                if not isinstance(part, bytes):
+                    part = part.encode('utf-8')
+                sha256.update(part)
+                decoder.update(part)
+        finally:
+            parts.close()
+        value = decoder.finish()
+
+    raw_digest = sha256.hexdigest()
+    verify_guestinfo(key, raw_digest, digest, signature, signing_key)
+    return value.decode('utf-8'), raw_digest
+
+
+def get_guestinfo_parts_digest(enc_type, count, digest):
+    '''
+    get_guestinfo_parts_digest returns the digest that a value split across
+    count parts is cached under, given the digest of its raw parts
+    '''
+    return get_guestinfo_digest(
+        '%s\nparts=%d' % (enc_type or '', count), normalize_digest(digest))
 
-        LOG.debug('network data %s', network)
-        data['network'] = network
 
-    return data
+def normalize_digest(digest):
+    '''
+    normalize_digest returns a SHA-256 hex digest in lower case and without
+    the optional "sha256:" prefix
+    '''
+    digest = digest.strip().lower()
+    if digest.startswith('sha256:'):
+        digest = digest[len('sha256:'):]
+    return digest
 
 
-def get_datasource_list(depends):
+def get_guestinfo_verified_digest(enc_type, digest):
     '''
-    Return a list of data sources that match this set of dependencies
+    get_guestinfo_verified_digest returns the digest that a verified value
+    is cached under, given the digest of its raw value
     '''
-    return [DataSourceVMwareGuestInfo]
+    return get_guestinfo_digest(
+        '%s\nsha256' % (enc_type or ''), normalize_digest(digest))
+
 
+_SIGNING_KEY_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_SIGNING_KEY'
+GUESTINFO_SIGNING_KEY_FILE = '/etc/cloud/vmware-guestinfo-signing-key.pem'
+OPENSSL = 'openssl'
 
-def get_default_ip_addrs():
+
+def read_signing_key():
     '''
-    Returns the default IPv4 and IPv6 addresses based on the device(s) used for
-    the default route. Please note that None may be returned for either address
-    family if that family has no default route or if there are multiple
-    addresses associated with the device used by the default route for a given
-    address.
+    read_signing_key returns the PEM public key that guestinfo values must
+    be signed with, or None if no key is configured. The key is read from
+    /etc/cloud/vmware-guestinfo-signing-key.pem, or from the file named by
+    the environment variable CLOUD_INIT_VMWARE_GUEST_INFO_SIGNING_KEY.
     '''
-    gateways = netifaces.gateways()
-    if 'default' not in gateways:
-        return None, None
+    path = os.getenv(_SIGNING_KEY_ENV_VAR) or GUESTINFO_SIGNING_KEY_FILE
+    try:
+        with open(path, 'rb') as f:
+            return f.read() or None
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        raise DecodeError("failed to read signing key %s: %s" % (path, error))
 
-    default_gw = gateways['default']
-    if netifaces.AF_INET not in default_gw and netifaces.AF_INET6 not in default_gw:
-        return None, None
 
-    ipv4 = None
-    ipv6 = None
+def get_signing_key_fingerprint(signing_key):
+    '''
+    get_signing_key_fingerprint returns the SHA-256 hex digest of the
+    signing key, or None if signing_key is None
+    '''
+    if not signing_key:
+        return None
+    return hashlib.sha256(signing_key).hexdigest()
 
-    gw4 = default_gw.get(netifaces.AF_INET)
-    if gw4:
-        _, dev4 = gw4
-        addr4_fams = netifaces.ifaddresses(dev4)
-        if addr4_fams:
-            af_inet4 = addr4_fams.get(netifaces.AF_INET)
-            if af_inet4:
-                if len(af_inet4) > 1:
-                    LOG.warn(
-                        "device %s has more than one ipv4 address: %s", dev4, af_inet4)
-                elif 'addr' in af_inet4[0]:
-                    ipv4 = af_inet4[0]['addr']
 
-    # Try to get the default IPv6 address by first seeing if there is a default
-    # IPv6 route.
-    gw6 = default_gw.get(netifaces.AF_INET6)
-    if gw6:
-        _, dev6 = gw6
-        addr6_fams = netifaces.ifaddresses(dev6)
-        if addr6_fams:
-            af_inet6 = addr6_fams.get(netifaces.AF_INET6)
-            if af_inet6:
-                if len(af_inet6) > 1:
-                    LOG.warn(
-                        "device %s has more than one ipv6 address: %s", dev6, af_inet6)
-                elif 'addr' in af_inet6[0]:
-                    ipv6 = af_inet6[0]['addr']
+def verify_guestinfo(key, raw_digest, digest=None, signature=None,
+                     signing_key=None):
+    '''
+    verify_guestinfo raises DecodeError unless raw_digest, the SHA-256 hex
+    digest of the raw value of key, matches digest if it is set, and, if
+    signing_key is set, signature is a valid base64 signature of the raw
+    value made with the private half of signing_key. The raw value is the
+    value as it is fetched, which is without its trailing whitespace.
+
+    Only the digest is passed to openssl, so the raw value is not read
+    again. The signature is the same as the one produced by
+    "openssl dgst -sha256 -sign", so RSA and ECDSA keys are supported.
+    '''
+    if digest and normalize_digest(digest) != raw_digest:
+        raise DecodeError(
+            "guestinfo.%s does not match its digest %s" % (key, digest))
+    if not signing_key:
+        if signature:
+            LOG.warning("ignoring guestinfo.%s.signature as no signing key "
+                        "is configured", key)
+        return
+    if not signature:
+        raise DecodeError("guestinfo.%s is not signed" % key)
 
-    # If there is a default IPv4 address but not IPv6, then see if there is a
-    # single IPv6 address associated with the same device associated with the
-    # default IPv4 address.
-    if ipv4 and not ipv6:
-        af_inet6 = addr4_fams.get(netifaces.AF_INET6)
-        if af_inet6:
-            if len(af_inet6) > 1:
-                LOG.warn(
-                    "device %s has more than one ipv6 address: %s", dev4, af_inet6)
-            elif 'addr' in af_inet6[0]:
-                ipv6 = af_inet6[0]['addr']
+    try:
+        sig = binascii.a2b_base64(signature)
+    except (binascii.Error, TypeError) as error:
+        raise DecodeError(
+            "failed to decode guestinfo.%s.signature as base64: %s" %
+            (key, error))
+
+    import tempfile
+    with TIMING.timer('verify_guestinfo.' + key):
+        with tempfile.NamedTemporaryFile() as key_file, \
+                tempfile.NamedTemporaryFile() as sig_file:
+            key_file.write(signing_key)
+            key_file.flush()
+            sig_file.write(sig)
+            sig_file.flush()
+            try:
+                TIMING.incr('subprocesses')
+                subp([OPENSSL, 'pkeyutl', '-verify', '-pubin',
+                      '-inkey', key_file.name, '-sigfile', sig_file.name,
+                      '-pkeyopt', 'digest:sha256'],
+                     data=binascii.unhexlify(raw_digest))
+            except ProcessExecutionError as error:
+                raise DecodeError(
+                    "guestinfo.%s has an invalid signature: %s" %
+                    (key, (error.stdout or error.stderr or '').strip()))
+    LOG.debug("verified the signature of guestinfo.%s", key)
+
+
+_STORE_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_STORE'
+GUESTINFO_STORE_DIR = '/var/lib/cloud/vmware-guestinfo-store'
+
+
+def get_guestinfo_stores():
+    '''
+    get_guestinfo_stores returns the list of the local content stores that
+    exist. The store is /var/lib/cloud/vmware-guestinfo-store unless the
+    environment variable CLOUD_INIT_VMWARE_GUEST_INFO_STORE names one or
+    more directories, separated by colons.
+    '''
+    val = os.getenv(_STORE_ENV_VAR)
+    paths = val.split(os.pathsep) if val else [GUESTINFO_STORE_DIR]
+    return [path for path in paths if path and os.path.isdir(path)]
 
-    # If there is a default IPv6 address but not IPv4, then see if there is a
-    # single IPv4 address associated with the same device associated with the
-    # default IPv6 address.
-    if not ipv4 and ipv6:
-        af_inet4 = addr6_fams.get(netifaces.AF_INET)
-        if af_inet4:
-            if len(af_inet4) > 1:
-                LOG.warn(
-                    "device %s has more than one ipv4 address: %s", dev6, af_inet4)
-            elif 'addr' in af_inet4[0]:
-                ipv4 = af_inet4[0]['addr']
 
-    return ipv4, ipv6
+def parse_guestinfo_ref(key, ref):
+    '''
+    parse_guestinfo_ref returns the SHA-256 hex digest from the value of
+    <key>.ref, which must be "sha256:" followed by the digest
+    '''
+    digest = ref.strip().lower()
+    if not digest.startswith('sha256:'):
+        raise DecodeError("unsupported guestinfo.%s.ref: %s" % (key, ref))
+    digest = normalize_digest(digest)
+    if len(digest) != 64 or not all(c in string.hexdigits for c in digest):
+        raise DecodeError("invalid guestinfo.%s.ref: %s" % (key, ref))
+    return digest
 
-# patched socket.getfqdn() - see https://bugs.python.org/issue5004
 
+def guestinfo_ref(key, ref, ref_digest, stores, signature=None,
+                  signing_key=None, cache=None):
+    '''
+    guestinfo_ref returns the value of key that ref, the value of <key>.ref,
+    refers to, or None if none of the stores hold it. If signing_key is set,
+    signature must be a valid signature of ref. If cache is a dictionary
+    it is used and updated the same way as by guestinfo_many, and a value
+    whose ref is unchanged is reused without being read or verified again.
+    '''
+    fingerprint = get_signing_key_fingerprint(signing_key)
+    entry = cache.get(key) if cache is not None else None
+    if entry and entry.get('signed') == fingerprint and \
+            entry.get('digest') == get_guestinfo_ref_digest(ref_digest):
+        LOG.debug("Using cached value for key %s", key)
+        return entry['value']
+
+    if signing_key:
+        verify_guestinfo(
+            key + '.ref', get_text_digest(ref), None, signature, signing_key)
+    value = read_guestinfo_store(ref_digest, stores)
+    if value is not None and cache is not None:
+        cache[key] = {
+            'digest': get_guestinfo_ref_digest(ref_digest),
+            'value': value,
+            'signed': fingerprint,
+        }
+    return value
+
+
+def read_guestinfo_store(digest, stores):
+    '''
+    read_guestinfo_store returns the document whose SHA-256 hex digest is
+    digest from the first of the stores that holds it, or None. Each store
+    holds documents in files named sha256/<digest>, and a file that does
+    not match its name once it is normalized with normalize_ref_text is
+    ignored.
+    '''
+    for store in stores:
+        path = os.path.join(store, 'sha256', digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                LOG.warning("failed to read %s: %s", path, error)
+            continue
+        try:
+            text = normalize_ref_text(data.decode('utf-8'))
+        except UnicodeDecodeError:
+            text = None
+        if text is None or get_text_digest(text) != digest:
+            LOG.warning("ignoring %s as it does not match its digest", path)
+            continue
+        LOG.debug("read %s", path)
+        TIMING.incr('guestinfo_store_hits')
+        return text
+    return None
 
-def getfqdn(name=''):
-    """Get fully qualified domain name from name.
+
+def normalize_ref_text(text):
+    '''
+    normalize_ref_text returns text without its trailing whitespace. A ref
+    is the digest of the normalized text, as plain guestinfo values have
+    their trailing whitespace stripped when they are fetched.
+    '''
+    return text.rstrip()
+
+
+def get_guestinfo_ref_digest(digest):
+    '''
+    get_guestinfo_ref_digest returns the digest that a value resolved from
+    a ref is cached under, given the digest from the ref
+    '''
+    return get_guestinfo_digest('\nref', digest)
+
+
+def get_text_digest(text):
+    '''
+    get_text_digest returns the SHA-256 hex digest of text encoded as UTF-8
+    '''
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha256(text).hexdigest()
+
+
+def get_guestinfo_digest(enc_type, data):
+    '''
+    get_guestinfo_digest returns the SHA-256 hex digest of a raw guestinfo
+    value and its encoding
+    '''
+    digest = hashlib.sha256()
+    for part in (enc_type or '', '\n', data):
+        if not isinstance(part, bytes):
+            part = part.encode('utf-8')
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def load(data, fmt=None):
+    '''
+    load unmarshals the provided data as JSON or YAML. If fmt is "yaml"
+    then the data is parsed as YAML only. Otherwise the data is parsed as
+    JSON if fmt is "json" or the data looks like JSON, falling back to
+    YAML if that fails. If data is None then a new dictionary is returned.
+    '''
+    if not data:
+        return {}
+    if fmt is None:
+        fmt = sniff_format(data)
+    elif fmt not in (FORMAT_JSON, FORMAT_YAML):
+        LOG.warning("unknown format %s, detecting format instead", fmt)
+        fmt = sniff_format(data)
+    if fmt == FORMAT_JSON:
+        try:
+            return json.loads(data)
+        except ValueError:
+            LOG.debug("data is not JSON, loading as YAML")
+    return load_yaml(data)
+
+
+def sniff_format(data):
+    '''
+    sniff_format returns "json" if the data begins with a JSON object or
+    array, otherwise "yaml"
+    '''
+    for char in data[:1024]:
+        if char in ' \t\r\n':
+            continue
+        if char in '{[':
+            return FORMAT_JSON
+        break
+    return FORMAT_YAML
+
+
+_YAML_LOADER = None
+
+
+def get_yaml_loader():
+    '''
+    get_yaml_loader returns a safe YAML loader backed by libyaml, or None
+    if PyYAML was built without libyaml. Like the loader used by
+    cloud-init's safeyaml module, the loader accepts python/unicode tags.
+    '''
+    global _YAML_LOADER
+    if _YAML_LOADER is None:
+        _YAML_LOADER = False
+        try:
+            import yaml
+            if hasattr(yaml, 'CSafeLoader'):
+                class CustomCSafeLoader(yaml.CSafeLoader):
+                    def construct_python_unicode(self, node):
+                        return self.construct_scalar(node)
+
+                CustomCSafeLoader.add_constructor(
+                    u'tag:yaml.org,2002:python/unicode',
+                    CustomCSafeLoader.construct_python_unicode)
+                _YAML_LOADER = CustomCSafeLoader
+        except ImportError:
+            pass
+    return _YAML_LOADER or None
+
+
+def load_yaml(data):
+    '''
+    load_yaml unmarshals the provided data as YAML, using libyaml when it
+    is available
+    '''
+    loader = get_yaml_loader()
+    if loader:
+        import yaml
+        return yaml.load(data, Loader=loader)
+    return safeyaml.load(data)
+
+
+@timed('load_metadata')
+def load_metadata(values=None, network_cache=None):
+    '''
+    load_metadata loads the metadata from the guestinfo data, optionally
+    decoding the network config when required. The values argument may be
+    the result of guestinfo_many when the metadata was already fetched, and
+    network_cache is passed to load_network_config. An invalid network
+    config is logged and omitted, so the fallback config is used instead.
+    '''
+    if values is None:
+        values = guestinfo_many(
+            ['metadata'], raw_keys=[GUESTINFO_METADATA_FORMAT])
+    data = load(values['metadata'], values.get(GUESTINFO_METADATA_FORMAT))
+    LOG.debug('loaded metadata %s', data)
+
+    network = None
+    if 'network' in data:
+        network = data['network']
+        del data['network']
+
+    network_enc = None
+    if 'network.encoding' in data:
+        network_enc = data['network.encoding']
+        del data['network.encoding']
+
+    if network:
+        LOG.debug('network data found')
+        try:
+            network = {
+                'config': load_network_config(
+                    network, network_enc, network_cache),
+            }
+        except NetworkConfigError as error:
+            LOG.error("ignoring invalid network config: %s", error)
+        else:
+            LOG.debug('network data %s', network)
+            data['network'] = network
+
+    return data
+
+
+def load_network_config(network, network_enc=None, cache=None):
+    '''
+    load_network_config returns the validated network config from the
+    metadata key "network", decoding and parsing the value first if it is
+    a string. NetworkConfigError is raised if the config is invalid.
+
+    If cache is a dictionary, it holds the digest of the last string that
+    was loaded along with the resulting config. A string whose digest is
+    unchanged is not decoded, parsed, or validated again, and the cache is
+    updated in place.
+    '''
+    if isinstance(network, Mapping):
+        network = unwrap_network_config(network)
+        validate_network_config(network)
+        return network
+
+    digest = None
+    if cache is not None:
+        digest = get_guestinfo_digest(network_enc, network)
+        if cache.get('digest') == digest:
+            LOG.debug("network config is unchanged")
+            return cache['config']
+
+    LOG.debug("network data to be decoded %s", network)
+    try:
+        config = load(decode('metadata.network', network_enc, network))
+    except Exception as error:
+        raise NetworkConfigError("failed to load network config: %s" % error)
+    config = unwrap_network_config(config)
+    validate_network_config(config)
+    if cache is not None:
+        cache.clear()
+        cache['digest'] = digest
+        cache['config'] = config
+    return config
+
+
+def unwrap_network_config(config):
+    '''
+    unwrap_network_config returns the document under the top-level key
+    "network" when config is wrapped in one, as cloud-init accepts both
+    "network: {version: 2, ...}" and "{version: 2, ...}"
+    '''
+    if isinstance(config, Mapping) and 'version' not in config and \
+            isinstance(config.get('network'), Mapping):
+        return config['network']
+    return config
+
+
+def validate_network_config(config):
+    '''
+    validate_network_config raises NetworkConfigError if config is not a
+    Network Config Version 1 or 2 document. A config that disables
+    networking, "{config: disabled}", is valid as cloudinit.net's
+    is_disabled_cfg checks for it before the version is considered.
+    '''
+    if not isinstance(config, Mapping):
+        raise NetworkConfigError(
+            "network config must be a mapping, not %s" % type(config).__name__)
+    if config.get('config') == 'disabled':
+        return
+    version = config.get('version')
+    if version == 1:
+        items = config.get('config')
+        if not isinstance(items, list):
+            raise NetworkConfigError(
+                "network config version 1 requires a list named config")
+        for i, item in enumerate(items):
+            if not isinstance(item, Mapping) or not item.get('type'):
+                raise NetworkConfigError(
+                    "network config version 1 item %d has no type" % i)
+    elif version == 2:
+        for key, val in config.items():
+            if key in ('version', 'renderer'):
+                continue
+            if not isinstance(val, Mapping):
+                raise NetworkConfigError(
+                    "network config version 2 key %s must be a mapping" % key)
+    else:
+        raise NetworkConfigError(
+            "unsupported network config version: %r" % (version,))
+
+
+def get_product_uuid():
+    '''
+    get_product_uuid returns the VM's BIOS UUID in lower case
+    '''
+    with open(PRODUCT_UUID_FILE, 'r') as id_file:
+        return str(id_file.read()).rstrip().lower()
+
+
+def read_product_uuid():
+    '''
+    read_product_uuid returns the VM's BIOS UUID in lower case, or None if
+    it cannot be read
+    '''
+    try:
+        return get_product_uuid()
+    except (IOError, OSError):
+        return None
+
+
+def get_metadata_instance_id(metadata):
+    '''
+    get_metadata_instance_id returns the instance ID the datasource would
+    report for the provided metadata, or None if it cannot be determined
+    '''
+    if metadata and 'instance-id' in metadata:
+        return metadata['instance-id']
+    return read_product_uuid()
+
+
+def get_datasource_list(depends):
+    '''
+    Return a list of data sources that match this set of dependencies
+    '''
+    return [DataSourceVMwareGuestInfo]
+
+
+def get_default_ip_addrs(snapshot=None):
+    '''
+    Returns the default IPv4 and IPv6 addresses based on the device(s) used for
+    the default route. Please note that None may be returned for either address
+    family if that family has no default route or if there are multiple
+    addresses associated with the device used by the default route for a given
+    address.
+
+    The addresses are read from the provided interface snapshot, or from a
+    new snapshot if none is provided.
+    '''
+    import netifaces
+    gateways = netifaces.gateways()
+    if 'default' not in gateways:
+        return None, None
+
+    default_gw = gateways['default']
+    if netifaces.AF_INET not in default_gw and netifaces.AF_INET6 not in default_gw:
+        return None, None
+
+    if snapshot is None:
+        snapshot = get_interface_snapshot()
+
+    ipv4 = None
+    ipv6 = None
+    iface4 = None
+    iface6 = None
+
+    gw4 = default_gw.get(netifaces.AF_INET)
+    if gw4:
+        _, dev4 = gw4
+        iface4 = snapshot.get(dev4)
+        if iface4:
+            ipv4 = get_single_addr(dev4, 'ipv4', iface4.inet4)
+
+    # Try to get the default IPv6 address by first seeing if there is a default
+    # IPv6 route.
+    gw6 = default_gw.get(netifaces.AF_INET6)
+    if gw6:
+        _, dev6 = gw6
+        iface6 = snapshot.get(dev6)
+        if iface6:
+            ipv6 = get_single_addr(dev6, 'ipv6', iface6.inet6)
+
+    # If there is a default IPv4 address but not IPv6, then see if there is a
+    # single IPv6 address associated with the same device associated with the
+    # default IPv4 address.
+    if ipv4 and not ipv6:
+        ipv6 = get_single_addr(dev4, 'ipv6', iface4.inet6)
+
+    # If there is a default IPv6 address but not IPv4, then see if there is a
+    # single IPv4 address associated with the same device associated with the
+    # default IPv6 address.
+    if not ipv4 and ipv6:
+        ipv4 = get_single_addr(dev6, 'ipv4', iface6.inet4)
+
+    return ipv4, ipv6
+
+
+def get_single_addr(dev_name, family_name, addrs):
+    '''
+    get_single_addr returns the address from addrs, a list of netifaces
+    address dictionaries, if the list has exactly one element. Otherwise
+    None is returned.
+    '''
+    if not addrs:
+        return None
+    if len(addrs) > 1:
+        LOG.warn("device %s has more than one %s address: %s",
+                 dev_name, family_name, addrs)
+        return None
+    return addrs[0].get('addr')
+
+
+_FQDN_CACHE = {}
+_FQDN_PENDING = {}
+_FQDN_LOCK = threading.Lock()
+
+# patched socket.getfqdn() - see https://bugs.python.org/issue5004
+
+
+def getfqdn(name='', timeout=None):
+    """Get fully qualified domain name from name.
      An empty argument is interpreted as meaning the local host.
+
+     The name is resolved on a worker thread, and if timeout is not None
+     then at most timeout seconds are spent waiting on it, after which the
+     name is returned as is. A resolution that completes is cached, and a
+     resolution still in progress is shared with subsequent calls.
     """
     name = name.strip()
     if not name or name == '0.0.0.0':
         name = socket.gethostname()
+
+    with _FQDN_LOCK:
+        if name in _FQDN_CACHE:
+            return _FQDN_CACHE[name]
+        thread = _FQDN_PENDING.get(name)
+        if thread is None:
+            thread = threading.Thread(target=resolve_fqdn, args=(name,))
+            thread.daemon = True
+            _FQDN_PENDING[name] = thread
+            thread.start()
+
+    thread.join(timeout)
+    with _FQDN_LOCK:
+        if name not in _FQDN_CACHE and thread.is_alive():
+            LOG.warning("timed out resolving fqdn for %s", name)
+        return _FQDN_CACHE.get(name, name)
+
+
+def resolve_fqdn(name):
+    '''
+    resolve_fqdn resolves the canonical name for name and caches it. The
+    result is not cached if the resolver fails, so that a later call may
+    try again once DNS is reachable.
+    '''
+    fqdn = None
     try:
         addrs = socket.getaddrinfo(
             name, None, 0, socket.SOCK_DGRAM, 0, socket.AI_CANONNAME)
     except socket.error:
         pass
     else:
+        fqdn = name
         for addr in addrs:
             if addr[3]:
-                name = addr[3]
+                fqdn = addr[3]
                 break
+    with _FQDN_LOCK:
+        _FQDN_PENDING.pop(name, None)
+        if fqdn:
+            _FQDN_CACHE[name] = fqdn
+
+
+def get_hosts_fqdn(name, hosts_file=ETC_HOSTS):
+    '''
+    get_hosts_fqdn returns the canonical name for name from the hosts file,
+    or name if the hosts file has no entry for it
+    '''
+    try:
+        with open(hosts_file) as hosts:
+            for line in hosts:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) > 1 and name in fields[1:]:
+                    return fields[1]
+    except (IOError, OSError):
+        pass
     return name
 
 
+def get_hostname(config=None, metadata=None):
+    '''
+    get_hostname returns the host name to record in the host info, resolved
+    according to the host-info configuration:
+
+        dns      - the canonical name from the system resolver (default)
+        hosts    - the canonical name from /etc/hosts, without using DNS
+        metadata - the metadata key local-hostname
+        none     - the unresolved host name
+    '''
+    name = socket.gethostname()
+    mode = HOSTNAME_RESOLUTION_DNS
+    timeout = None
+    if config:
+        mode = config[HOST_INFO_HOSTNAME_RESOLUTION]
+        timeout = config[HOST_INFO_HOSTNAME_TIMEOUT]
+    if mode == HOSTNAME_RESOLUTION_METADATA:
+        return (metadata or {}).get('local-hostname') or name
+    if mode == HOSTNAME_RESOLUTION_HOSTS:
+        return get_hosts_fqdn(name)
+    if mode == HOSTNAME_RESOLUTION_NONE:
+        return name
+    return getfqdn(name, timeout)
+
+
 def is_valid_ip_addr(val):
     """
     Returns false if the address is loopback, link local or unspecified;
     otherwise true is returned.
     """
+    import ipaddress
     addr = None
     try:
         try:
@@ -581,9 +2241,203 @@ def is_valid_ip_addr(val):
     return True
 
 
-def get_host_info():
+class InterfaceInfo(collections.namedtuple(
+        'InterfaceInfo', ['name', 'mac', 'inet4', 'inet6', 'ipv4', 'ipv6'])):
+    '''
+    InterfaceInfo describes a network interface. The fields inet4 and inet6
+    are all of the interface's address dictionaries as returned by
+    netifaces, and ipv4 and ipv6 are the subset of the addresses that are
+    valid according to is_valid_ip_addr.
+    '''
+
+    __slots__ = ()
+
+
+def get_interface_info(dev_name):
+    '''
+    get_interface_info returns the InterfaceInfo for the named device, or
+    None if the device does not exist
+    '''
+    import netifaces
+    try:
+        addr_fams = netifaces.ifaddresses(dev_name)
+    except ValueError:
+        return None
+    af_link = addr_fams.get(netifaces.AF_LINK)
+    af_inet4 = addr_fams.get(netifaces.AF_INET) or []
+    af_inet6 = addr_fams.get(netifaces.AF_INET6) or []
+
+    mac = None
+    if af_link and 'addr' in af_link[0]:
+        mac = af_link[0]['addr']
+
+    return InterfaceInfo(
+        dev_name,
+        mac,
+        af_inet4,
+        af_inet6,
+        [ip_info for ip_info in af_inet4 if is_valid_ip_addr(ip_info['addr'])],
+        [ip_info for ip_info in af_inet6 if is_valid_ip_addr(ip_info['addr'])],
+    )
+
+
+# The default number of seconds to wait on resolving the host's FQDN.
+_HOSTNAME_TIMEOUT = 2
+
+
+def get_host_info_config(*configs):
+    '''
+    get_host_info_config returns the normalized host-info configuration
+    from the provided configurations, with the values from later
+    configurations taking precedence
+    '''
+    merged = {}
+    for config in configs:
+        if isinstance(config, dict):
+            merged.update(config)
+
+    max_addresses = merged.get(HOST_INFO_MAX_ADDRESSES)
+    if max_addresses is not None:
+        try:
+            max_addresses = int(max_addresses)
+        except (TypeError, ValueError):
+            max_addresses = -1
+        if max_addresses < 0:
+            LOG.warning("invalid host-info %s: %s",
+                        HOST_INFO_MAX_ADDRESSES,
+                        merged[HOST_INFO_MAX_ADDRESSES])
+            max_addresses = None
+
+    hostname_resolution = merged.get(
+        HOST_INFO_HOSTNAME_RESOLUTION, HOSTNAME_RESOLUTION_DNS)
+    if hostname_resolution not in (
+            HOSTNAME_RESOLUTION_DNS, HOSTNAME_RESOLUTION_HOSTS,
+            HOSTNAME_RESOLUTION_METADATA, HOSTNAME_RESOLUTION_NONE):
+        LOG.warning("invalid host-info %s: %s",
+                    HOST_INFO_HOSTNAME_RESOLUTION, hostname_resolution)
+        hostname_resolution = HOSTNAME_RESOLUTION_DNS
+
+    return {
+        HOST_INFO_HOSTNAME_RESOLUTION: hostname_resolution,
+        HOST_INFO_HOSTNAME_TIMEOUT: get_wait_on_network_seconds(
+            HOST_INFO_HOSTNAME_TIMEOUT,
+            merged.get(HOST_INFO_HOSTNAME_TIMEOUT), _HOSTNAME_TIMEOUT),
+        HOST_INFO_INCLUDE_INTERFACES: get_wait_on_network_list(
+            merged.get(HOST_INFO_INCLUDE_INTERFACES)),
+        HOST_INFO_EXCLUDE_INTERFACES: get_wait_on_network_list(
+            merged.get(HOST_INFO_EXCLUDE_INTERFACES)),
+        HOST_INFO_EXCLUDE_DRIVERS: get_wait_on_network_list(
+            merged.get(HOST_INFO_EXCLUDE_DRIVERS)),
+        HOST_INFO_EXCLUDE_TYPES: get_wait_on_network_list(
+            merged.get(HOST_INFO_EXCLUDE_TYPES)),
+        HOST_INFO_MAX_ADDRESSES: max_addresses,
+    }
+
+
+# Constants from linux/sockios.h and linux/ethtool.h
+SIOCETHTOOL = 0x8946
+ETHTOOL_GDRVINFO = 0x00000003
+ETHTOOL_DRVINFO_LEN = 196
+
+
+def get_interface_driver(dev_name):
+    '''
+    get_interface_driver returns the name of the driver for the named
+    device, ex. veth or e1000, or None if it cannot be determined
+    '''
+    import array
+    import fcntl
+    buf = array.array(
+        'B', struct.pack('I', ETHTOOL_GDRVINFO) +
+        b'\0' * (ETHTOOL_DRVINFO_LEN - 4))
+    addr, _ = buf.buffer_info()
+    ifreq = struct.pack('16sP', dev_name.encode('utf-8')[:15], addr)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        fcntl.ioctl(sock.fileno(), SIOCETHTOOL, ifreq)
+    except (IOError, OSError):
+        # Fall back to the driver of the underlying device, if any.
+        try:
+            return os.path.basename(os.readlink(
+                os.path.join(SYS_CLASS_NET, dev_name, 'device', 'driver')))
+        except OSError:
+            return None
+    finally:
+        sock.close()
+    driver = bytearray(buf)[4:36].split(b'\0', 1)[0]
+    return driver.decode('utf-8')
+
+
+def get_interface_type(dev_name):
+    '''
+    get_interface_type returns the kernel's DEVTYPE for the named device,
+    ex. bridge, bond, or vlan, or None if the device has no type
+    '''
+    try:
+        with open(os.path.join(SYS_CLASS_NET, dev_name, 'uevent')) as uevent:
+            for line in uevent:
+                if line.startswith('DEVTYPE='):
+                    return line[len('DEVTYPE='):].strip()
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def is_interface_included(dev_name, config):
+    '''
+    is_interface_included returns True if the named device passes the
+    filters in the provided host-info configuration
+    '''
+    if not config:
+        return True
+    include = config[HOST_INFO_INCLUDE_INTERFACES]
+    if include and not any(fnmatch.fnmatch(dev_name, p) for p in include):
+        return False
+    for pattern in config[HOST_INFO_EXCLUDE_INTERFACES]:
+        if fnmatch.fnmatch(dev_name, pattern):
+            return False
+    exclude_types = config[HOST_INFO_EXCLUDE_TYPES]
+    if exclude_types and get_interface_type(dev_name) in exclude_types:
+        return False
+    exclude_drivers = config[HOST_INFO_EXCLUDE_DRIVERS]
+    if exclude_drivers and get_interface_driver(dev_name) in exclude_drivers:
+        return False
+    return True
+
+
+def get_interface_snapshot(dev_names=None, config=None):
+    '''
+    get_interface_snapshot returns an ordered dictionary of InterfaceInfo
+    objects keyed by device name. The addresses of each device are read and
+    validated exactly once. If dev_names is None then all of the host's
+    devices are included. Devices excluded by the provided host-info
+    configuration are skipped before their addresses are read.
+
+    Two snapshots may be compared with == to determine if anything changed.
+    '''
+    if dev_names is None:
+        import netifaces
+        dev_names = netifaces.interfaces()
+    snapshot = collections.OrderedDict()
+    for dev_name in dev_names:
+        if not is_interface_included(dev_name, config):
+            continue
+        info = get_interface_info(dev_name)
+        if info:
+            snapshot[dev_name] = info
+    return snapshot
+
+
+def get_host_info(snapshot=None, config=None, hostname=None,
+                  default_addrs=None):
     '''
     Returns host information such as the host name and network interfaces.
+    The interfaces are read from the provided snapshot, or from a new
+    snapshot if none is provided. The optional host-info configuration
+    filters the interfaces, limits the number of recorded addresses, and
+    controls how the host name is resolved if hostname is None. If
+    default_addrs is None then the default addresses are computed from the
+    snapshot with get_default_ip_addrs.
     '''
 
     host_info = {
@@ -596,13 +2450,24 @@ def get_host_info():
         },
     }
 
-    hostname = getfqdn(socket.gethostname())
+    if hostname is None:
+        hostname = get_hostname(config)
     if hostname:
         host_info['hostname'] = hostname
         host_info['local-hostname'] = hostname
         host_info['local_hostname'] = hostname
 
-    default_ipv4, default_ipv6 = get_default_ip_addrs()
+    if snapshot is None:
+        snapshot = get_interface_snapshot(config=config)
+
+    # The maximum number of addresses to record for each address family.
+    max_ipv4 = max_ipv6 = None
+    if config and config[HOST_INFO_MAX_ADDRESSES] is not None:
+        max_ipv4 = max_ipv6 = config[HOST_INFO_MAX_ADDRESSES]
+
+    if default_addrs is None:
+        default_addrs = get_default_ip_addrs(snapshot)
+    default_ipv4, default_ipv6 = default_addrs
     if default_ipv4:
         host_info[LOCAL_IPV4] = default_ipv4
     if default_ipv6:
@@ -612,142 +2477,1158 @@ def get_host_info():
     by_ipv4 = host_info['network']['interfaces']['by-ipv4']
     by_ipv6 = host_info['network']['interfaces']['by-ipv6']
 
-    ifaces = netifaces.interfaces()
-    for dev_name in ifaces:
-        addr_fams = netifaces.ifaddresses(dev_name)
-        af_link = addr_fams.get(netifaces.AF_LINK)
-        af_inet4 = addr_fams.get(netifaces.AF_INET)
-        af_inet6 = addr_fams.get(netifaces.AF_INET6)
-
-        mac = None
-        if af_link and 'addr' in af_link[0]:
-            mac = af_link[0]['addr']
+    for info in snapshot.values():
+        mac = info.mac
 
         # Do not bother recording localhost
         if mac == "00:00:00:00:00:00":
             continue
 
-        if mac and (af_inet4 or af_inet6):
-            key = mac
+        ipv4 = info.ipv4
+        if max_ipv4 is not None:
+            ipv4 = ipv4[:max_ipv4]
+            max_ipv4 -= len(ipv4)
+        ipv6 = info.ipv6
+        if max_ipv6 is not None:
+            ipv6 = ipv6[:max_ipv6]
+            max_ipv6 -= len(ipv6)
+
+        if mac and (info.inet4 or info.inet6):
             val = {}
-            if af_inet4:
-                af_inet4_vals = []
-                for ip_info in af_inet4:
-                    if not is_valid_ip_addr(ip_info['addr']):
-                        continue
-                    af_inet4_vals.append(ip_info)
-                val["ipv4"] = af_inet4_vals
-            if af_inet6:
-                af_inet6_vals = []
-                for ip_info in af_inet6:
-                    if not is_valid_ip_addr(ip_info['addr']):
-                        continue
-                    af_inet6_vals.append(ip_info)
-                val["ipv6"] = af_inet6_vals
-            by_mac[key] = val
-
-        if af_inet4:
-            for ip_info in af_inet4:
-                key = ip_info['addr']
-                if not is_valid_ip_addr(key):
-                    continue
-                val = copy.deepcopy(ip_info)
-                del val['addr']
-                if mac:
-                    val['mac'] = mac
-                by_ipv4[key] = val
-
-        if af_inet6:
-            for ip_info in af_inet6:
-                key = ip_info['addr']
-                if not is_valid_ip_addr(key):
-                    continue
-                val = copy.deepcopy(ip_info)
-                del val['addr']
-                if mac:
-                    val['mac'] = mac
-                by_ipv6[key] = val
+            if info.inet4:
+                val["ipv4"] = list(ipv4)
+            if info.inet6:
+                val["ipv6"] = list(ipv6)
+            by_mac[mac] = val
 
-    return host_info
+        for ip_info in ipv4:
+            by_ipv4[ip_info['addr']] = get_addr_info(ip_info, mac)
 
+        for ip_info in ipv6:
+            by_ipv6[ip_info['addr']] = get_addr_info(ip_info, mac)
 
-def wait_on_network(metadata):
-    # Determine whether we need to wait on the network coming online.
-    wait_on_ipv4 = False
-    wait_on_ipv6 = False
-    if WAIT_ON_NETWORK in metadata:
-        wait_on_network = metadata[WAIT_ON_NETWORK]
-        if WAIT_ON_NETWORK_IPV4 in wait_on_network:
-            wait_on_ipv4_val = wait_on_network[WAIT_ON_NETWORK_IPV4]
-            if isinstance(wait_on_ipv4_val, bool):
-                wait_on_ipv4 = wait_on_ipv4_val
-            else:
-                wait_on_ipv4 = bool(strtobool(wait_on_ipv4_val))
-        if WAIT_ON_NETWORK_IPV6 in wait_on_network:
-            wait_on_ipv6_val = wait_on_network[WAIT_ON_NETWORK_IPV6]
-            if isinstance(wait_on_ipv6_val, bool):
-                wait_on_ipv6 = wait_on_ipv6_val
-            else:
-                wait_on_ipv6 = bool(strtobool(wait_on_ipv6_val))
+    return host_info
 
-    # Get information about the host.
-    host_info = None
-    while host_info == None:
-        host_info = get_host_info()
-        if wait_on_ipv4:
-            ipv4_ready = False
-            if 'network' in host_info:
-                if 'interfaces' in host_info['network']:
-                    if 'by-ipv4' in host_info['network']['interfaces']:
-                        if len(host_info['network']['interfaces']['by-ipv4']) > 0:
-                            ipv4_ready = True
-            if not ipv4_ready:
-                LOG.info("ipv4 not ready")
-                host_info = None
-        if wait_on_ipv6:
-            ipv6_ready = False
-            if 'network' in host_info:
-                if 'interfaces' in host_info['network']:
-                    if 'by-ipv6' in host_info['network']['interfaces']:
-                        if len(host_info['network']['interfaces']['by-ipv6']) > 0:
-                            ipv6_ready = True
-            if not ipv6_ready:
-                LOG.info("ipv6 not ready")
-                host_info = None
-        if host_info == None:
-            LOG.info("waiting on network")
-            time.sleep(1)
 
-    return host_info
+def get_addr_info(ip_info, mac):
+    '''
+    get_addr_info returns a copy of a netifaces address dictionary without
+    its address and with the MAC address of its device
+    '''
+    val = dict((k, v) for k, v in ip_info.items() if k != 'addr')
+    if mac:
+        val['mac'] = mac
+    return val
 
 
-def get_data_access_method():
-    if os.environ.get(VMX_GUESTINFO, ""):
-        return VMX_GUESTINFO
-    if VMWARE_RPCTOOL:
-        return VMWARE_RPCTOOL
-    return None
+# Constants from linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE = 0
+NLMSG_HDR_FMT = '=IHHII'
+NLMSG_HDR_LEN = struct.calcsize(NLMSG_HDR_FMT)
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+# The longest time to wait for a netlink event before checking the network
+# again, in case an event was dropped.
+_NETLINK_RECHECK_INTERVAL = 10
+
+
+class NetlinkChanges(object):
+    '''
+    NetlinkChanges records the changes reported by rtnetlink: the indexes
+    of the interfaces whose links or addresses changed, and whether any
+    route changed. If overflow is True then notifications were dropped or
+    could not be parsed, so anything may have changed.
+    '''
 
+    def __init__(self):
+        self.indexes = set()
+        self.routes = False
+        self.overflow = False
 
-_MERGE_STRATEGY_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_MERGE_STRATEGY'
-_MERGE_STRATEGY_DEEPMERGE = 'deepmerge'
+    def update(self, other):
+        self.indexes.update(other.indexes)
+        self.routes = self.routes or other.routes
+        self.overflow = self.overflow or other.overflow
 
+    def __bool__(self):
+        return bool(self.indexes or self.routes or self.overflow)
 
-def merge_dicts(a, b):
-    merge_strategy = os.getenv(_MERGE_STRATEGY_ENV_VAR)
-    if merge_strategy == _MERGE_STRATEGY_DEEPMERGE:
-        try:
-            LOG.info('merging dictionaries with deepmerge strategy')
-            return merge_dicts_with_deep_merge(a, b)
-        except Exception as err:
-            LOG.error("deep merge failed: %s" % err)
-    LOG.info('merging dictionaries with stdlib strategy')
-    return merge_dicts_with_stdlib(a, b)
+    __nonzero__ = __bool__
+
+
+class NetlinkMonitor(object):
+    '''
+    NetlinkMonitor subscribes to rtnetlink notifications for new IPv4 and
+    IPv6 addresses and routes, allowing callers to block until the network
+    changes rather than polling it. Other groups and message types may be
+    selected when the monitor is opened.
+    '''
+
+    GROUPS = RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | \
+        RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE
+    MSG_TYPES = (RTM_NEWADDR, RTM_NEWROUTE)
+
+    def __init__(self, sock, msg_types=None):
+        self.sock = sock
+        self.msg_types = msg_types or self.MSG_TYPES
+
+    @classmethod
+    def open(cls, groups=None, msg_types=None):
+        '''
+        open returns a new NetlinkMonitor, or None if rtnetlink is not
+        available
+        '''
+        try:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        except (AttributeError, socket.error) as error:
+            LOG.debug("netlink is not available: %s", error)
+            return None
+        try:
+            sock.bind((0, groups or cls.GROUPS))
+            sock.setblocking(False)
+        except socket.error as error:
+            LOG.debug("failed to subscribe to netlink: %s", error)
+            sock.close()
+            return None
+        return cls(sock, msg_types)
+
+    def wait(self, timeout):
+        '''
+        wait blocks until a new address or route is reported or timeout
+        seconds elapse. True is returned if the network changed.
+        '''
+        return bool(self.wait_changes(timeout))
+
+    def wait_changes(self, timeout, changes=None):
+        '''
+        wait_changes blocks until a change is reported or timeout seconds
+        elapse, and returns the NetlinkChanges that were read. The changes
+        are also added to changes if it is provided.
+        '''
+        found = NetlinkChanges()
+        deadline = time.time() + timeout
+        while not found:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self.sock], [], [], remaining)
+            if not readable:
+                break
+            self.read_changes(found)
+        if changes is not None:
+            changes.update(found)
+        return found
+
+    def drain(self):
+        '''
+        drain reads all pending notifications and returns True if any of
+        them reported a new address or route
+        '''
+        return bool(self.read_changes(NetlinkChanges()))
+
+    def read_changes(self, changes):
+        '''
+        read_changes reads all pending notifications into changes and
+        returns it
+        '''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changes
+                # ENOBUFS means notifications were dropped, so assume the
+                # network changed.
+                changes.overflow = True
+                return changes
+            if not data:
+                return changes
+            offset = 0
+            while offset + NLMSG_HDR_LEN <= len(data):
+                msg_len, msg_type, _, _, _ = struct.unpack_from(
+                    NLMSG_HDR_FMT, data, offset)
+                if msg_type in self.msg_types:
+                    if msg_type in (RTM_NEWROUTE, RTM_DELROUTE):
+                        changes.routes = True
+                    elif offset + NLMSG_HDR_LEN + 8 <= len(data):
+                        # Both ifinfomsg and ifaddrmsg begin with four
+                        # bytes followed by the interface index.
+                        changes.indexes.add(struct.unpack_from(
+                            '=i', data, offset + NLMSG_HDR_LEN + 4)[0])
+                    else:
+                        changes.overflow = True
+                if msg_len < NLMSG_HDR_LEN:
+                    break
+                offset += (msg_len + 3) & ~3
+
+    def close(self):
+        self.sock.close()
+
+
+def get_wait_on_network_seconds(name, val, default):
+    '''
+    get_wait_on_network_seconds returns val as a positive number of seconds,
+    or default if val is absent or invalid
+    '''
+    if val is None or isinstance(val, bool):
+        return default
+    try:
+        seconds = float(val)
+    except (TypeError, ValueError):
+        LOG.warning("invalid wait-on-network %s: %s", name, val)
+        return default
+    if seconds <= 0:
+        return default
+    return seconds
+
+
+_TRUE_STRINGS = ('y', 'yes', 't', 'true', 'on', '1')
+_FALSE_STRINGS = ('n', 'no', 'f', 'false', 'off', '0')
+
+
+def get_wait_on_network_bool(val):
+    '''
+    get_wait_on_network_bool returns val as a bool. Strings are converted
+    the same way as distutils' strtobool, and a ValueError is raised if
+    val is not a valid truth value.
+    '''
+    if isinstance(val, bool):
+        return val
+    val = str(val).lower()
+    if val in _TRUE_STRINGS:
+        return True
+    if val in _FALSE_STRINGS:
+        return False
+    raise ValueError("invalid truth value %r" % (val,))
+
+
+def get_wait_on_network_list(val):
+    if not val:
+        return []
+    if not type(val) in (list, tuple):
+        return [val]
+    return list(val)
+
+
+def get_wait_on_network_config(metadata):
+    '''
+    get_wait_on_network_config returns the normalized wait-on-network
+    configuration from the metadata
+    '''
+    wait_on_network = metadata.get(WAIT_ON_NETWORK) or {}
+    config = {
+        WAIT_ON_NETWORK_IPV4: get_wait_on_network_bool(
+            wait_on_network.get(WAIT_ON_NETWORK_IPV4, False)),
+        WAIT_ON_NETWORK_IPV6: get_wait_on_network_bool(
+            wait_on_network.get(WAIT_ON_NETWORK_IPV6, False)),
+        WAIT_ON_NETWORK_TIMEOUT: get_wait_on_network_seconds(
+            WAIT_ON_NETWORK_TIMEOUT,
+            wait_on_network.get(WAIT_ON_NETWORK_TIMEOUT), None),
+        WAIT_ON_NETWORK_INTERVAL: get_wait_on_network_seconds(
+            WAIT_ON_NETWORK_INTERVAL,
+            wait_on_network.get(WAIT_ON_NETWORK_INTERVAL), 1),
+        WAIT_ON_NETWORK_BACKOFF: get_wait_on_network_seconds(
+            WAIT_ON_NETWORK_BACKOFF,
+            wait_on_network.get(WAIT_ON_NETWORK_BACKOFF), 1),
+        WAIT_ON_NETWORK_MAX_INTERVAL: get_wait_on_network_seconds(
+            WAIT_ON_NETWORK_MAX_INTERVAL,
+            wait_on_network.get(WAIT_ON_NETWORK_MAX_INTERVAL), 30),
+        WAIT_ON_NETWORK_MODE: wait_on_network.get(
+            WAIT_ON_NETWORK_MODE, WAIT_ON_NETWORK_MODE_ALL),
+        WAIT_ON_NETWORK_INTERFACE: get_wait_on_network_list(
+            wait_on_network.get(WAIT_ON_NETWORK_INTERFACE)),
+        WAIT_ON_NETWORK_CIDR: [],
+    }
+
+    if config[WAIT_ON_NETWORK_MODE] not in (
+            WAIT_ON_NETWORK_MODE_ALL, WAIT_ON_NETWORK_MODE_ANY):
+        LOG.warning("invalid wait-on-network mode: %s",
+                    config[WAIT_ON_NETWORK_MODE])
+        config[WAIT_ON_NETWORK_MODE] = WAIT_ON_NETWORK_MODE_ALL
+
+    import ipaddress
+    for cidr in get_wait_on_network_list(
+            wait_on_network.get(WAIT_ON_NETWORK_CIDR)):
+        try:
+            config[WAIT_ON_NETWORK_CIDR].append(
+                ipaddress.ip_network(u"%s" % cidr, strict=False))
+        except ValueError:
+            LOG.warning("invalid wait-on-network cidr: %s", cidr)
+
+    return config
+
+
+def is_addr_in_networks(val, networks):
+    '''
+    is_addr_in_networks returns True if the address val is in one of the
+    provided networks, or if there are no networks
+    '''
+    if not networks:
+        return True
+    import ipaddress
+    addr = ipaddress.ip_address(u"%s" % val)
+    for network in networks:
+        if addr.version == network.version and addr in network:
+            return True
+    return False
+
+
+def is_network_ready(config, snapshot):
+    '''
+    is_network_ready returns True if the interface snapshot has the
+    addresses specified by the wait-on-network configuration
+    '''
+    wait_on = []
+    if config[WAIT_ON_NETWORK_IPV4]:
+        wait_on.append(WAIT_ON_NETWORK_IPV4)
+    if config[WAIT_ON_NETWORK_IPV6]:
+        wait_on.append(WAIT_ON_NETWORK_IPV6)
+    if not wait_on:
+        return True
+
+    networks = config[WAIT_ON_NETWORK_CIDR]
+    ready = []
+    for family in wait_on:
+        family_ready = False
+        for info in snapshot.values():
+            if info.mac == "00:00:00:00:00:00":
+                continue
+            for ip_info in getattr(info, family):
+                if is_addr_in_networks(ip_info['addr'], networks):
+                    family_ready = True
+                    break
+            if family_ready:
+                break
+        if not family_ready:
+            LOG.info("%s not ready", family)
+        ready.append(family_ready)
+
+    if config[WAIT_ON_NETWORK_MODE] == WAIT_ON_NETWORK_MODE_ANY:
+        return any(ready)
+    return all(ready)
+
+
+@timed('wait_on_network')
+def wait_on_network(metadata, host_info_config=None):
+    # Determine whether we need to wait on the network coming online.
+    config = get_wait_on_network_config(metadata)
+    if host_info_config is None:
+        host_info_config = get_host_info_config(metadata.get(HOST_INFO))
+    timeout = config[WAIT_ON_NETWORK_TIMEOUT]
+    interval = config[WAIT_ON_NETWORK_INTERVAL]
+
+    # Only the configured interfaces are inspected while waiting. When no
+    # interfaces are configured, the last snapshot is used to build the
+    # host info.
+    dev_names = config[WAIT_ON_NETWORK_INTERFACE] or None
+
+    # Subscribe to network changes before the first check so that no
+    # change between a check and the subsequent wait is missed.
+    monitor = None
+    if config[WAIT_ON_NETWORK_IPV4] or config[WAIT_ON_NETWORK_IPV6]:
+        monitor = NetlinkMonitor.open()
+    deadline = None
+    if timeout:
+        deadline = time.time() + timeout
+
+    snapshot = None
+    try:
+        while True:
+            TIMING.incr('wait_on_network.iterations')
+            last_snapshot = snapshot
+            snapshot = get_interface_snapshot(dev_names, host_info_config)
+            if snapshot == last_snapshot:
+                LOG.debug("network unchanged")
+            elif is_network_ready(config, snapshot):
+                break
+
+            # Without netlink, poll with the configured interval, backing
+            # off after each attempt.
+            wait = interval
+            if monitor:
+                wait = _NETLINK_RECHECK_INTERVAL
+            else:
+                interval = min(
+                    interval * config[WAIT_ON_NETWORK_BACKOFF],
+                    config[WAIT_ON_NETWORK_MAX_INTERVAL])
+            if deadline:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    LOG.warning(
+                        "timed out after %ss waiting on network", timeout)
+                    break
+                wait = min(wait, remaining)
+
+            LOG.info("waiting on network")
+            if monitor:
+                monitor.wait(wait)
+            else:
+                time.sleep(wait)
+    finally:
+        if monitor:
+            monitor.close()
+
+    # Get information about the host.
+    if dev_names:
+        snapshot = None
+    return get_host_info(
+        snapshot, host_info_config, get_hostname(host_info_config, metadata))
+
+
+class GuestInfoTransport(object):
+    '''
+    GuestInfoTransport is the base class for the methods used to get and
+    set guestinfo values. A transport is created once per process and
+    reused for every key.
+    '''
+
+    name = None
+    writable = True
+    concurrent = False
+
+    # probed is True if the values that dscheck_VMwareGuestInfo fetched
+    # with vmware-rpctool may be used in place of the transport's values.
+    probed = True
+
+    def get(self, key):
+        '''
+        get returns the raw value of guestinfo.<key> or None if the key
+        has no value
+        '''
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        '''
+        set assigns value to guestinfo.<key> and returns True on success
+        '''
+        raise NotImplementedError()
+
+    def try_set(self, key, value):
+        '''
+        try_set assigns value to guestinfo.<key> and returns None on
+        success, or a description of the failure
+        '''
+        try:
+            if self.set(key, value):
+                return None
+            return "the value was not set"
+        except Exception as error:
+            return str(error) or error.__class__.__name__
+
+    def set_many(self, items):
+        '''
+        set_many assigns each (key, value) pair in items and returns a
+        dictionary of the keys that could not be set, mapped to the reason.
+        The keys are set concurrently if the transport supports it.
+        '''
+        def try_set(item):
+            return self.try_set(*item)
+
+        if self.concurrent:
+            errors = map_concurrently(try_set, items)
+        else:
+            errors = [try_set(item) for item in items]
+        return dict(
+            (key, error) for (key, _), error in zip(items, errors) if error)
+
+    def close(self):
+        '''
+        close releases any resources held by the transport
+        '''
+        pass
+
+
+class EnvTransport(GuestInfoTransport):
+    '''
+    EnvTransport reads guestinfo from VMX_GUESTINFO_* environment
+    variables. Writes are accepted but discarded.
+    '''
+
+    name = VMX_GUESTINFO
+    writable = False
+
+    def get(self, key):
+        env_key = ("vmx.guestinfo." + key).upper().replace(".", "_", -1)
+        return os.environ.get(env_key, "")
+
+    def set(self, key, value):
+        return True
+
+
+class LocalBackdoorTransport(GuestInfoTransport):
+    '''
+    LocalBackdoorTransport is an in-memory stand-in for the VMware
+    backdoor. It is intended for tests and benchmarks and may be installed
+    with set_transport. Each command sleeps for latency seconds to simulate
+    a round-trip to the host, and, like the RPCI channel, commands are
+    serialized.
+    '''
+
+    name = "local-backdoor"
+
+    # The values probed from the host are not the stand-in's values.
+    probed = False
+
+    def __init__(self, values=None, latency=0):
+        self.values = dict(values or {})
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if self.latency:
+                time.sleep(self.latency)
+            return self.values.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            if self.latency:
+                time.sleep(self.latency)
+            self.values[key] = value
+        return True
+
+
+class RpcToolTransport(GuestInfoTransport):
+    '''
+    RpcToolTransport forks vmware-rpctool once for every get and set. Since
+    each command is a separate process, commands may be run concurrently.
+    '''
+
+    name = VMWARE_RPCTOOL
+    concurrent = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        try:
+            TIMING.incr('subprocesses')
+            (stdout, stderr) = subp([self.path, "info-get guestinfo." + key])
+            if stderr == NOVAL:
+                LOG.debug("No value found for key %s", key)
+            elif not stdout:
+                LOG.error("Failed to get guestinfo value for key %s", key)
+            else:
+                return stdout
+        except ProcessExecutionError as error:
+            if error.stderr == NOVAL:
+                LOG.debug("No value found for key %s", key)
+            else:
+                util.logexc(
+                    LOG, "Failed to get guestinfo value for key %s: %s", key, error)
+        return None
+
+    def set(self, key, value):
+        error = self.try_set(key, value)
+        if not error:
+            return True
+        LOG.error(
+            "Failed to set guestinfo key=%s to value=%s: %s", key, value, error)
+        return None
+
+    def try_set(self, key, value):
+        try:
+            TIMING.incr('subprocesses')
+            subp([self.path, ("info-set guestinfo.%s %s" % (key, value))])
+            return None
+        except ProcessExecutionError as error:
+            return (error.stderr or str(error)).strip()
+
+
+class RpciTransport(GuestInfoTransport):
+    '''
+    RpciTransport sends RPCI commands over a single RpcChannel opened
+    in-process with open-vm-tools' libvmtools. The channel is opened on
+    first use and reused for every subsequent get and set.
+    '''
+
+    name = VMWARE_RPCI
+
+    def __init__(self, lib):
+        self._lib = lib
+        self._chan = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        '''
+        load returns a new RpciTransport, or None if libvmtools is not
+        available on this host
+        '''
+        import ctypes
+        lib = None
+        for lib_name in VMWARE_LIBVMTOOLS:
+            try:
+                lib = ctypes.CDLL(lib_name)
+                break
+            except OSError:
+                continue
+        if not lib:
+            return None
+        try:
+            lib.RpcChannel_New.restype = ctypes.c_void_p
+            lib.RpcChannel_New.argtypes = []
+            lib.RpcChannel_Start.restype = ctypes.c_int
+            lib.RpcChannel_Start.argtypes = [ctypes.c_void_p]
+            lib.RpcChannel_Send.restype = ctypes.c_int
+            lib.RpcChannel_Send.argtypes = [
+                ctypes.c_void_p,
+                ctypes.c_char_p,
+                ctypes.c_size_t,
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_char)),
+                ctypes.POINTER(ctypes.c_size_t),
+            ]
+            lib.RpcChannel_Stop.restype = None
+            lib.RpcChannel_Stop.argtypes = [ctypes.c_void_p]
+            lib.RpcChannel_Destroy.restype = None
+            lib.RpcChannel_Destroy.argtypes = [ctypes.c_void_p]
+            lib.RpcChannel_Free.restype = None
+            lib.RpcChannel_Free.argtypes = [ctypes.c_void_p]
+        except AttributeError as error:
+            LOG.debug("libvmtools does not export RpcChannel: %s", error)
+            return None
+        return cls(lib)
+
+    def open(self):
+        '''
+        open starts the RPCI channel if it is not already started
+        '''
+        with self._lock:
+            self._open()
+
+    def _open(self):
+        if self._chan:
+            return
+        chan = self._lib.RpcChannel_New()
+        if not chan:
+            raise IOError("failed to create rpci channel")
+        if not self._lib.RpcChannel_Start(chan):
+            self._lib.RpcChannel_Destroy(chan)
+            raise IOError("failed to start rpci channel")
+        self._chan = chan
+
+    def _close(self):
+        if not self._chan:
+            return
+        self._lib.RpcChannel_Stop(self._chan)
+        self._lib.RpcChannel_Destroy(self._chan)
+        self._chan = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def send(self, cmd):
+        '''
+        send issues cmd over the channel and returns a tuple of whether
+        the command succeeded and the reply
+        '''
+        with self._lock:
+            return self._send(cmd)
+
+    def _send(self, cmd):
+        import ctypes
+        if not isinstance(cmd, bytes):
+            cmd = cmd.encode('utf-8')
+        self._open()
+        result = ctypes.POINTER(ctypes.c_char)()
+        result_len = ctypes.c_size_t()
+        ok = self._lib.RpcChannel_Send(
+            self._chan, cmd, len(cmd),
+            ctypes.byref(result), ctypes.byref(result_len))
+        reply = b''
+        if result:
+            reply = ctypes.string_at(result, result_len.value)
+            self._lib.RpcChannel_Free(result)
+        reply = reply.decode('utf-8', 'replace')
+        if not ok and reply != NOVAL:
+            # The channel may have been reset by the host, so reopen it on
+            # the next command.
+            self._close()
+        return bool(ok), reply
+
+    def get(self, key):
+        ok, reply = self.send("info-get guestinfo." + key)
+        if ok:
+            return reply
+        if reply == NOVAL:
+            LOG.debug("No value found for key %s", key)
+        else:
+            LOG.error(
+                "Failed to get guestinfo value for key %s: %s", key, reply)
+        return None
+
+    def set(self, key, value):
+        error = self.try_set(key, value)
+        if not error:
+            return True
+        LOG.error(
+            "Failed to set guestinfo key=%s to value=%s: %s", key, value, error)
+        return None
+
+    def try_set(self, key, value):
+        try:
+            ok, reply = self.send("info-set guestinfo.%s %s" % (key, value))
+        except (IOError, OSError) as error:
+            return str(error)
+        if ok:
+            return None
+        return reply or "the value was not set"
+
+    def set_many(self, items):
+        # Hold the channel for the whole batch so the writes are sent in
+        # a single session, without interleaving other commands.
+        failures = {}
+        with self._lock:
+            for key, value in items:
+                try:
+                    ok, reply = self._send(
+                        "info-set guestinfo.%s %s" % (key, value))
+                except (IOError, OSError) as error:
+                    ok, reply = False, str(error)
+                if not ok:
+                    failures[key] = reply or "the value was not set"
+        return failures
+
+
+class SeedTransport(GuestInfoTransport):
+    '''
+    SeedTransport reads guestinfo in bulk from the guestinfo.* properties
+    of an OVF environment, which is read once from a seed ISO image or
+    device, or from an ovf-env.xml file. Keys that the seed does not hold,
+    such as guestinfo.revision or values set after the seed was created,
+    are read with the backdoor transport, if one is available. Writes are
+    sent with the backdoor transport too, and are discarded without one.
+    '''
+
+    name = VMWARE_SEED
+    probed = False
+
+    def __init__(self, values, path=None, backdoor=None):
+        self.values = values
+        self.path = path
+        self.backdoor = backdoor
+        self.writable = backdoor is not None
+        self.concurrent = backdoor is not None and backdoor.concurrent
+
+    @classmethod
+    def load(cls, paths, backdoor=None):
+        '''
+        load returns a new SeedTransport for the first of paths that holds
+        an OVF environment with guestinfo properties, or None
+        '''
+        for path in paths:
+            try:
+                with TIMING.timer('read_seed'):
+                    values = read_seed(path)
+            except (EnvironmentError, ValueError, SyntaxError) as error:
+                LOG.debug("failed to read seed %s: %s", path, error)
+                continue
+            if values:
+                LOG.debug("using seed %s", path)
+                return cls(values, path, backdoor)
+        return None
+
+    def get(self, key):
+        if key in self.values:
+            return self.values[key]
+        if self.backdoor:
+            return self.backdoor.get(key)
+        return None
+
+    def set(self, key, value):
+        if self.backdoor:
+            return self.backdoor.set(key, value)
+        return True
+
+    def try_set(self, key, value):
+        if self.backdoor:
+            return self.backdoor.try_set(key, value)
+        return None
+
+    def set_many(self, items):
+        if self.backdoor:
+            return self.backdoor.set_many(items)
+        return {}
+
+    def close(self):
+        if self.backdoor:
+            self.backdoor.close()
+
+
+# Constants from ECMA-119 (ISO 9660)
+ISO_SECTOR_SIZE = 2048
+ISO_PVD_OFFSET = 16 * ISO_SECTOR_SIZE
+ISO_STANDARD_ID = b'CD001'
+
+
+def read_seed(path):
+    '''
+    read_seed returns a dictionary of the guestinfo values from the OVF
+    environment at path, which may be an ISO 9660 image or device with
+    ovf-env.xml in its root directory, an ovf-env.xml file, or a directory
+    that holds one. None is returned if path does not hold an environment.
+
+    The file is memory-mapped rather than read, so only the parts of an
+    image or device that are needed are read from it.
+    '''
+    if os.path.isdir(path):
+        path = os.path.join(path, OVF_ENV_FILE)
+    if not os.path.exists(path):
+        return None
+
+    import mmap
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if not size:
+            return None
+        data = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        try:
+            if data[ISO_PVD_OFFSET + 1:ISO_PVD_OFFSET + 6] == ISO_STANDARD_ID:
+                env = read_iso_file(data, OVF_ENV_FILE)
+            elif stat.S_ISREG(os.fstat(fd).st_mode):
+                env = data[:]
+            else:
+                env = None
+        finally:
+            data.close()
+    finally:
+        os.close(fd)
+    if not env:
+        return None
+    return parse_ovf_env(env)
+
+
+def read_iso_file(data, name):
+    '''
+    read_iso_file returns the contents of the file name from the root
+    directory of the ISO 9660 image data, or None if there is no such file.
+    Names are compared without regard to case or version, and "-" matches
+    the "_" that replaces it in ISO 9660 names. ValueError is raised if the
+    image is truncated or its root directory is invalid.
+    '''
+    def normalize(val):
+        return val.split(';')[0].rstrip('.').lower().replace('-', '_')
+
+    def unpack(fmt, offset):
+        if offset + struct.calcsize(fmt) > len(data):
+            raise ValueError("ISO 9660 image is truncated at %d" % offset)
+        return struct.unpack_from(fmt, data, offset)
+
+    block_size, = unpack('<H', ISO_PVD_OFFSET + 128)
+    if not block_size:
+        raise ValueError("ISO 9660 image has a logical block size of 0")
+    root = ISO_PVD_OFFSET + 156
+    extent, length = unpack('<I4xI', root + 2)
+    offset = extent * block_size
+    end = min(offset + length, len(data))
+    name = normalize(name)
+    while offset < end:
+        record_len, = unpack('B', offset)
+        if not record_len:
+            # Records do not span blocks, so the rest of the block is empty.
+            offset = (offset // block_size + 1) * block_size
+            continue
+        file_extent, file_size = unpack('<I4xI', offset + 2)
+        flags, = unpack('B', offset + 25)
+        name_len, = unpack('B', offset + 32)
+        file_name = data[offset + 33:offset + 33 + name_len]
+        if not flags & 0x2 and \
+                normalize(file_name.decode('ascii', 'replace')) == name:
+            start = file_extent * block_size
+            if start + file_size > len(data):
+                raise ValueError("%s extends past the end of the image" %
+                                 file_name)
+            return data[start:start + file_size]
+        offset += record_len
+    return None
+
+
+def parse_ovf_env(data):
+    '''
+    parse_ovf_env returns a dictionary of the values of the guestinfo.*
+    properties in the OVF environment document data, keyed without the
+    "guestinfo." prefix
+    '''
+    from xml.etree import ElementTree
+    root = ElementTree.fromstring(data)
+    values = {}
+    for elem in root.iter():
+        if elem.tag.rsplit('}', 1)[-1] != 'Property':
+            continue
+        key = value = None
+        for attr, val in elem.attrib.items():
+            attr = attr.rsplit('}', 1)[-1]
+            if attr == 'key':
+                key = val
+            elif attr == 'value':
+                value = val
+        if key and key.startswith('guestinfo.') and value is not None:
+            values[key[len('guestinfo.'):]] = value
+    return values
+
+
+_SEED_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_SEED'
+_SEED_CDROM_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_SEED_CDROM'
+_TRANSPORT_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_TRANSPORT'
+_TRANSPORT_PRIORITY = (VMWARE_SEED, VMWARE_RPCI, VMWARE_RPCTOOL)
+_TRANSPORT = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+def get_seed_paths():
+    '''
+    get_seed_paths returns the paths that are searched for a seed, which
+    are /var/lib/cloud/seed/vmware-guestinfo unless the environment
+    variable CLOUD_INIT_VMWARE_GUEST_INFO_SEED names one or more paths,
+    separated by colons. /dev/sr0 is searched as well if the environment
+    variable CLOUD_INIT_VMWARE_GUEST_INFO_SEED_CDROM is true, since the
+    seed transport is used ahead of the backdoor.
+    '''
+    val = os.getenv(_SEED_ENV_VAR)
+    if val:
+        return [path for path in val.split(os.pathsep) if path]
+    paths = list(GUESTINFO_SEED_PATHS)
+    if util.is_true(os.getenv(_SEED_CDROM_ENV_VAR)):
+        paths.append(GUESTINFO_SEED_CDROM)
+    return paths
+
+
+def get_transport_priority():
+    '''
+    get_transport_priority returns the names of the transports that may be
+    used, fastest first. The environment variable
+    CLOUD_INIT_VMWARE_GUEST_INFO_TRANSPORT may be set to a comma-separated
+    list of vmware-seed, vmware-rpci, and vmware-rpctool to select the
+    transports and their order.
+    '''
+    val = os.getenv(_TRANSPORT_ENV_VAR)
+    if not val:
+        return list(_TRANSPORT_PRIORITY)
+    names = []
+    for name in val.split(','):
+        name = name.strip()
+        if name in _TRANSPORT_PRIORITY:
+            names.append(name)
+        elif name:
+            LOG.warning("invalid %s: %s", _TRANSPORT_ENV_VAR, name)
+    return names
+
+
+def new_transport():
+    '''
+    new_transport returns the first transport in the order given by
+    get_transport_priority that is available, or None. The seed transport
+    sends its writes with the first backdoor transport that is available.
+    '''
+    priority = get_transport_priority()
+    backdoor = new_backdoor_transport(
+        [name for name in priority if name != VMWARE_SEED])
+    for name in priority:
+        if name == VMWARE_SEED:
+            seed = SeedTransport.load(get_seed_paths(), backdoor)
+            if seed:
+                return seed
+        elif backdoor and name == backdoor.name:
+            return backdoor
+    return None
+
+
+def new_backdoor_transport(names=(VMWARE_RPCI, VMWARE_RPCTOOL)):
+    '''
+    new_backdoor_transport returns a transport for the VMware backdoor,
+    trying the in-process RPCI channel and vmware-rpctool in the order
+    given by names, or None if neither is available
+    '''
+    for name in names:
+        if name == VMWARE_RPCI:
+            try:
+                transport = RpciTransport.load()
+                if transport:
+                    transport.open()
+                    LOG.debug("using in-process rpci channel")
+                    return transport
+            except Exception as error:
+                LOG.debug("rpci channel unavailable: %s", error)
+        elif name == VMWARE_RPCTOOL:
+            path = which(VMWARE_RPCTOOL)
+            if path:
+                return RpcToolTransport(path)
+    return None
+
+
+def get_transport():
+    '''
+    get_transport returns the transport used to access guestinfo, or None
+    if no transport is available. The transport is created once with
+    new_transport and reused for the lifetime of the process.
+    '''
+    global _TRANSPORT
+    if os.environ.get(VMX_GUESTINFO, ""):
+        return EnvTransport()
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is None:
+            _TRANSPORT = new_transport() or False
+        return _TRANSPORT or None
+
+
+def set_transport(transport):
+    '''
+    set_transport replaces the transport returned by get_transport, closing
+    the previous one. Pass None to select a transport again on next use.
+    '''
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT:
+            _TRANSPORT.close()
+        _TRANSPORT = transport
+    with _GUESTINFO_KNOWN_LOCK:
+        _GUESTINFO_KNOWN.clear()
+
+
+def get_data_access_method():
+    '''
+    get_data_access_method returns the name of the transport used to access
+    guestinfo: VMX_GUESTINFO, VMWARE_SEED, VMWARE_RPCI or VMWARE_RPCTOOL.
+    None is returned if guestinfo cannot be accessed.
+    '''
+    transport = get_transport()
+    if transport:
+        return transport.name
+    return None
+
+
+_MAX_WORKERS = 8
+
+# The number of guestinfo values that are decoded at once. zlib releases
+# the GIL while it inflates, so compressed values are decoded in parallel.
+_DECODE_WORKERS = 3
+
+
+def map_concurrently(func, items, max_workers=_MAX_WORKERS):
+    '''
+    map_concurrently returns the list [func(item) for item in items], with
+    func called from up to max_workers threads at once. The first exception
+    raised by func, if any, is raised once all of the items are processed.
+    '''
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    pending = collections.deque(enumerate(items))
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as error:
+                errors.append(error)
+
+    threads = []
+    for _ in range(min(max_workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+class BackgroundCall(object):
+    '''
+    BackgroundCall calls func(*args) on a new thread. The thread is not a
+    daemon, so the call is allowed to complete before the process exits.
+    '''
+
+    def __init__(self, func, *args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func, args))
+        self._thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception as error:
+            self._error = error
+
+    def result(self):
+        '''
+        result waits for the call to complete and returns its result, or
+        raises the exception that it raised
+        '''
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+_MERGE_STRATEGY_ENV_VAR = 'CLOUD_INIT_VMWARE_GUEST_INFO_MERGE_STRATEGY'
+_MERGE_STRATEGY_DEEPMERGE = 'deepmerge'
+_MERGE_STRATEGY_STDLIB = 'stdlib'
+_MERGE_STRATEGY_REPLACE = 'replace'
+_MERGE_STRATEGY_APPEND = 'append'
+_MERGE_STRATEGY_UNIQUE = 'unique'
+_LIST_MERGE_STRATEGIES = (
+    _MERGE_STRATEGY_REPLACE, _MERGE_STRATEGY_APPEND, _MERGE_STRATEGY_UNIQUE)
+_DEEP_MERGER = None
+
+
+def merge_dicts(a, b):
+    '''
+    merge_dicts returns the result of merging a into b. The strategy is
+    selected with the environment variable
+    CLOUD_INIT_VMWARE_GUEST_INFO_MERGE_STRATEGY, which may be set to
+    replace (the default), append, or unique to select how lists are
+    merged by merge_dicts_with_sharing, or to deepmerge or stdlib.
+    '''
+    merge_strategy = os.getenv(_MERGE_STRATEGY_ENV_VAR) or \
+        _MERGE_STRATEGY_REPLACE
+    if merge_strategy == _MERGE_STRATEGY_DEEPMERGE:
+        try:
+            LOG.info('merging dictionaries with deepmerge strategy')
+            return merge_dicts_with_deep_merge(a, b)
+        except Exception as err:
+            LOG.error("deep merge failed: %s" % err)
+        merge_strategy = _MERGE_STRATEGY_REPLACE
+    if merge_strategy == _MERGE_STRATEGY_STDLIB:
+        LOG.info('merging dictionaries with stdlib strategy')
+        return merge_dicts_with_stdlib(a, b)
+    if merge_strategy not in _LIST_MERGE_STRATEGIES:
+        LOG.warning("invalid %s: %s", _MERGE_STRATEGY_ENV_VAR, merge_strategy)
+        merge_strategy = _MERGE_STRATEGY_REPLACE
+    LOG.info('merging dictionaries with %s list strategy', merge_strategy)
+    return merge_dicts_with_sharing(a, b, merge_strategy)
 
 
 def merge_dicts_with_deep_merge(a, b):
-    from deepmerge import always_merger
-    return always_merger.merge(a, b)
+    global _DEEP_MERGER
+    if _DEEP_MERGER is None:
+        from deepmerge import always_merger
+        _DEEP_MERGER = always_merger
+    return _DEEP_MERGER.merge(a, b)
 
 
 def merge_dicts_with_stdlib(a, b):
@@ -760,6 +3641,61 @@ def merge_dicts_with_stdlib(a, b):
     return b
 
 
+def merge_dicts_with_sharing(a, b, list_strategy=_MERGE_STRATEGY_REPLACE):
+    '''
+    merge_dicts_with_sharing returns a new dictionary with the values of a
+    merged into those of b, with the values from a taking precedence.
+    Neither a nor b is modified. Values that are not merged are shared
+    with the result rather than copied, so only the dictionaries along the
+    paths where a and b overlap are copied.
+
+    Lists present in both a and b are merged according to list_strategy:
+    replace uses the list from a, append appends the items of a to those
+    of b, and unique appends only the items of a that are not in b.
+    '''
+    result = dict(b)
+    for key, value in a.items():
+        other = result.get(key)
+        if other is value:
+            continue
+        if isinstance(value, Mapping) and isinstance(other, Mapping):
+            value = merge_dicts_with_sharing(value, other, list_strategy)
+        elif list_strategy != _MERGE_STRATEGY_REPLACE and \
+                isinstance(value, list) and isinstance(other, list):
+            value = merge_lists(value, other, list_strategy)
+        result[key] = value
+    return result
+
+
+def merge_lists(a, b, list_strategy):
+    '''
+    merge_lists returns a new list with the items of a appended to those of
+    b. If list_strategy is unique then only the items of a that are not
+    already in the result are appended.
+    '''
+    if list_strategy != _MERGE_STRATEGY_UNIQUE:
+        return b + a
+    result = list(b)
+    seen = set()
+    for item in b:
+        try:
+            seen.add(item)
+        except TypeError:
+            pass
+    for item in a:
+        try:
+            if item in seen:
+                continue
+            seen.add(item)
+        except TypeError:
+            # Unhashable items, such as dictionaries, are compared with
+            # every item in the result instead.
+            if item in result:
+                continue
+        result.append(item)
+    return result
+
+
 def main():
     '''
     Executed when this file is used as a program.
@@ -775,7 +3711,384 @@ def main():
     print(util.json_dumps(metadata))
 
 
+_WATCH_INTERVAL = 60
+
+
+class GuestInfoWatcher(object):
+    '''
+    GuestInfoWatcher detects changes to the metadata of a running VM. When
+    guestinfo.revision is set, each poll fetches only the revision, and the
+    metadata is fetched again only when the revision changes. Otherwise the
+    raw metadata is fetched and compared by digest, so it is decoded and
+    loaded again only when it changes.
+    '''
+
+    def __init__(self):
+        self.revision = None
+        self.metadata = None
+        self.metadata_format = None
+        self.entries = {}
+        self.network_cache = {}
+
+    def poll(self):
+        '''
+        poll returns the metadata if it changed since the last poll, or
+        None if it did not. The first poll that succeeds always returns the
+        metadata. A poll that fails does not update the watcher's state.
+        '''
+        revision = get_guestinfo_value(GUESTINFO_REVISION)
+        if revision and revision == self.revision:
+            return None
+
+        entry = self.entries.get('metadata') or {}
+        digest = entry.get('digest')
+        values = guestinfo_many(
+            ['metadata'], self.entries, raw_keys=[GUESTINFO_METADATA_FORMAT])
+        metadata_format = values[GUESTINFO_METADATA_FORMAT]
+        if self.metadata is not None and \
+                self.entries['metadata']['digest'] == digest and \
+                metadata_format == self.metadata_format:
+            self.revision = revision
+            return None
+
+        LOG.debug("guestinfo.metadata changed")
+        self.metadata = load_metadata(values, self.network_cache)
+        self.metadata_format = metadata_format
+        self.revision = revision
+        return self.metadata
+
+
+def new_watch_handlers(distro, cfg):
+    '''
+    new_watch_handlers returns a dictionary of the functions that re-apply
+    a changed metadata key, keyed by the metadata key. Each function is
+    called with the new metadata. The public SSH keys are added to the
+    default user in the cloud-init config cfg.
+    '''
+    def apply_network(metadata):
+        LOG.info("applying the changed network config")
+        distro.apply_network_config(
+            metadata['network']['config'], bring_up=True)
+
+    def apply_public_keys(metadata):
+        from cloudinit import ssh_util
+        from cloudinit.distros import ug_util
+        users, _ = ug_util.normalize_users_groups(cfg, distro)
+        user, _ = ug_util.extract_default(users)
+        if not user:
+            LOG.warning("no default user to add the public keys to")
+            return
+        LOG.info("adding the changed public keys to user %s", user)
+        ssh_util.setup_user_keys(set(get_public_ssh_keys(metadata)), user)
+
+    return {
+        'network': apply_network,
+        PUBLIC_KEYS_DATA: apply_public_keys,
+    }
+
+
+def watch(handlers, interval=_WATCH_INTERVAL, iterations=None):
+    '''
+    watch polls guestinfo every interval seconds and, when the metadata
+    changes, calls the handler for each metadata key whose value changed.
+    Keys that were removed from the metadata are not handled. The polls
+    are spread with random jitter so that the VMs on a host do not poll in
+    lockstep. If iterations is not None then at most that many polls are
+    made after the first.
+
+    Changes are detected against the metadata from the first poll that
+    succeeds. A poll that fails is logged and retried after the next
+    interval.
+    '''
+    watcher = GuestInfoWatcher()
+    metadata = None
+    LOG.info("watching guestinfo every %s seconds", interval)
+
+    wait = random.uniform(0, interval)
+    while True:
+        try:
+            changed = watcher.poll()
+        except Exception:
+            util.logexc(LOG, "Failed to check guestinfo for changes")
+            changed = None
+        if changed is not None and metadata is None:
+            metadata = changed
+        elif changed is not None:
+            if changed.get('instance-id') != metadata.get('instance-id'):
+                LOG.warning("the instance-id changed, which is only "
+                            "applied by cloud-init on the next boot")
+            for key, handler in handlers.items():
+                if key in changed and changed[key] != metadata.get(key):
+                    try:
+                        handler(changed)
+                    except Exception:
+                        util.logexc(LOG, "Failed to apply the changed %s", key)
+            metadata = changed
+        if iterations is not None:
+            if iterations <= 0:
+                break
+            iterations -= 1
+        time.sleep(wait)
+        wait = interval * random.uniform(0.9, 1.1)
+
+
+def watch_main(args=None):
+    '''
+    Executed when this file is used as a program with the argument "watch".
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='DataSourceVMwareGuestInfo.py watch',
+        description='Re-apply the network config and public SSH keys when '
+                    'they change in guestinfo.')
+    parser.add_argument(
+        '--interval', type=float, default=_WATCH_INTERVAL,
+        help='seconds between checks for changes (default: %(default)s)')
+    args = parser.parse_args(args)
+    try:
+        logging.setupBasicLogging()
+    except Exception:
+        pass
+
+    from cloudinit import stages
+    init = stages.Init()
+    init.read_cfg()
+    watch(new_watch_handlers(init.distro, init.cfg), args.interval)
+
+
+GUESTINFO_LOCAL_INTERFACES = 'local-interfaces'
+_AGENT_GROUPS = RTMGRP_LINK | NetlinkMonitor.GROUPS
+_AGENT_MSG_TYPES = (
+    RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR,
+    RTM_NEWROUTE, RTM_DELROUTE)
+_AGENT_DEBOUNCE = 1
+_AGENT_MAX_DELAY = 5
+_AGENT_MIN_INTERVAL = 5
+_AGENT_RECHECK_INTERVAL = 300
+_AGENT_POLL_INTERVAL = 30
+
+
+class AddressAgent(object):
+    '''
+    AddressAgent keeps the host's addresses in guestinfo up to date. Its
+    snapshot of the network interfaces is updated only for the interfaces
+    that netlink reports as changed, and the default addresses are only
+    computed again when a route or an interface changed. The default
+    addresses and the interface map are published only when they change.
+    '''
+
+    def __init__(self, config=None):
+        self.config = config
+        self.snapshot = None
+        self.index_names = {}
+        self.default_addrs = (None, None)
+        self.published = None
+        self.dirty = False
+
+    def get_changed_names(self, changes):
+        '''
+        get_changed_names returns the names of the interfaces in changes,
+        or None if they cannot be determined and a new snapshot is needed
+        '''
+        if changes is None or self.snapshot is None or changes.overflow:
+            return None
+        if_indextoname = getattr(socket, 'if_indextoname', None)
+        if not if_indextoname:
+            return None
+        names = []
+        for index in changes.indexes:
+            try:
+                name = if_indextoname(index)
+            except (OSError, socket.error):
+                # The interface was removed, so its name is only known if
+                # it was seen before.
+                name = self.index_names.pop(index, None)
+                if name is None:
+                    return None
+                names.append(name)
+                continue
+            old_name = self.index_names.get(index)
+            if old_name and old_name != name:
+                names.append(old_name)
+            self.index_names[index] = name
+            names.append(name)
+        return names
+
+    def refresh(self, changes=None):
+        '''
+        refresh updates the snapshot of the network interfaces and the
+        default addresses for the provided NetlinkChanges, or takes a new
+        snapshot if changes is None. True is returned if anything that is
+        published changed.
+        '''
+        names = self.get_changed_names(changes)
+        if names is None:
+            snapshot = get_interface_snapshot(config=self.config)
+            routes = True
+        else:
+            snapshot = collections.OrderedDict(self.snapshot)
+            update = get_interface_snapshot(names, self.config)
+            for name in names:
+                if name in update:
+                    snapshot[name] = update[name]
+                else:
+                    snapshot.pop(name, None)
+            routes = changes.routes
+        TIMING.incr('agent.refresh')
+
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        if changed or routes:
+            default_addrs = get_default_ip_addrs(snapshot)
+            changed = changed or default_addrs != self.default_addrs
+            self.default_addrs = default_addrs
+        self.dirty = self.dirty or changed
+        return changed
+
+    def publish(self):
+        '''
+        publish writes the default addresses to guestinfo.local-ipv4 and
+        guestinfo.local-ipv6, and the interface map as gzip+base64 JSON to
+        guestinfo.local-interfaces, skipping any that are unchanged. A
+        dictionary of the keys that could not be written, mapped to the
+        reason, is returned.
+        '''
+        host_info = get_host_info(
+            self.snapshot, self.config, '', self.default_addrs)
+        writer = GuestInfoWriter()
+        for key in (LOCAL_IPV4, LOCAL_IPV6):
+            if host_info.get(key):
+                writer.set(key, host_info[key])
+            else:
+                writer.clear(key)
+
+        interfaces = json.dumps(
+            host_info['network']['interfaces'],
+            sort_keys=True, separators=(',', ':'))
+        if interfaces != self.published:
+            writer.set(
+                GUESTINFO_LOCAL_INTERFACES, encode_gzip_base64(interfaces))
+            writer.set(GUESTINFO_LOCAL_INTERFACES + '.encoding', 'gzip+base64')
+
+        failures = writer.flush()
+        for key, error in failures.items():
+            LOG.error("failed to publish guestinfo.%s: %s", key, error)
+        if not failures:
+            self.published = interfaces
+            self.dirty = False
+            TIMING.incr('agent.publish')
+        return failures
+
+
+def encode_gzip_base64(data):
+    '''
+    encode_gzip_base64 returns data compressed with gzip and encoded with
+    base64. The gzip header omits the modification time, so equal data is
+    always encoded the same way.
+    '''
+    import zlib
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    compressed = compressor.compress(data) + compressor.flush()
+    return base64.b64encode(compressed).decode('ascii')
+
+
+def run_agent(agent, debounce=_AGENT_DEBOUNCE, max_delay=_AGENT_MAX_DELAY,
+              min_interval=_AGENT_MIN_INTERVAL, iterations=None):
+    '''
+    run_agent publishes the host's addresses with agent and then keeps them
+    up to date. Once netlink reports a change, further changes are
+    collected until none are reported for debounce seconds, or for at most
+    max_delay seconds, and publishes are at least min_interval seconds
+    apart. The network is also checked in full every five minutes in case
+    a notification was missed, or every 30 seconds if netlink is not
+    available. If iterations is not None then at most that many updates
+    are made.
+    '''
+    monitor = NetlinkMonitor.open(_AGENT_GROUPS, _AGENT_MSG_TYPES)
+    if not monitor:
+        LOG.warning("netlink is not available, checking the network every "
+                    "%s seconds", _AGENT_POLL_INTERVAL)
+    agent.refresh()
+    agent.publish()
+    last_publish = time.time()
+    try:
+        while iterations is None or iterations > 0:
+            if iterations is not None:
+                iterations -= 1
+            changes = None
+            if monitor:
+                changes = monitor.wait_changes(_AGENT_RECHECK_INTERVAL)
+                if not changes:
+                    changes = None
+                deadline = time.time() + max_delay
+                while changes is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not monitor.wait_changes(
+                            min(debounce, remaining), changes):
+                        break
+            else:
+                time.sleep(_AGENT_POLL_INTERVAL)
+
+            delay = last_publish + min_interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                if changes is not None:
+                    monitor.read_changes(changes)
+
+            agent.refresh(changes)
+            if agent.dirty:
+                agent.publish()
+                last_publish = time.time()
+    finally:
+        if monitor:
+            monitor.close()
+
+
+def agent_main(args=None):
+    '''
+    Executed when this file is used as a program with the argument "agent".
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='DataSourceVMwareGuestInfo.py agent',
+        description='Publish the local addresses and network interfaces to '
+                    'guestinfo whenever they change.')
+    parser.add_argument(
+        '--debounce', type=float, default=_AGENT_DEBOUNCE,
+        help='seconds without changes before publishing '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--max-delay', type=float, default=_AGENT_MAX_DELAY,
+        help='the most seconds to wait for changes to settle '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--min-interval', type=float, default=_AGENT_MIN_INTERVAL,
+        help='the fewest seconds between publishes (default: %(default)s)')
+    args = parser.parse_args(args)
+    try:
+        logging.setupBasicLogging()
+    except Exception:
+        pass
+
+    from cloudinit import stages
+    init = stages.Init()
+    init.read_cfg()
+    ds_cfg = util.get_cfg_by_path(
+        init.cfg, ('datasource', DataSourceVMwareGuestInfo.dsname), {})
+    config = get_host_info_config(
+        ds_cfg.get(HOST_INFO), load_metadata().get(HOST_INFO))
+    run_agent(AddressAgent(config), args.debounce, args.max_delay,
+              args.min_interval)
+
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ['watch']:
+        watch_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['agent']:
+        agent_main(sys.argv[2:])
+    else:
+        main()
 
 # vi: ts=4 expandtab
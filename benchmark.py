@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+# Cloud-Init Datasource for VMware Guestinfo
+#
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+'''
+Benchmarks for the VMware GuestInfo datasource.
+
+The datasource is driven against a simulated guestinfo backend and a
+simulated set of network interfaces, so the benchmarks may be run on any
+host where cloud-init is installed. For each case the wall time, the number
+of subprocesses executed, and the peak memory allocated are reported.
+
+usage: python benchmark.py [-h] [--transport {local,rpctool,env,seed}]
+                           [--latency SECONDS] [--sizes BYTES,...]
+                           [--interfaces COUNT,...] [--json]
+                           [--import-budget MICROSECONDS]
+'''
+
+import argparse
+import base64
+import copy
+import gc
+import json
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from xml.sax.saxutils import quoteattr
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from cloudinit import helpers
+import netifaces
+import yaml
+
+import DataSourceVMwareGuestInfo as ds
+
+
+DEFAULT_SIZES = '1024,102400,1048576,10485760'
+DEFAULT_INTERFACES = '2,10,100,1000'
+IMPORT_CODE = '''
+import cloudinit.log, cloudinit.sources, cloudinit.util, cloudinit.safeyaml
+try:
+    import cloudinit.subp
+except ImportError:
+    pass
+import DataSourceVMwareGuestInfo
+'''
+MERGE_STRATEGIES = ('stdlib', 'deepmerge', 'replace', 'append', 'unique')
+
+FAKE_RPCTOOL = '''#!/bin/sh
+sleep %(latency)s
+case "$1" in
+"info-get guestinfo."*)
+  f="%(dir)s/${1#info-get guestinfo.}"
+  if [ -f "$f" ]; then cat "$f"; exit 0; fi
+  printf "No value found" 1>&2; exit 1;;
+"info-set guestinfo."*)
+  r="${1#info-set guestinfo.}"
+  printf '%%s' "${r#* }" > "%(dir)s/${r%%%% *}";;
+esac
+'''
+
+
+class FakeNetifaces(object):
+    '''
+    FakeNetifaces simulates the netifaces module for a host with count
+    interfaces, each with one IPv4 and two IPv6 addresses.
+    '''
+
+    AF_LINK = netifaces.AF_LINK
+    AF_INET = netifaces.AF_INET
+    AF_INET6 = netifaces.AF_INET6
+
+    def __init__(self, count):
+        self.addrs = {'lo': {
+            self.AF_LINK: [{'addr': '00:00:00:00:00:00'}],
+            self.AF_INET: [{'addr': '127.0.0.1', 'netmask': '255.0.0.0'}],
+        }}
+        for i in range(count):
+            self.addrs['eth%d' % i] = {
+                self.AF_LINK: [{'addr': '02:00:00:00:%02x:%02x' % (
+                    i // 256, i % 256)}],
+                self.AF_INET: [{
+                    'addr': '10.%d.%d.2' % (i // 256, i % 256),
+                    'netmask': '255.255.255.0',
+                    'broadcast': '10.%d.%d.255' % (i // 256, i % 256),
+                }],
+                self.AF_INET6: [
+                    {'addr': 'fd00::%x:2' % i,
+                     'netmask': 'ffff:ffff:ffff:ffff::/64'},
+                    {'addr': 'fe80::%x:1%%eth%d' % (i, i),
+                     'netmask': 'ffff:ffff:ffff:ffff::/64'},
+                ],
+            }
+
+    def interfaces(self):
+        return sorted(self.addrs)
+
+    def ifaddresses(self, name):
+        if name not in self.addrs:
+            raise ValueError("You must specify a valid interface name.")
+        return dict((fam, [dict(a) for a in addrs])
+                    for fam, addrs in self.addrs[name].items())
+
+    def gateways(self):
+        return {'default': {self.AF_INET: ('10.0.0.1', 'eth0')}}
+
+
+def new_payload(size):
+    '''
+    new_payload returns a cloud-config document of approximately size
+    bytes that compresses like typical user data
+    '''
+    rand = random.Random(size)
+    lines = ['#cloud-config', 'write_files:']
+    length = 0
+    while length < size:
+        line = '- path: /etc/bench/%08x\n  content: %s' % (
+            rand.getrandbits(32),
+            base64.b64encode(bytearray(
+                rand.getrandbits(8) for _ in range(48))).decode())
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+
+def encode(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    gz = compressor.compress(data.encode('utf-8')) + compressor.flush()
+    return base64.b64encode(gz).decode('ascii')
+
+
+def new_metadata(interfaces, fmt=ds.FORMAT_JSON):
+    '''
+    new_metadata returns metadata that configures interfaces network
+    interfaces, marshaled as fmt, either JSON or YAML
+    '''
+    ethernets = {}
+    for i in range(interfaces):
+        ethernets['nic%d' % i] = {
+            'match': {'name': 'eth%d' % i},
+            'addresses': ['10.%d.%d.2/24' % (i // 256, i % 256)],
+        }
+    metadata = {
+        'instance-id': 'bench',
+        'local-hostname': 'bench',
+        'network': encode(json.dumps({'version': 2, 'ethernets': ethernets})),
+        'network.encoding': 'gzip+base64',
+        'wait-on-network': {'ipv4': True},
+    }
+    if fmt == ds.FORMAT_YAML:
+        return yaml.safe_dump(metadata, default_flow_style=False)
+    return json.dumps(metadata)
+
+
+def new_guestinfo(size, interfaces, fmt=ds.FORMAT_JSON, with_format=False):
+    '''
+    new_guestinfo returns the guestinfo values for user data and vendor
+    data of size bytes and metadata in fmt that configures interfaces
+    network interfaces. If with_format is true, metadata.format is set.
+    '''
+    payload = encode(new_payload(size))
+    values = {
+        'metadata': new_metadata(interfaces, fmt),
+        'userdata': payload,
+        'userdata.encoding': 'gzip+base64',
+        'vendordata': payload,
+        'vendordata.encoding': 'gzip+base64',
+    }
+    if with_format:
+        values[ds.GUESTINFO_METADATA_FORMAT] = fmt
+    return values
+
+
+def new_ovf_env(values):
+    '''
+    new_ovf_env returns an OVF environment document with a guestinfo
+    property for each of the values
+    '''
+    props = ''.join(
+        '<Property oe:key=%s oe:value=%s/>' % (
+            quoteattr('guestinfo.' + key), quoteattr(val))
+        for key, val in sorted(values.items()))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Environment xmlns="http://schemas.dmtf.org/ovf/environment/1"'
+        ' xmlns:oe="http://schemas.dmtf.org/ovf/environment/1">'
+        '<PropertySection>%s</PropertySection></Environment>' % props)
+
+
+class Backend(object):
+    '''
+    Backend installs the simulated guestinfo values behind the selected
+    transport
+    '''
+
+    def __init__(self, transport, latency, tmpdir):
+        self.transport = transport
+        self.latency = latency
+        self.tmpdir = tmpdir
+        self.rpctool = os.path.join(tmpdir, 'vmware-rpctool')
+        self.values_dir = os.path.join(tmpdir, 'guestinfo')
+
+    def install(self, values):
+        os.environ.pop(ds.VMX_GUESTINFO, None)
+        for key in list(os.environ):
+            if key.startswith('VMX_GUESTINFO_'):
+                del os.environ[key]
+        if self.transport == 'local':
+            ds.set_transport(
+                ds.LocalBackdoorTransport(values, self.latency))
+        elif self.transport == 'env':
+            os.environ[ds.VMX_GUESTINFO] = '1'
+            for key, val in values.items():
+                env_key = ('vmx.guestinfo.' + key).upper().replace('.', '_')
+                os.environ[env_key] = val
+        elif self.transport == 'seed':
+            shutil.rmtree(self.values_dir, ignore_errors=True)
+            os.makedirs(self.values_dir)
+            with open(os.path.join(self.values_dir, ds.OVF_ENV_FILE), 'w') as f:
+                f.write(new_ovf_env(values))
+            ds.set_transport(ds.SeedTransport.load([self.values_dir]))
+        else:
+            shutil.rmtree(self.values_dir, ignore_errors=True)
+            os.makedirs(self.values_dir)
+            for key, val in values.items():
+                with open(os.path.join(self.values_dir, key), 'w') as f:
+                    f.write(val)
+            with open(self.rpctool, 'w') as f:
+                f.write(FAKE_RPCTOOL % {
+                    'latency': self.latency, 'dir': self.values_dir})
+            os.chmod(self.rpctool, stat.S_IRWXU)
+            ds.set_transport(ds.RpcToolTransport(self.rpctool))
+
+
+def measure_import():
+    '''
+    measure_import returns the microseconds spent importing the datasource
+    in a new interpreter, as reported by python -X importtime. The modules
+    that cloud-init imports before it imports any datasource are imported
+    first, so only the cost added by the datasource is measured.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(ds.__file__))] + sys.path)
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', IMPORT_CODE],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    _, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', 'replace'))
+    for line in stderr.decode('utf-8').splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == ds.__name__:
+            return int(fields[1])
+    raise RuntimeError('%s not found in importtime output' % ds.__name__)
+
+
+def measure(func):
+    '''
+    measure returns the wall time, subprocess count, and peak memory in
+    bytes of calling func
+    '''
+    gc.collect()
+    ds.TIMING.reset()
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    func()
+    wall = time.time() - start
+    peak = 0
+    if tracemalloc:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return wall, ds.TIMING.counters.get('subprocesses', 0), peak
+
+
+def new_datasource(tmpdir, cache=False):
+    paths = helpers.Paths({
+        'cloud_dir': os.path.join(tmpdir, 'cloud'),
+        'run_dir': os.path.join(tmpdir, 'run'),
+    })
+    sys_cfg = {'datasource': {'VMwareGuestInfo': {'cache': cache}}}
+    source = ds.DataSourceVMwareGuestInfo(sys_cfg, None, paths)
+    source.persist_instance_data = lambda: None
+    return source
+
+
+def install_vendordata_ref(backend, values, tmpdir):
+    '''
+    install_vendordata_ref stores the decoded vendor data in a local content
+    store and installs values with guestinfo.vendordata.ref in place of
+    guestinfo.vendordata
+    '''
+    vendordata = ds.decode('vendordata', 'gzip+base64', values['vendordata'])
+    digest = ds.get_text_digest(ds.normalize_ref_text(vendordata))
+    store = os.path.join(tmpdir, 'store')
+    if not os.path.isdir(os.path.join(store, 'sha256')):
+        os.makedirs(os.path.join(store, 'sha256'))
+    with open(os.path.join(store, 'sha256', digest), 'w') as f:
+        f.write(vendordata)
+    os.environ[ds._STORE_ENV_VAR] = store
+
+    values = dict(values)
+    del values['vendordata']
+    del values['vendordata.encoding']
+    values['vendordata.ref'] = 'sha256:' + digest
+    backend.install(values)
+
+
+def get_merge_strategies():
+    '''
+    get_merge_strategies returns the merge strategies to measure, skipping
+    deepmerge if it is not installed
+    '''
+    try:
+        import deepmerge
+    except ImportError:
+        return [s for s in MERGE_STRATEGIES if s != 'deepmerge']
+    return list(MERGE_STRATEGIES)
+
+
+def new_merge(strategy, a, b):
+    '''
+    new_merge returns a function that merges a into b with strategy. The
+    stdlib and deepmerge strategies modify their arguments, so they are
+    given copies that are made before the function is measured.
+    '''
+    if strategy == 'stdlib':
+        b = copy.deepcopy(b)
+        return lambda: ds.merge_dicts_with_stdlib(a, b)
+    if strategy == 'deepmerge':
+        a = copy.deepcopy(a)
+        return lambda: ds.merge_dicts_with_deep_merge(a, b)
+    return lambda: ds.merge_dicts_with_sharing(a, b, strategy)
+
+
+def get_data(source):
+    '''
+    get_data calls source.get_data and waits for the user data and vendor
+    data that it fetches in the background
+    '''
+    result = source.get_data()
+    source.wait_for_guestinfo()
+    return result
+
+
+def run(args, tmpdir):
+    backend = Backend(args.transport, args.latency, tmpdir)
+    sizes = [int(v) for v in args.sizes.split(',')]
+    counts = [int(v) for v in args.interfaces.split(',')]
+    merge_strategies = get_merge_strategies()
+    results = [{
+        'name': 'import', 'param': 0, 'wall': measure_import() / 1e6,
+        'subprocesses': 1, 'peak': 0,
+    }]
+
+    def record(name, param, func):
+        wall, subprocesses, peak = measure(func)
+        results.append({
+            'name': name, 'param': param, 'wall': wall,
+            'subprocesses': subprocesses, 'peak': peak,
+        })
+
+    try:
+        for size in sizes:
+            values = new_guestinfo(size, 2)
+            payload = values['userdata']
+            record('decode', size, lambda: ds.decode(
+                'userdata', 'gzip+base64', payload))
+
+            backend.install(values)
+            record('get_data', size, lambda: get_data(new_datasource(tmpdir)))
+            record('get_data (metadata only)', size,
+                   lambda: new_datasource(tmpdir).get_data())
+            decode_workers = ds._DECODE_WORKERS
+            ds._DECODE_WORKERS = 1
+            try:
+                record('get_data (serial decode)', size,
+                       lambda: get_data(new_datasource(tmpdir)))
+            finally:
+                ds._DECODE_WORKERS = decode_workers
+
+            install_vendordata_ref(backend, values, tmpdir)
+            record('get_data (vendordata ref)', size,
+                   lambda: get_data(new_datasource(tmpdir)))
+            os.environ.pop(ds._STORE_ENV_VAR)
+            backend.install(values)
+
+            get_data(new_datasource(tmpdir, cache=True))
+            record('get_data (warm cache)', size,
+                   lambda: get_data(new_datasource(tmpdir, cache=True)))
+            shutil.rmtree(os.path.join(tmpdir, 'cloud'), ignore_errors=True)
+
+        for count in counts:
+            sys.modules['netifaces'] = FakeNetifaces(count)
+            for fmt in (ds.FORMAT_JSON, ds.FORMAT_YAML):
+                for with_format in (False, True):
+                    backend.install(
+                        new_guestinfo(1024, count, fmt, with_format))
+                    name = 'load_metadata (%s%s)' % (
+                        fmt, ', metadata.format' if with_format else '')
+                    record(name, count, lambda: ds.load_metadata())
+
+            values = new_guestinfo(1024, count)
+            backend.install(values)
+            record('get_host_info', count, lambda: ds.get_host_info())
+
+            host_info = ds.get_host_info()
+            metadata = ds.load_metadata()
+            for strategy in merge_strategies:
+                record('merge_dicts (%s)' % strategy, count,
+                       new_merge(strategy, metadata, host_info))
+
+            source = new_datasource(tmpdir)
+            get_data(source)
+            record('setup', count, lambda: source.setup(True))
+    finally:
+        sys.modules['netifaces'] = netifaces
+        ds.set_transport(None)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--transport', choices=('local', 'rpctool', 'env', 'seed'),
+        default='local',
+        help='the simulated guestinfo backend (default: local)')
+    parser.add_argument(
+        '--latency', type=float, default=0.001,
+        help='seconds of latency added to each guestinfo command')
+    parser.add_argument(
+        '--sizes', default=DEFAULT_SIZES,
+        help='comma-separated payload sizes in bytes')
+    parser.add_argument(
+        '--interfaces', default=DEFAULT_INTERFACES,
+        help='comma-separated interface counts')
+    parser.add_argument(
+        '--json', action='store_true', help='print the results as JSON')
+    parser.add_argument(
+        '--import-budget', type=int, metavar='MICROSECONDS',
+        help='only check that importing the datasource takes at most '
+             'MICROSECONDS, exiting with a non-zero status if not')
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        import_time = measure_import()
+        print('import %s: %d us (budget %d us)' % (
+            ds.__name__, import_time, args.import_budget))
+        if import_time > args.import_budget:
+            sys.exit(1)
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix='guestinfo-bench-')
+    try:
+        results = run(args, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    width = max(len(result['name']) for result in results)
+    print('%-*s %10s %12s %6s %12s' % (
+        width, 'benchmark', 'param', 'wall (ms)', 'procs', 'peak (KiB)'))
+    for result in results:
+        print('%-*s %10d %12.3f %6d %12d' % (
+            width, result['name'], result['param'], result['wall'] * 1000,
+            result['subprocesses'], result['peak'] // 1024))
+
+
+if __name__ == "__main__":
+    main()
+
+# vi: ts=4 expandtab
@@ -41,14 +41,109 @@ if [ -n "${VMX_GUESTINFO}" ]; then
   fi
 fi
 
+# An OVF environment baked into the image is read by the datasource without
+# using the backdoor.
+if [ -r /var/lib/cloud/seed/vmware-guestinfo/ovf-env.xml ]; then
+  exit 0
+fi
+
+# The values of the probed keys are recorded in this directory so the
+# datasource may reuse them rather than fetching them again.
+PROBE_DIR="/run/cloud-init/vmware-guestinfo-probe"
+
+# is_vmware returns success if the DMI data identifies the host as a VMware
+# VM. Only shell builtins are used so non-VMware hosts are ruled out without
+# executing any other programs.
+is_vmware() {
+  for dmi_file in /sys/class/dmi/id/sys_vendor /sys/class/dmi/id/product_name; do
+    dmi_val=""
+    if [ -r "${dmi_file}" ]; then
+      read -r dmi_val <"${dmi_file}"
+    fi
+    case "${dmi_val}" in
+    *[Vv][Mm][Ww][Aa][Rr][Ee]*)
+      return 0
+      ;;
+    esac
+  done
+  return 1
+}
+
+if ! is_vmware; then
+  exit 1
+fi
+
+# is_true returns success if the value is true the same way cloud-init's
+# util.is_true reads it.
+is_true() {
+  case "${1}" in
+  [Tt][Rr][Uu][Ee]|[Yy][Ee][Ss]|[Oo][Nn]|1)
+    return 0
+    ;;
+  esac
+  return 1
+}
+
+# is_cdrom_ovf returns success if the device holds an OVF environment with
+# guestinfo properties. The device is detected the same way ds-identify's
+# is_cdrom_ovf detects an OVF CD-ROM, such as the ISO 9660 image that
+# vSphere attaches for a vApp's OVF environment.
+is_cdrom_ovf() {
+  dev="${1}"
+  [ -b "${dev}" ] || return 1
+  command -v blkid >/dev/null 2>&1 || return 1
+  fs_type="$(blkid -c /dev/null -o value -s TYPE "${dev}" 2>/dev/null)"
+  [ "${fs_type}" = "iso9660" ] || return 1
+
+  label="$(blkid -c /dev/null -o value -s LABEL "${dev}" 2>/dev/null)"
+  case "${label}" in
+  OVF-TRANSPORT|ovf-transport|OVFENV|ovfenv|OVF\ ENV|ovf\ env)
+    ;;
+  config-2|CONFIG-2|rd_rdfe_stable*|cidata|CIDATA)
+    return 1
+    ;;
+  *)
+    # The size is in 512 byte sectors, and an OVF CD-ROM is under 10MB.
+    size=""
+    read -r size <"/sys/class/block/${dev##*/}/size" 2>/dev/null || return 1
+    [ "$((size / 2048))" -lt 10 ] || return 1
+    grep -q -i "http://schemas.dmtf.org/ovf/environment/1" "${dev}" || \
+      return 1
+    ;;
+  esac
+  grep -q "guestinfo\." "${dev}"
+}
+
+# The datasource only reads a seed on the CD-ROM when
+# CLOUD_INIT_VMWARE_GUEST_INFO_SEED_CDROM is true.
+if is_true "${CLOUD_INIT_VMWARE_GUEST_INFO_SEED_CDROM}" && \
+   is_cdrom_ovf /dev/sr0; then
+  exit 0
+fi
+
 if ! command -v vmware-rpctool >/dev/null 2>&1; then
   exit 1
 fi
 
-if { vmware-rpctool "info-get guestinfo.metadata" || \
-     vmware-rpctool "info-get guestinfo.userdata" || \
-     vmware-rpctool "info-get guestinfo.vendordata"; } >/dev/null 2>&1; then
-   exit 0
+umask 077
+rm -fr "${PROBE_DIR}"
+if ! mkdir -p "${PROBE_DIR}" 2>/dev/null; then
+  PROBE_DIR=""
 fi
 
+# Stop at the first key that has a value, which is usually the metadata, so
+# a single vmware-rpctool process is executed in the common case.
+for key in metadata userdata vendordata; do
+  out="/dev/null"
+  if [ -n "${PROBE_DIR}" ]; then
+    out="${PROBE_DIR}/${key}"
+  fi
+  if vmware-rpctool "info-get guestinfo.${key}" >"${out}" 2>/dev/null; then
+    exit 0
+  fi
+  if [ -n "${PROBE_DIR}" ]; then
+    rm -f "${out}"
+  fi
+done
+
 exit 1
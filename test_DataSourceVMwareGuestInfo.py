@@ -0,0 +1,1380 @@
+#!/usr/bin/env python
+
+# Cloud-Init Datasource for VMware Guestinfo
+#
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+'''
+Tests for the VMware GuestInfo datasource.
+
+The datasource is tested against the in-process LocalBackdoorTransport and
+fake sockets, so the tests may be run on any host where cloud-init is
+installed.
+
+usage: python test_DataSourceVMwareGuestInfo.py [-v]
+'''
+
+import base64
+import collections
+import copy
+import errno
+import json
+import os
+import pickle
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import unittest
+from xml.sax.saxutils import quoteattr
+
+from cloudinit import helpers
+
+import DataSourceVMwareGuestInfo as ds
+
+
+def new_ovf_env(values):
+    '''
+    new_ovf_env returns an OVF environment document with a guestinfo
+    property for each of the values
+    '''
+    props = ''.join(
+        '<Property oe:key=%s oe:value=%s/>' % (
+            quoteattr('guestinfo.' + key), quoteattr(val))
+        for key, val in sorted(values.items()))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Environment xmlns="http://schemas.dmtf.org/ovf/environment/1"'
+        ' xmlns:oe="http://schemas.dmtf.org/ovf/environment/1">'
+        '<PropertySection>%s</PropertySection></Environment>' % props)
+
+
+def pack_both(fmt, val):
+    '''
+    pack_both returns val packed in the ISO 9660 both-byte order format,
+    little-endian followed by big-endian
+    '''
+    return struct.pack('<' + fmt, val) + struct.pack('>' + fmt, val)
+
+
+def new_iso_dir_record(extent, size, flags, name):
+    '''
+    new_iso_dir_record returns an ISO 9660 directory record
+    '''
+    record_len = 33 + len(name) + (len(name) + 1) % 2
+    return (
+        struct.pack('<BB', record_len, 0) +
+        pack_both('I', extent) +
+        pack_both('I', size) +
+        b'\0' * 7 +
+        struct.pack('<BBB', flags, 0, 0) +
+        pack_both('H', 1) +
+        struct.pack('<B', len(name)) + name +
+        b'\0' * ((len(name) + 1) % 2))
+
+
+def new_iso_image(name, data):
+    '''
+    new_iso_image returns an ISO 9660 image with the file name in its root
+    directory, holding data. The root directory is in the block after the
+    primary volume descriptor and the file in the block after that.
+    '''
+    block = ds.ISO_SECTOR_SIZE
+    root_extent = ds.ISO_PVD_OFFSET // block + 1
+    file_extent = root_extent + 1
+    root = (
+        new_iso_dir_record(root_extent, block, 0x2, b'\0') +
+        new_iso_dir_record(root_extent, block, 0x2, b'\1') +
+        new_iso_dir_record(file_extent, len(data), 0, name))
+    pvd = bytearray(block)
+    pvd[0:7] = b'\1' + ds.ISO_STANDARD_ID + b'\1'
+    pvd[128:132] = pack_both('H', block)
+    pvd[156:190] = new_iso_dir_record(root_extent, block, 0x2, b'\0')
+    return (
+        b'\0' * ds.ISO_PVD_OFFSET + bytes(pvd) +
+        root + b'\0' * (block - len(root)) + data)
+
+
+def new_netlink_msg(msg_type, body):
+    '''
+    new_netlink_msg returns a netlink message of msg_type with body, padded
+    to a multiple of four bytes
+    '''
+    msg_len = ds.NLMSG_HDR_LEN + len(body)
+    msg = struct.pack(ds.NLMSG_HDR_FMT, msg_len, msg_type, 0, 0, 0) + body
+    return msg + b'\0' * (-msg_len % 4)
+
+
+def new_ifaddrmsg(index):
+    '''
+    new_ifaddrmsg returns an RTM_NEWADDR message for the interface index
+    '''
+    return new_netlink_msg(
+        ds.RTM_NEWADDR, struct.pack('=BBBBi', socket.AF_INET, 24, 0, 0, index))
+
+
+def new_ifinfomsg(msg_type, index):
+    '''
+    new_ifinfomsg returns an RTM_NEWLINK or RTM_DELLINK message for the
+    interface index
+    '''
+    return new_netlink_msg(
+        msg_type, struct.pack('=BxHiII', socket.AF_UNSPEC, 1, index, 0, 0))
+
+
+class FakeSocket(object):
+    '''
+    FakeSocket returns each of the queued datagrams from recv, and then
+    raises the queued error, or EAGAIN
+    '''
+
+    def __init__(self, datagrams, error=errno.EAGAIN):
+        self.datagrams = list(datagrams)
+        self.error = error
+        self.closed = False
+
+    def recv(self, size):
+        if self.datagrams:
+            return self.datagrams.pop(0)
+        raise socket.error(self.error, os.strerror(self.error))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock(object):
+    '''
+    FakeClock stands in for the time module, recording the calls to sleep
+    and advancing the time without waiting. After each sleep, the next of
+    steps, if any, is called.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self.steps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        if self.steps:
+            self.steps.pop(0)()
+
+
+class TestCase(unittest.TestCase):
+
+    def patch(self, obj, name, value):
+        '''
+        patch replaces the attribute name of obj with value until the test
+        ends
+        '''
+        self.addCleanup(setattr, obj, name, vars(obj)[name])
+        setattr(obj, name, value)
+
+
+class NetlinkMonitorTest(unittest.TestCase):
+
+    def read_changes(self, datagrams, error=errno.EAGAIN, msg_types=None):
+        monitor = ds.NetlinkMonitor(FakeSocket(datagrams, error), msg_types)
+        changes = ds.NetlinkChanges()
+        self.assertIs(monitor.read_changes(changes), changes)
+        self.assertEqual(monitor.sock.datagrams, [])
+        return changes
+
+    def test_addresses(self):
+        changes = self.read_changes([
+            new_ifaddrmsg(2) + new_ifaddrmsg(7),
+            new_ifaddrmsg(-1),
+        ])
+        self.assertEqual(changes.indexes, set([2, 7, -1]))
+        self.assertFalse(changes.routes)
+        self.assertFalse(changes.overflow)
+        self.assertTrue(changes)
+
+    def test_links(self):
+        changes = self.read_changes([
+            new_ifinfomsg(ds.RTM_NEWLINK, 3) +
+            new_ifinfomsg(ds.RTM_DELLINK, 4) +
+            new_ifaddrmsg(5),
+        ], msg_types=(ds.RTM_NEWLINK, ds.RTM_NEWADDR))
+        self.assertEqual(changes.indexes, set([3, 5]))
+        self.assertFalse(changes.overflow)
+
+    def test_routes(self):
+        changes = self.read_changes([
+            new_netlink_msg(ds.RTM_NEWROUTE, b'\0' * 12) + new_ifaddrmsg(2),
+        ])
+        self.assertTrue(changes.routes)
+        self.assertEqual(changes.indexes, set([2]))
+
+    def test_other_messages_are_ignored(self):
+        changes = self.read_changes([
+            new_netlink_msg(ds.RTM_DELADDR, b'\0' * 9),
+            new_ifinfomsg(ds.RTM_NEWLINK, 3),
+        ])
+        self.assertFalse(changes)
+
+    def test_short_message_overflows(self):
+        changes = self.read_changes([new_netlink_msg(ds.RTM_NEWADDR, b'\0')])
+        self.assertEqual(changes.indexes, set())
+        self.assertTrue(changes.overflow)
+
+    def test_invalid_length_stops_parsing(self):
+        msg = struct.pack(ds.NLMSG_HDR_FMT, 0, ds.RTM_NEWROUTE, 0, 0, 0)
+        changes = self.read_changes([msg + new_ifaddrmsg(2)])
+        self.assertTrue(changes.routes)
+        self.assertEqual(changes.indexes, set())
+
+    def test_dropped_notifications_overflow(self):
+        changes = self.read_changes([new_ifaddrmsg(2)], errno.ENOBUFS)
+        self.assertEqual(changes.indexes, set([2]))
+        self.assertTrue(changes.overflow)
+
+    def test_empty_read(self):
+        monitor = ds.NetlinkMonitor(FakeSocket([b'', new_ifaddrmsg(2)]))
+        self.assertFalse(monitor.read_changes(ds.NetlinkChanges()))
+        self.assertTrue(monitor.drain())
+
+    def test_wait_changes(self):
+        sock, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(peer.close)
+        sock.setblocking(False)
+        monitor = ds.NetlinkMonitor(sock)
+        self.addCleanup(monitor.close)
+        self.assertFalse(monitor.wait(0.01))
+
+        peer.send(new_ifaddrmsg(2))
+        peer.send(new_netlink_msg(ds.RTM_NEWROUTE, b''))
+        changes = ds.NetlinkChanges()
+        changes.indexes.add(1)
+        found = monitor.wait_changes(5, changes)
+        self.assertEqual(found.indexes, set([2]))
+        self.assertTrue(found.routes)
+        self.assertEqual(changes.indexes, set([1, 2]))
+        self.assertFalse(monitor.drain())
+
+
+class FakeNetlinkMonitor(object):
+    '''
+    FakeNetlinkMonitor records the timeouts that it is waited on with,
+    advancing clock by each of them
+    '''
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.waits = []
+        self.closed = False
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.clock.now += timeout
+        return False
+
+    def close(self):
+        self.closed = True
+
+
+class WaitOnNetworkTest(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.monitor = None
+        self.snapshots = []
+        self.patch(ds, 'time', self.clock)
+        self.patch(ds.NetlinkMonitor, 'open', self.open_monitor)
+        self.patch(ds, 'get_interface_snapshot', self.get_interface_snapshot)
+        self.patch(ds, 'get_hostname', lambda config, metadata: 'host')
+        self.patch(ds, 'get_host_info',
+                   lambda snapshot, config, hostname: snapshot)
+
+    def open_monitor(self):
+        return self.monitor
+
+    def get_interface_snapshot(self, dev_names, config):
+        if len(self.snapshots) > 1:
+            return self.snapshots.pop(0)
+        return self.snapshots[0]
+
+    def new_snapshot(self, *ipv4):
+        info = ds.InterfaceInfo(
+            'eth0', '00:50:56:00:00:01', [], [],
+            [{'addr': addr} for addr in ipv4], [])
+        return {'eth0': info}
+
+    def wait_on_network(self, **config):
+        config.setdefault('ipv4', True)
+        return ds.wait_on_network({'wait-on-network': config}, {})
+
+    def test_ready(self):
+        self.snapshots = [self.new_snapshot('10.0.0.2')]
+        self.assertEqual(self.wait_on_network(), self.snapshots[0])
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_poll_backs_off(self):
+        ready = self.new_snapshot('10.0.0.2')
+        self.snapshots = [self.new_snapshot()] * 4 + [ready]
+        result = self.wait_on_network(
+            interval=1, backoff=2, **{'max-interval': 5})
+        self.assertEqual(result, ready)
+        self.assertEqual(self.clock.sleeps, [1, 2, 4, 5])
+
+    def test_poll_times_out(self):
+        self.snapshots = [self.new_snapshot()]
+        result = self.wait_on_network(
+            timeout=10, interval=1, backoff=2, **{'max-interval': 4})
+        self.assertEqual(result, self.snapshots[0])
+        self.assertEqual(self.clock.sleeps, [1, 2, 4, 3])
+
+    def test_netlink_times_out(self):
+        self.monitor = FakeNetlinkMonitor(self.clock)
+        self.snapshots = [self.new_snapshot()]
+        self.wait_on_network(timeout=25, interval=1)
+        self.assertEqual(self.monitor.waits, [
+            ds._NETLINK_RECHECK_INTERVAL, ds._NETLINK_RECHECK_INTERVAL, 5])
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertTrue(self.monitor.closed)
+
+    def test_netlink_ready_on_change(self):
+        self.monitor = FakeNetlinkMonitor(self.clock)
+        ready = self.new_snapshot('10.0.0.2')
+        self.snapshots = [self.new_snapshot(), ready]
+        self.assertEqual(self.wait_on_network(timeout=25), ready)
+        self.assertEqual(self.monitor.waits, [ds._NETLINK_RECHECK_INTERVAL])
+        self.assertTrue(self.monitor.closed)
+
+
+class HostInfoTest(TestCase):
+
+    def setUp(self):
+        self.interfaces = {
+            'eth0': self.new_info(
+                'eth0', 1, ['10.0.0.2', '10.0.0.3', '10.0.0.4'], ['fd00::2']),
+            'eth1': self.new_info('eth1', 2, ['10.0.1.2', '10.0.1.3'], []),
+            'br0': self.new_info('br0', 3, ['10.0.2.2'], []),
+            'veth0': self.new_info('veth0', 4, ['10.0.3.2'], []),
+        }
+        self.patch(ds, 'get_interface_info', self.interfaces.get)
+        self.patch(ds, 'get_interface_type',
+                   lambda dev_name: 'bridge' if dev_name == 'br0' else None)
+        self.patch(ds, 'get_interface_driver',
+                   lambda dev_name: 'veth' if dev_name == 'veth0' else None)
+
+    def new_info(self, name, index, ipv4, ipv6):
+        ipv4 = [{'addr': addr} for addr in ipv4]
+        ipv6 = [{'addr': addr} for addr in ipv6]
+        return ds.InterfaceInfo(
+            name, '00:50:56:00:00:%02x' % index, ipv4, ipv6, ipv4, ipv6)
+
+    def get_addresses(self, **config):
+        config = ds.get_host_info_config(config)
+        snapshot = ds.get_interface_snapshot(['eth0', 'eth1'], config)
+        host_info = ds.get_host_info(snapshot, config, 'host', (None, None))
+        interfaces = host_info['network']['interfaces']
+        return list(interfaces['by-ipv4']), list(interfaces['by-ipv6'])
+
+    def test_max_addresses_config(self):
+        for val, expected in (
+                (None, None), (0, 0), ('3', 3), (-1, None), ('-1', None),
+                ('many', None), ([1], None)):
+            config = ds.get_host_info_config({'max-addresses': val})
+            self.assertEqual(config['max-addresses'], expected, repr(val))
+
+    def test_max_addresses(self):
+        all_ipv4 = ['10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.1.2', '10.0.1.3']
+        self.assertEqual(self.get_addresses(), (all_ipv4, ['fd00::2']))
+        self.assertEqual(self.get_addresses(**{'max-addresses': -1}),
+                         (all_ipv4, ['fd00::2']))
+        self.assertEqual(self.get_addresses(**{'max-addresses': 0}), ([], []))
+        self.assertEqual(self.get_addresses(**{'max-addresses': 1}),
+                         (all_ipv4[:1], ['fd00::2']))
+        self.assertEqual(self.get_addresses(**{'max-addresses': 4}),
+                         (all_ipv4[:4], ['fd00::2']))
+
+    def get_interfaces(self, **config):
+        config = ds.get_host_info_config(config)
+        return sorted(ds.get_interface_snapshot(
+            sorted(self.interfaces) + ['missing0'], config))
+
+    def test_interface_filters(self):
+        self.assertEqual(
+            self.get_interfaces(), ['br0', 'eth0', 'eth1', 'veth0'])
+        self.assertEqual(
+            self.get_interfaces(**{'include-interfaces': ['eth*', 'br0']}),
+            ['br0', 'eth0', 'eth1'])
+        self.assertEqual(
+            self.get_interfaces(**{'exclude-interfaces': 'eth1'}),
+            ['br0', 'eth0', 'veth0'])
+        self.assertEqual(
+            self.get_interfaces(**{
+                'include-interfaces': ['eth*'],
+                'exclude-interfaces': ['eth0'],
+            }),
+            ['eth1'])
+        self.assertEqual(
+            self.get_interfaces(**{
+                'exclude-types': ['bridge'],
+                'exclude-drivers': ['veth'],
+            }),
+            ['eth0', 'eth1'])
+
+
+class FqdnTest(TestCase):
+
+    def setUp(self):
+        self.patch(ds, '_FQDN_CACHE', {})
+        self.patch(ds, '_FQDN_PENDING', {})
+        self.patch(socket, 'getaddrinfo', self.getaddrinfo)
+        self.lookups = []
+        self.errors = []
+        self.release = threading.Event()
+        self.release.set()
+        self.addCleanup(self.release.set)
+
+    def getaddrinfo(self, name, *args):
+        self.lookups.append(name)
+        self.release.wait()
+        if self.errors:
+            raise self.errors.pop(0)
+        return [(socket.AF_INET, socket.SOCK_DGRAM, 0, name + '.example.com',
+                 ('10.0.0.2', 0))]
+
+    def test_cache_hit(self):
+        self.assertEqual(ds.getfqdn('host', 1), 'host.example.com')
+        self.assertEqual(ds.getfqdn(' host ', 1), 'host.example.com')
+        self.assertEqual(self.lookups, ['host'])
+
+    def test_failure_is_not_cached(self):
+        self.errors.append(socket.gaierror(socket.EAI_AGAIN, 'try again'))
+        self.assertEqual(ds.getfqdn('host', 1), 'host')
+        self.assertEqual(ds.getfqdn('host', 1), 'host.example.com')
+        self.assertEqual(ds.getfqdn('other', 1), 'other.example.com')
+        self.assertEqual(self.lookups, ['host', 'host', 'other'])
+
+    def test_timeout_shares_pending_lookup(self):
+        self.release.clear()
+        self.assertEqual(ds.getfqdn('host', 0.01), 'host')
+        self.assertEqual(ds.getfqdn('host', 0.01), 'host')
+        thread = ds._FQDN_PENDING['host']
+        self.release.set()
+        thread.join(5)
+        self.assertEqual(ds._FQDN_PENDING, {})
+        self.assertEqual(ds.getfqdn('host', 0.01), 'host.example.com')
+        self.assertEqual(self.lookups, ['host'])
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.host_info = {
+            'hostname': 'host',
+            'local-hostname': 'host',
+            'local-ipv4': '10.0.0.2',
+            'network': {
+                'interfaces': {
+                    'by-mac': {'00:50:56:00:00:01': {
+                        'ipv4': [{'addr': '10.0.0.2'}],
+                    }},
+                    'by-ipv4': {'10.0.0.2': {'mac': '00:50:56:00:00:01'}},
+                    'by-ipv6': {},
+                },
+            },
+            'tags': ['host', {'role': 'web'}],
+        }
+        self.fixtures = [
+            # The metadata merged by main, and the metadata of WatchTest.
+            {
+                'wait-on-network': {'ipv4': True, 'ipv6': 'false'},
+                'network': {'config': {'dhcp': True}},
+            },
+            {'instance-id': 'i-1', 'network': new_network_config('eth0')},
+            {
+                'local-hostname': 'metadata',
+                'network': {'interfaces': {'by-ipv6': {'fd00::2': {}}}},
+                'tags': [{'role': 'web'}, ['db'], 'metadata'],
+            },
+        ]
+
+    def merge(self, a, b, list_strategy):
+        a_copy, b_copy = copy.deepcopy(a), copy.deepcopy(b)
+        result = ds.merge_dicts_with_sharing(a, b, list_strategy)
+        self.assertEqual(a, a_copy)
+        self.assertEqual(b, b_copy)
+        return result
+
+    def test_matches_stdlib(self):
+        for metadata in self.fixtures:
+            expected = ds.merge_dicts_with_stdlib(
+                copy.deepcopy(metadata), copy.deepcopy(self.host_info))
+            self.assertEqual(
+                self.merge(metadata, self.host_info, 'replace'), expected)
+
+    def test_sharing(self):
+        metadata = self.fixtures[2]
+        result = self.merge(metadata, self.host_info, 'replace')
+        interfaces = result['network']['interfaces']
+        host_interfaces = self.host_info['network']['interfaces']
+        self.assertIsNot(result['network'], self.host_info['network'])
+        self.assertIsNot(interfaces, host_interfaces)
+        self.assertIs(interfaces['by-mac'], host_interfaces['by-mac'])
+        self.assertIs(interfaces['by-ipv4'], host_interfaces['by-ipv4'])
+        self.assertIs(interfaces['by-ipv6']['fd00::2'],
+                      metadata['network']['interfaces']['by-ipv6']['fd00::2'])
+        self.assertIs(result['tags'], metadata['tags'])
+
+        result = self.merge(self.fixtures[1], self.host_info, 'replace')
+        self.assertIs(result['network']['ethernets'],
+                      self.fixtures[1]['network']['ethernets'])
+        self.assertIs(result['network']['interfaces'],
+                      self.host_info['network']['interfaces'])
+
+    def test_list_strategies(self):
+        metadata = self.fixtures[2]
+        self.assertEqual(
+            self.merge(metadata, self.host_info, 'append')['tags'],
+            ['host', {'role': 'web'}, {'role': 'web'}, ['db'], 'metadata'])
+        self.assertEqual(
+            self.merge(metadata, self.host_info, 'unique')['tags'],
+            ['host', {'role': 'web'}, ['db'], 'metadata'])
+        self.assertEqual(
+            self.merge({'tags': ['host', ['db'], ['db']]}, self.host_info,
+                       'unique')['tags'],
+            ['host', {'role': 'web'}, ['db']])
+
+
+def new_compressor(enc_type):
+    '''
+    new_compressor returns a compressor for enc_type, or None if its module
+    is not installed
+    '''
+    if enc_type == 'gzip+base64':
+        import zlib
+        return zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    try:
+        if enc_type == 'xz+base64':
+            import lzma
+            return lzma.LZMACompressor()
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    except ImportError:
+        return None
+
+
+class RecordingDecompressor(object):
+    '''
+    RecordingDecompressor records the size of each output of decompressor
+    '''
+
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+        self.sizes = []
+
+    def decompress(self, *args):
+        data = self.decompressor.decompress(*args)
+        self.sizes.append(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.decompressor, name)
+
+
+class DecodeTest(unittest.TestCase):
+
+    ENC_TYPES = ('gzip+base64', 'xz+base64', 'zstd+base64')
+
+    def setUp(self):
+        self.text = u''.join(u'line %d\n' % i for i in range(12000))
+        self.encoded = ds.encode_gzip_base64(self.text)
+
+    def encode(self, enc_type, chunks):
+        compressor = new_compressor(enc_type)
+        if compressor is None:
+            return None
+        data = b''.join(compressor.compress(chunk) for chunk in chunks)
+        return base64.b64encode(data + compressor.flush()).decode('ascii')
+
+    def test_gzip(self):
+        self.assertEqual(
+            ds.decode('k', 'gzip+base64', self.encoded), self.text)
+
+    def test_encodings(self):
+        for enc_type in self.ENC_TYPES:
+            encoded = self.encode(enc_type, [self.text.encode('utf-8')])
+            if encoded is None:
+                continue
+            self.assertEqual(ds.decode('k', enc_type, encoded), self.text)
+            self.assertRaises(
+                ds.DecodeError, ds.decode, 'k', enc_type,
+                encoded[:len(encoded) // 8 * 4])
+
+    def test_truncated_gzip(self):
+        for size in (len(self.encoded) // 8 * 4, len(self.encoded) - 8):
+            self.assertRaises(
+                ds.DecodeError, ds.decode, 'k', 'gzip+base64',
+                self.encoded[:size])
+
+    def test_decompression_bomb(self):
+        max_size = 1024 * 1024
+        chunk = b'\0' * max_size
+        for enc_type in self.ENC_TYPES:
+            encoded = self.encode(enc_type, [chunk] * 32)
+            if encoded is None:
+                continue
+            decoder = ds.StreamDecoder('k', enc_type, max_size)
+            decompressor = RecordingDecompressor(decoder._decompressor)
+            decoder._decompressor = decompressor
+            with self.assertRaises(ds.DecodeError):
+                for i in range(0, len(encoded), ds._DECODE_CHUNK_SIZE):
+                    decoder.update(encoded[i:i + ds._DECODE_CHUNK_SIZE])
+                decoder.finish()
+            self.assertTrue(
+                max(decompressor.sizes) <=
+                max_size + 2 * ds._ZSTD_BLOCK_SIZE_MAX, enc_type)
+
+    def test_truncated_parts(self):
+        ds.set_transport(ds.LocalBackdoorTransport({
+            'userdata.encoding': 'gzip+base64',
+            'userdata.parts': '2',
+            'userdata.0': self.encoded[:1024],
+            'userdata.1': self.encoded[1024:2048],
+        }))
+        self.addCleanup(ds.set_transport, None)
+        self.assertRaises(ds.DecodeError, ds.guestinfo, 'userdata')
+
+
+class LoadTest(unittest.TestCase):
+
+    def test_sniff_format(self):
+        for data, fmt in (
+                ('{"a": 1}', ds.FORMAT_JSON),
+                (' \r\n\t[1, 2]', ds.FORMAT_JSON),
+                ('a: 1\n', ds.FORMAT_YAML),
+                ('#cloud-config\n{}', ds.FORMAT_YAML),
+                ('--- {a: 1}', ds.FORMAT_YAML),
+                (' ' * 2048 + '{}', ds.FORMAT_YAML),
+                ('', ds.FORMAT_YAML)):
+            self.assertEqual(ds.sniff_format(data), fmt, repr(data))
+
+    def test_load(self):
+        for data, fmt in (
+                ('{"a": 1}', None),
+                ('{"a": 1}', ds.FORMAT_JSON),
+                ('{"a": 1}', ds.FORMAT_YAML),
+                ('a: 1', None),
+                ('a: 1', ds.FORMAT_YAML),
+                ('{a: 1}', None),
+                ('{a: 1}', ds.FORMAT_JSON),
+                ('a: 1', 'toml')):
+            self.assertEqual(ds.load(data, fmt), {'a': 1}, repr(data))
+        self.assertEqual(ds.load(None), {})
+
+
+class ReadOnlyTransport(ds.LocalBackdoorTransport):
+    '''
+    ReadOnlyTransport is a LocalBackdoorTransport that fails to set keys
+    '''
+
+    def set(self, key, value):
+        raise IOError("%s is read-only" % key)
+
+
+class LocalBackdoorTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.transport = ds.LocalBackdoorTransport({
+            'metadata': json.dumps({
+                'instance-id': 'i-1',
+                'cleanup-guestinfo': ['userdata'],
+            }),
+            'userdata': ds.encode_gzip_base64('#cloud-config\n{}\n'),
+            'userdata.encoding': 'gzip+base64',
+        })
+        ds.set_transport(self.transport)
+
+    def tearDown(self):
+        ds.set_transport(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_and_set(self):
+        self.assertEqual(ds.get_data_access_method(), 'local-backdoor')
+        self.assertEqual(ds.guestinfo('userdata'), '#cloud-config\n{}\n')
+        self.assertIsNone(ds.guestinfo('vendordata'))
+        self.assertTrue(ds.set_guestinfo_value('local-ipv4', '10.0.0.2'))
+        self.assertEqual(self.transport.values['local-ipv4'], '10.0.0.2')
+        self.assertEqual(ds.get_guestinfo_value('local-ipv4'), '10.0.0.2')
+
+    def test_clear_guestinfo_keys(self):
+        self.assertEqual(ds.clear_guestinfo_keys(['userdata']), {})
+        self.assertEqual(self.transport.values['userdata'], '---')
+        self.assertFalse(ds.get_guestinfo_value('userdata.encoding'))
+        self.assertIsNone(ds.guestinfo('userdata'))
+
+    def test_failed_writes(self):
+        ds.set_transport(ReadOnlyTransport(self.transport.values))
+        self.assertIsNone(ds.set_guestinfo_value('local-ipv4', '10.0.0.2'))
+        failures = ds.clear_guestinfo_keys(['userdata'])
+        self.assertEqual(sorted(failures), ['userdata', 'userdata.encoding'])
+
+    def test_clear_guestinfo_keys_transport_calls(self):
+        store = tempfile.mkdtemp(dir=self.tmpdir)
+        os.environ[ds._STORE_ENV_VAR] = store
+        self.addCleanup(os.environ.pop, ds._STORE_ENV_VAR)
+        encoded = ds.encode_gzip_base64('#cloud-config\n{}\n')
+        transport = RecordingTransport({
+            'userdata.0': encoded[:8],
+            'userdata.1': encoded[8:],
+            'userdata.parts': '2',
+            'userdata.encoding': 'gzip+base64',
+            'vendordata': '#cloud-config',
+            'vendordata.ref': 'sha256:' + ds.get_text_digest('#cloud-config'),
+        })
+        ds.set_transport(transport)
+        self.assertEqual(ds.guestinfo_many(['userdata', 'vendordata']), {
+            'userdata': '#cloud-config\n{}\n',
+            'vendordata': '#cloud-config',
+        })
+
+        del transport.reads[:]
+        self.assertEqual(ds.clear_guestinfo_keys(['userdata']), {})
+        self.assertEqual(transport.reads, [])
+        self.assertEqual(sorted(transport.writes), [
+            'userdata', 'userdata.0', 'userdata.1', 'userdata.digest',
+            'userdata.encoding', 'userdata.parts', 'userdata.signature'])
+
+        del transport.writes[:]
+        self.assertEqual(ds.clear_guestinfo_keys(['vendordata']), {})
+        self.assertEqual(transport.reads, [])
+        self.assertEqual(sorted(transport.writes), [
+            'vendordata', 'vendordata.encoding', 'vendordata.ref'])
+
+    def new_datasource(self):
+        paths = helpers.Paths({
+            'cloud_dir': self.tmpdir,
+            'run_dir': self.tmpdir,
+        })
+        return ds.DataSourceVMwareGuestInfo(
+            {'datasource': {'VMwareGuestInfo': {'cache': False}}}, None, paths)
+
+    def test_get_data(self):
+        source = self.new_datasource()
+        self.assertTrue(source.get_data())
+        self.assertEqual(source.get_instance_id(), 'i-1')
+        self.assertEqual(source.userdata_raw, '#cloud-config\n{}\n')
+        self.assertIsNone(source.vendordata_raw)
+        self.assertEqual(self.transport.values['userdata'], '---')
+
+    def test_get_data_fetch_error(self):
+        self.transport.set('metadata', json.dumps({
+            'instance-id': 'i-1',
+            'cleanup-guestinfo': ['userdata', 'vendordata'],
+        }))
+        self.transport.set('userdata.digest', 'sha256:' + '0' * 64)
+        self.transport.set('vendordata', '#cloud-config')
+        source = self.new_datasource()
+        self.assertTrue(source.get_data())
+        self.assertIsNone(source.userdata_raw)
+        self.assertEqual(source.vendordata_raw, '#cloud-config')
+        self.assertEqual(list(source.guestinfo_errors), ['userdata'])
+        self.assertIsInstance(
+            source.guestinfo_errors['userdata'], ds.DecodeError)
+        self.assertNotEqual(self.transport.values['userdata'], '---')
+        self.assertEqual(self.transport.values['vendordata'], '---')
+
+        source = pickle.loads(pickle.dumps(source))
+        self.assertIsNone(source.userdata_raw)
+        self.assertEqual(source.vendordata_raw, '#cloud-config')
+
+
+class GuestInfoRefTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'sha256'))
+        os.environ[ds._STORE_ENV_VAR] = self.tmpdir
+        self.text = u'#cloud-config\n{}'
+        self.ref = 'sha256:' + ds.get_text_digest(self.text)
+        self.transport = ds.LocalBackdoorTransport({'userdata.ref': self.ref})
+        ds.set_transport(self.transport)
+
+    def tearDown(self):
+        ds.set_transport(None)
+        del os.environ[ds._STORE_ENV_VAR]
+        shutil.rmtree(self.tmpdir)
+
+    def test_store_hit(self):
+        name = os.path.join(self.tmpdir, 'sha256', self.ref[len('sha256:'):])
+        with open(name, 'wb') as f:
+            f.write((self.text + u'\n\n').encode('utf-8'))
+        self.assertEqual(ds.guestinfo('userdata'), self.text)
+
+    def test_store_miss(self):
+        for value, enc_type in (
+                (self.text + u'\n', None),
+                (ds.encode_gzip_base64(self.text + u' \n'), 'gzip+base64')):
+            self.transport.set('userdata', value)
+            self.transport.set('userdata.encoding', enc_type or '')
+            self.assertEqual(ds.guestinfo('userdata'), self.text)
+
+    def test_mismatch(self):
+        name = os.path.join(self.tmpdir, 'sha256', self.ref[len('sha256:'):])
+        with open(name, 'wb') as f:
+            f.write(b'#cloud-config\n{a: 1}\n')
+        self.transport.set('userdata', self.text + u'\n\n# changed\n')
+        self.assertRaises(ds.DecodeError, ds.guestinfo, 'userdata')
+
+
+def run_openssl(args, data=None):
+    '''
+    run_openssl runs openssl with args and data as its input, and returns
+    its output
+    '''
+    proc = subprocess.Popen(
+        [ds.OPENSSL] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    if proc.returncode:
+        raise AssertionError("openssl %s failed: %s" % (args[0], err))
+    return out
+
+
+def has_openssl():
+    '''
+    has_openssl returns whether openssl can be executed
+    '''
+    try:
+        run_openssl(['version'])
+    except OSError:
+        return False
+    return True
+
+
+@unittest.skipUnless(has_openssl(), "openssl is not installed")
+class SignatureTest(unittest.TestCase):
+
+    KEY_ALGORITHMS = {
+        'rsa': ['-algorithm', 'RSA', '-pkeyopt', 'rsa_keygen_bits:2048'],
+        'ec': ['-algorithm', 'EC', '-pkeyopt', 'ec_paramgen_curve:P-256'],
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keydir = tempfile.mkdtemp()
+        for name, args in cls.KEY_ALGORITHMS.items():
+            for i in range(2):
+                path = os.path.join(cls.keydir, '%s%d.pem' % (name, i))
+                run_openssl(['genpkey'] + args + ['-out', path])
+                run_openssl(['pkey', '-in', path, '-pubout',
+                             '-out', path + '.pub'])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.keydir)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.text = u'#cloud-config\n{}\n'
+        self.transport = ds.LocalBackdoorTransport({})
+        ds.set_transport(self.transport)
+
+    def tearDown(self):
+        ds.set_transport(None)
+        os.environ.pop(ds._SIGNING_KEY_ENV_VAR, None)
+        shutil.rmtree(self.tmpdir)
+
+    def key_path(self, name):
+        return os.path.join(self.keydir, name + '.pem')
+
+    def set_signing_key(self, name):
+        os.environ[ds._SIGNING_KEY_ENV_VAR] = self.key_path(name) + '.pub'
+
+    def set_signed(self, key, value, enc_type, name):
+        '''
+        set_signed sets key to value signed with the private key name the
+        way the README recipe does
+        '''
+        sig = run_openssl(
+            ['dgst', '-sha256', '-sign', self.key_path(name)],
+            value.encode('utf-8'))
+        self.transport.set(key, value)
+        self.transport.set(key + '.encoding', enc_type or '')
+        self.transport.set(
+            key + '.signature', base64.b64encode(sig).decode('ascii'))
+
+    def test_valid(self):
+        for name in ('rsa0', 'ec0'):
+            self.set_signing_key(name)
+            self.set_signed(
+                'userdata', ds.encode_gzip_base64(self.text), 'gzip+base64',
+                name)
+            self.assertEqual(ds.guestinfo('userdata'), self.text)
+            self.set_signed('userdata', self.text.rstrip(), None, name)
+            self.transport.set('userdata', self.text)
+            self.assertEqual(ds.guestinfo('userdata'), self.text.rstrip())
+
+    def test_tampered(self):
+        for name in ('rsa0', 'ec0'):
+            self.set_signing_key(name)
+            self.set_signed(
+                'userdata', ds.encode_gzip_base64(self.text), 'gzip+base64',
+                name)
+            self.transport.set(
+                'userdata', ds.encode_gzip_base64(self.text + u'a: 1\n'))
+            self.assertRaises(ds.DecodeError, ds.guestinfo, 'userdata')
+
+    def test_wrong_key(self):
+        for signer, verifier in (
+                ('rsa0', 'rsa1'), ('ec0', 'ec1'), ('rsa0', 'ec0')):
+            self.set_signing_key(verifier)
+            self.set_signed('userdata', self.text.rstrip(), None, signer)
+            self.assertRaises(ds.DecodeError, ds.guestinfo, 'userdata')
+
+    def test_changed_key_discards_cached_revision(self):
+        paths = helpers.Paths({
+            'cloud_dir': self.tmpdir,
+            'run_dir': self.tmpdir,
+        })
+        source = ds.DataSourceVMwareGuestInfo(
+            {'datasource': {'VMwareGuestInfo': {}}}, None, paths)
+        self.set_signing_key('ec0')
+        self.set_signed('metadata', '{"instance-id": "i-1"}', None, 'ec0')
+        self.set_signed('userdata', self.text.rstrip(), None, 'ec0')
+        self.set_signed('vendordata', '#cloud-config', None, 'ec0')
+        self.transport.set('revision', '1')
+        self.assertTrue(source.get_data())
+        self.assertEqual(source.userdata_raw, self.text.rstrip())
+        self.assertTrue(source.get_data())
+        self.set_signing_key('ec1')
+        self.assertRaises(ds.DecodeError, source.get_data)
+
+
+class RecordingTransport(ds.LocalBackdoorTransport):
+    '''
+    RecordingTransport is a LocalBackdoorTransport that records the keys
+    that are read and set
+    '''
+
+    def __init__(self, values=None):
+        ds.LocalBackdoorTransport.__init__(self, values)
+        self.reads = []
+        self.writes = []
+
+    def get(self, key):
+        self.reads.append(key)
+        return ds.LocalBackdoorTransport.get(self, key)
+
+    def set(self, key, value):
+        self.writes.append(key)
+        return ds.LocalBackdoorTransport.set(self, key, value)
+
+
+class ScriptedNetlinkMonitor(object):
+    '''
+    ScriptedNetlinkMonitor reports each of events, a list of the time and
+    the indexes of the interfaces that changed, once clock reaches its time
+    '''
+
+    def __init__(self, clock, events):
+        self.clock = clock
+        self.events = list(events)
+        self.closed = False
+
+    def wait_changes(self, timeout, changes=None):
+        found = ds.NetlinkChanges()
+        if self.events and self.events[0][0] <= self.clock.now + timeout:
+            when, indexes = self.events.pop(0)
+            self.clock.now = max(self.clock.now, when)
+            found.indexes.update(indexes)
+        else:
+            self.clock.now += timeout
+        if changes is not None:
+            changes.update(found)
+        return found
+
+    def read_changes(self, changes):
+        return changes
+
+    def close(self):
+        self.closed = True
+
+
+class RecordingAgent(ds.AddressAgent):
+    '''
+    RecordingAgent is an AddressAgent that records the time of each refresh
+    along with the indexes of the interfaces that changed
+    '''
+
+    def __init__(self, clock):
+        ds.AddressAgent.__init__(self)
+        self.clock = clock
+        self.refreshes = []
+
+    def refresh(self, changes=None):
+        self.refreshes.append((
+            self.clock.now, sorted(changes.indexes) if changes else None))
+        return ds.AddressAgent.refresh(self, changes)
+
+
+class AddressAgentTest(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patch(ds, 'time', self.clock)
+        self.transport = RecordingTransport()
+        ds.set_transport(self.transport)
+        self.addCleanup(ds.set_transport, None)
+        self.snapshot = self.new_snapshot(['10.0.0.2'], ['10.0.1.2'])
+        self.patch(ds, 'get_interface_snapshot',
+                   lambda dev_names=None, config=None: self.snapshot)
+        self.patch(ds, 'get_default_ip_addrs', self.get_default_ip_addrs)
+
+    def new_snapshot(self, *ipv4s):
+        snapshot = collections.OrderedDict()
+        for i, ipv4 in enumerate(ipv4s):
+            ipv4 = [{'addr': addr} for addr in ipv4]
+            snapshot['eth%d' % i] = ds.InterfaceInfo(
+                'eth%d' % i, '00:50:56:00:00:%02x' % i, ipv4, [], ipv4, [])
+        return snapshot
+
+    def get_default_ip_addrs(self, snapshot):
+        ipv4 = list(snapshot.values())[0].ipv4
+        return (ipv4[0]['addr'] if ipv4 else None, None)
+
+    def run_agent(self, events, iterations):
+        monitor = ScriptedNetlinkMonitor(self.clock, events)
+        self.patch(ds.NetlinkMonitor, 'open', staticmethod(
+            lambda groups=None, msg_types=None: monitor))
+        agent = RecordingAgent(self.clock)
+        ds.run_agent(agent, debounce=1, max_delay=5, min_interval=0,
+                     iterations=iterations)
+        self.assertTrue(monitor.closed)
+        return agent
+
+    def test_debounce_coalesces_changes(self):
+        start = self.clock.now
+        events = [
+            (start + 10, [2]),
+            (start + 10.5, [3]),
+            (start + 11.2, [2]),
+            (start + 20, [4]),
+        ]
+        agent = self.run_agent(events, 2)
+        self.assertEqual(agent.refreshes, [
+            (start, None),
+            (start + 12.2, [2, 3]),
+            (start + 21, [4]),
+        ])
+
+    def test_max_delay(self):
+        start = self.clock.now
+        events = [(start + 10 + i * 0.5, [2]) for i in range(20)]
+        agent = self.run_agent(events, 1)
+        self.assertEqual(agent.refreshes, [(start, None), (start + 15, [2])])
+
+    def test_publish_only_changed_keys(self):
+        agent = ds.AddressAgent()
+        agent.refresh()
+        self.assertEqual(agent.publish(), {})
+        self.assertEqual(sorted(self.transport.writes), [
+            'local-interfaces', 'local-interfaces.encoding', 'local-ipv4',
+            'local-ipv6'])
+        self.assertEqual(self.transport.values['local-ipv4'], '10.0.0.2')
+
+        del self.transport.writes[:]
+        self.assertFalse(agent.refresh())
+        self.assertEqual(agent.publish(), {})
+        self.assertEqual(self.transport.writes, [])
+
+        self.snapshot = self.new_snapshot(['10.0.0.2'], ['10.0.1.3'])
+        self.assertTrue(agent.refresh())
+        self.assertEqual(agent.publish(), {})
+        self.assertEqual(self.transport.writes, ['local-interfaces'])
+
+        del self.transport.writes[:]
+        self.snapshot = self.new_snapshot(['10.0.0.3'], ['10.0.1.3'])
+        self.assertTrue(agent.refresh())
+        self.assertEqual(agent.publish(), {})
+        self.assertEqual(
+            sorted(self.transport.writes), ['local-interfaces', 'local-ipv4'])
+        self.assertEqual(self.transport.values['local-ipv4'], '10.0.0.3')
+        interfaces = json.loads(ds.decode(
+            'local-interfaces', 'gzip+base64',
+            self.transport.values['local-interfaces']))
+        self.assertEqual(sorted(interfaces['by-ipv4']),
+                         ['10.0.0.3', '10.0.1.3'])
+
+
+def new_network_config(*dev_names):
+    '''
+    new_network_config returns a version 2 network config that enables DHCP
+    on each of dev_names
+    '''
+    ethernets = dict((name, {'dhcp4': True}) for name in dev_names)
+    return {'version': 2, 'ethernets': ethernets}
+
+
+class NetworkConfigTest(unittest.TestCase):
+
+    V1 = {
+        'version': 1,
+        'config': [{'type': 'physical', 'name': 'eth0'}],
+    }
+    V2 = new_network_config('eth0')
+    DISABLED = {'config': 'disabled'}
+
+    def load_metadata(self, network, network_enc=None):
+        metadata = {'instance-id': 'i-1', 'network': network}
+        if network_enc:
+            metadata['network.encoding'] = network_enc
+        return ds.load_metadata({'metadata': json.dumps(metadata)})
+
+    def test_valid(self):
+        for config in (self.V1, self.V2, self.DISABLED):
+            self.assertEqual(ds.load_network_config(config), config)
+            self.assertEqual(
+                ds.load_network_config(ds.encode_gzip_base64(
+                    json.dumps(config)), 'gzip+base64'), config)
+            self.assertEqual(
+                self.load_metadata(config)['network'], {'config': config})
+
+    def test_wrapped(self):
+        for config in (self.V1, self.V2, self.DISABLED):
+            wrapped = {'network': config}
+            self.assertEqual(ds.load_network_config(wrapped), config)
+            self.assertEqual(
+                ds.load_network_config(ds.encode_gzip_base64(
+                    json.dumps(wrapped)), 'gzip+base64'), config)
+            self.assertEqual(
+                self.load_metadata(wrapped)['network'], {'config': config})
+
+    def test_invalid(self):
+        for config in (
+                [self.V2],
+                {'version': 3},
+                {'config': 'enabled'},
+                {'network': {'version': 1}},
+                {'version': 1, 'config': [{'name': 'eth0'}]},
+                {'version': 2, 'ethernets': ['eth0']}):
+            self.assertRaises(
+                ds.NetworkConfigError, ds.load_network_config, config)
+            self.assertNotIn('network', self.load_metadata(config))
+        self.assertRaises(
+            ds.NetworkConfigError, ds.load_network_config,
+            'not base64', 'gzip+base64')
+
+
+class WatchTest(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patch(ds, 'time', self.clock)
+        self.metadata = {
+            'instance-id': 'i-1',
+            'network': new_network_config(),
+        }
+        self.transport = ds.LocalBackdoorTransport({
+            'metadata': json.dumps(self.metadata),
+            'revision': '1',
+        })
+        ds.set_transport(self.transport)
+        self.addCleanup(ds.set_transport, None)
+        self.applied = []
+
+    def set_metadata(self, revision, **values):
+        self.metadata.update(values)
+        self.transport.set('metadata', json.dumps(self.metadata))
+        self.transport.set('revision', revision)
+
+    def watch(self, iterations):
+        handlers = {
+            'network': lambda metadata: self.applied.append(
+                metadata['network']['config']),
+        }
+        ds.watch(handlers, interval=60, iterations=iterations)
+
+    def test_changes_are_applied(self):
+        self.clock.steps = [
+            lambda: self.set_metadata('1', network=new_network_config('eth1')),
+            lambda: self.set_metadata('2', network=new_network_config('eth2')),
+        ]
+        self.watch(3)
+        self.assertEqual(len(self.clock.sleeps), 3)
+        self.assertTrue(0 <= self.clock.sleeps[0] <= 60)
+        self.assertTrue(54 <= self.clock.sleeps[1] <= 66)
+        self.assertEqual(self.applied, [new_network_config('eth2')])
+
+    def test_first_poll_is_retried(self):
+        self.transport.set('metadata.digest', 'sha256:' + '0' * 64)
+        self.clock.steps = [
+            lambda: self.transport.set('metadata.digest', ''),
+            lambda: self.set_metadata('2', network=new_network_config('eth1')),
+        ]
+        self.watch(2)
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertEqual(self.applied, [new_network_config('eth1')])
+
+
+class SeedTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = new_ovf_env({
+            'metadata': '{"instance-id": "seed"}',
+            'userdata': '#cloud-config\n{}',
+        }).encode('utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_seed_paths(self):
+        for var in (ds._SEED_ENV_VAR, ds._SEED_CDROM_ENV_VAR):
+            self.addCleanup(os.environ.pop, var, None)
+            os.environ.pop(var, None)
+        self.assertEqual(ds.get_seed_paths(), list(ds.GUESTINFO_SEED_PATHS))
+        os.environ[ds._SEED_CDROM_ENV_VAR] = 'true'
+        self.assertEqual(
+            ds.get_seed_paths(),
+            list(ds.GUESTINFO_SEED_PATHS) + [ds.GUESTINFO_SEED_CDROM])
+        os.environ[ds._SEED_ENV_VAR] = self.tmpdir + ':'
+        self.assertEqual(ds.get_seed_paths(), [self.tmpdir])
+
+    def test_load_directory(self):
+        self.write(ds.OVF_ENV_FILE, self.env)
+        seed = ds.SeedTransport.load([self.tmpdir])
+        self.assertEqual(seed.path, self.tmpdir)
+        self.assertEqual(seed.get('metadata'), '{"instance-id": "seed"}')
+        self.assertEqual(seed.get('userdata'), '#cloud-config\n{}')
+        self.assertIsNone(seed.get('vendordata'))
+        self.assertFalse(seed.writable)
+
+    def test_load_iso_image(self):
+        path = self.write('seed.iso', new_iso_image(b'OVF_ENV.XML;1', self.env))
+        seed = ds.SeedTransport.load([path])
+        self.assertEqual(seed.path, path)
+        self.assertEqual(seed.get('metadata'), '{"instance-id": "seed"}')
+
+    def test_load_iso_image_without_env(self):
+        path = self.write('seed.iso', new_iso_image(b'OTHER.XML;1', self.env))
+        self.assertIsNone(ds.SeedTransport.load([path]))
+
+    def test_load_skips_truncated_iso_image(self):
+        image = new_iso_image(b'OVF_ENV.XML;1', self.env)
+        root = ds.ISO_PVD_OFFSET + ds.ISO_SECTOR_SIZE
+        good = self.write(ds.OVF_ENV_FILE, self.env)
+        for size in (ds.ISO_PVD_OFFSET + 140, ds.ISO_PVD_OFFSET + 160,
+                     root + 70, root + 100, len(image) - 1):
+            path = self.write('seed.iso', image[:size])
+            self.assertIsNone(ds.SeedTransport.load([path]), size)
+            self.assertEqual(ds.SeedTransport.load([path, good]).path, good)
+
+    def test_missing_keys_are_read_from_backdoor(self):
+        self.write(ds.OVF_ENV_FILE, self.env)
+        backdoor = ds.LocalBackdoorTransport({
+            'metadata': 'ignored',
+            'revision': '2',
+        })
+        seed = ds.SeedTransport.load([self.tmpdir], backdoor)
+        self.assertTrue(seed.writable)
+        self.assertEqual(seed.get('metadata'), '{"instance-id": "seed"}')
+        self.assertEqual(seed.get('revision'), '2')
+        self.assertIsNone(seed.get('vendordata'))
+        self.assertTrue(seed.set('local-ipv4', '10.0.0.2'))
+        self.assertEqual(backdoor.get('local-ipv4'), '10.0.0.2')
+
+    def test_guestinfo(self):
+        self.write(ds.OVF_ENV_FILE, self.env)
+        backdoor = ds.LocalBackdoorTransport({
+            'vendordata': 'I2Nsb3VkLWNvbmZpZwp7fQo=',
+            'vendordata.encoding': 'base64',
+        })
+        ds.set_transport(ds.SeedTransport.load([self.tmpdir], backdoor))
+        try:
+            values = ds.guestinfo_many(['userdata', 'vendordata'])
+        finally:
+            ds.set_transport(None)
+        self.assertEqual(values, {
+            'userdata': '#cloud-config\n{}',
+            'vendordata': '#cloud-config\n{}\n',
+        })
+
+
+class GuestInfoCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.product_uuid_file = ds.PRODUCT_UUID_FILE
+        ds.PRODUCT_UUID_FILE = os.path.join(self.tmpdir, 'product_uuid')
+        self.set_product_uuid('4220-0001')
+        self.transport = ds.LocalBackdoorTransport({
+            'metadata': json.dumps({'local-hostname': 'a'}),
+            'userdata': '#cloud-config\n{}',
+            'revision': '1',
+        })
+        ds.set_transport(self.transport)
+
+    def tearDown(self):
+        ds.set_transport(None)
+        ds.PRODUCT_UUID_FILE = self.product_uuid_file
+        shutil.rmtree(self.tmpdir)
+
+    def set_product_uuid(self, uuid):
+        with open(ds.PRODUCT_UUID_FILE, 'w') as f:
+            f.write(uuid.upper() + '\n')
+
+    def get_data(self):
+        paths = helpers.Paths({
+            'cloud_dir': self.tmpdir,
+            'run_dir': self.tmpdir,
+        })
+        source = ds.DataSourceVMwareGuestInfo(
+            {'datasource': {'VMwareGuestInfo': {}}}, None, paths)
+        self.assertTrue(source.get_data())
+        self.assertEqual(source.userdata_raw, '#cloud-config\n{}')
+        return source
+
+    def test_unchanged_revision_uses_cache(self):
+        self.assertEqual(self.get_data().metadata['local-hostname'], 'a')
+        self.transport.set('metadata', json.dumps({'local-hostname': 'b'}))
+        self.assertEqual(self.get_data().metadata['local-hostname'], 'a')
+        self.transport.set('revision', '2')
+        self.assertEqual(self.get_data().metadata['local-hostname'], 'b')
+
+    def test_clone_discards_cache(self):
+        self.assertEqual(self.get_data().get_instance_id(), '4220-0001')
+        self.set_product_uuid('4220-0002')
+        self.assertEqual(self.get_data().get_instance_id(), '4220-0002')
+
+    def test_clone_with_instance_id_discards_cache(self):
+        self.transport.set('metadata', json.dumps({
+            'instance-id': 'i-1',
+            'local-hostname': 'a',
+        }))
+        self.assertEqual(self.get_data().metadata['local-hostname'], 'a')
+        self.transport.set('metadata', json.dumps({
+            'instance-id': 'i-1',
+            'local-hostname': 'b',
+        }))
+        self.set_product_uuid('4220-0002')
+        self.assertEqual(self.get_data().metadata['local-hostname'], 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()